@@ -1,12 +1,11 @@
 from __future__ import annotations
 
-import asyncio
+from copy import deepcopy
 from datetime import datetime
 from functools import partial
 import logging
 import os
 from pathlib import Path
-import pickle
 import shutil
 import sys
 import traceback
@@ -20,16 +19,18 @@ from core.llm import ResponseFormat
 from core.steps import StepMessages
 from core.utils import Colors, shallow_copy, random_id
 
+from .checkpoints import CheckpointWriter, digest, merge_checkpoints, read_checkpoints
 from .clients import BaseClient
 from .configs import AgentConfig
-from .history import History, Tag
+from .history import History, HistoryJournal, HISTORY_JOURNAL, Tag, common_prefix_length
+from .progress import ProgressPublisher
 from .stats import Stats
 from . import tips as tip
 from .tips import SectionedContent, ExerciseSectionedContent
-from .tool_calls import parse_run_ipython, dump_tool_output
+from .tool_calls import parse_run_ipython, dump_tool_output, split_monologue_and_tool_call
 from .tool_call_status import TCStatus as TCS
 from .trajectory import Trajectory
-from .workspace import Workspace
+from .workspace import Workspace, WorkspaceBase
 
 class Agent:
     """Agent class that runs a task using a client and a workspace.
@@ -48,6 +49,7 @@ class Agent:
         input_variables: dict[str, Any] = None,
         initial_status: dict = None,
         init_script: str = None,
+        progress: ProgressPublisher = None,  # Publishes the steps of the run, see tasks.batch_eval.Manager
     ):
         self.task: str = task
         self.stats = Stats.from_status(initial_status)
@@ -56,27 +58,31 @@ class Agent:
         self.max_llm_calls = max_llm_calls
 
         self.msg_builder = MessageBuilder(config)
-        self.workspace: Workspace = Workspace()
+        workspace_factory = self.config.engine_config.workspace_factory or Workspace
+        self.workspace: WorkspaceBase = workspace_factory()
         self.init_script = init_script
 
         self.history = History()
+        self.last_call_messages: list[Message] = []  # Input of the previous LLM call
+        # Workspaces and histories at the end of the steps, see AgentConfig.snapshot_workspace
+        self.snapshots: dict[int, tuple[WorkspaceBase, History]] = {}
 
         self.step: int = 0
+        self.progress = progress
 
         self.setup_logging(run_path)
 
         self.return_value = None
         self.return_cls_name = return_cls_name
+        self.checkpoint_writer = CheckpointWriter()
 
-        tools = config.engine_config.get_tools()
-        self.core_tools = CoreTools(tools, agent=self)
-        self.workspace.add_variables({"tools": self.core_tools})
+        self.bind_tools()
         self.tool_docs_list = self.config.prompt_config.tool_docs_list
         if self.tool_docs_list is None:
-            self.tool_docs_list = list(tools.keys())
+            self.tool_docs_list = list(self.core_tools.tool_names)
 
         if input_variables:
-            self.workspace.add_variables(input_variables)
+            self.workspace.add_variables(input_variables, shared=True)
 
         if config and config.engine_config.modify_agent:
             config.engine_config.modify_agent(self)
@@ -94,45 +100,101 @@ class Agent:
         )
 
     def __getstate__(self):
+        "The workspace is saved in the incremental checkpoints, see save."
         state = {
             "task": self.task,
-            "workspace": self.workspace.__getstate__(),
             "step": self.step,
             "run_path": self.run_path,
             "config": self.config,
+            "return_cls_name": self.return_cls_name,
+            "init_script": self.init_script,
         }
         return state
 
     def __setstate__(self, state):
-        workspace = Workspace()
-        workspace.__setstate__(state["workspace"])
-        state["workspace"] = workspace
-
         self.__dict__.update(state)
+        self.stats = Stats()
+        self.msg_builder = MessageBuilder(self.config)
+        self.return_value = None
+        self.snapshots = {}
+        self.last_call_messages = []
+        self.checkpoint_writer = CheckpointWriter()
+        self.logger = None  # setup_logging would wipe the run path
+        self.progress = None
+
+        workspace_factory = self.config.engine_config.workspace_factory or Workspace
+        self.workspace = workspace_factory()
+        self.bind_tools()
 
+        self.history_journal = HistoryJournal(self.run_path / HISTORY_JOURNAL) if self.run_path else None
         self.history = self.load_history()
 
+    def load_history(self) -> History:
+        if self.history_journal and self.history_journal.path.exists():
+            return self.history_journal.replay(self.step)
+        elif self.run_path:
+            return History.from_xml_path(self.history_save_path)
+        else:
+            return History()
+
     def __copy__(self):
         "Create a shallow copy."
         new_agent = shallow_copy(self)
         new_agent.workspace = self.workspace.copy()
+        new_agent.bind_tools()
         new_agent.history = self.history.copy()
+        new_agent.checkpoint_writer = CheckpointWriter()
         return new_agent
 
     copy = __copy__
 
+    def branch(self, step: int) -> "Agent":
+        """Create a copy of the agent as it was at the end of the given step, e.g. to rerun the following steps.
+        The workspace is copied from the snapshot taken at that step (see AgentConfig.snapshot_workspace),
+        so the init script and the cells are not re-executed. Set up a new run path for the branch before running it."""
+        if step not in self.snapshots:
+            raise KeyError(f"No snapshot of step {step}, available steps: {sorted(self.snapshots)}")
+        workspace, history = self.snapshots[step]
+        new_agent = shallow_copy(self)
+        new_agent.step = step
+        new_agent.workspace = workspace.copy()
+        new_agent.bind_tools()
+        new_agent.history = history.copy(copy_messages=True)
+        new_agent.snapshots = {s: snapshot for s, snapshot in self.snapshots.items() if s <= step}
+        new_agent.checkpoint_writer = CheckpointWriter()
+        new_agent.trajectory = deepcopy(self.trajectory)
+        del new_agent.trajectory.half_steps[2 * step:]  # Two half-steps per step
+        return new_agent
+
+    def bind_tools(self):
+        "Create the tools of this agent and put them into its workspace, e.g. in place of the tools of a copied agent."
+        self.core_tools = CoreTools(self.config.engine_config.get_tools(), agent=self)
+        self.workspace.add_variables({"tools": self.core_tools})
+
     def save(self):
+        "Save an incremental checkpoint of the agent, see agent.checkpoints."
         if self.run_path is not None:
             filename = self.run_path / f"state_{self.step:03d}.pkl"
             self._log_and_print(f"Saving state to {filename}")
-            with open(filename, 'wb') as file:
-                pickle.dump(self, file)
+            self.checkpoint_writer.save(self.__getstate__(), self.workspace, filename)
 
     @classmethod
-    def from_saved(cls, state_filename: os.PathLike) -> "Agent":
-        with open(state_filename, 'rb') as file:
-            agent = pickle.load(file)
-
+    def from_saved(cls, state_filename: os.PathLike, input_variables: dict[str, Any] = None) -> "Agent":
+        """Restore the agent from a checkpoint written by save.
+        The input variables of the agent are not stored in the checkpoints, so they have to be given again."""
+        checkpoints = read_checkpoints(state_filename)
+        values, cell_outputs = merge_checkpoints(checkpoints)
+
+        agent = cls.__new__(cls)
+        agent.__setstate__(checkpoints[-1]["agent"])
+        agent.workspace.load_checkpoint(values, input_variables or {}, checkpoints[-1]["cell_counter"])
+        for name, content in cell_outputs.items():
+            agent.workspace.add_cell_output(name, content)
+
+        # The next checkpoint can be based on the restored one
+        agent.checkpoint_writer.base = checkpoints[-1]["path"]
+        agent.checkpoint_writer.digests = {name: digest(data) for name, data in values.items()}
+        agent.checkpoint_writer.cell_output_names = set(cell_outputs)
         return agent
 
     def __str__(self):
@@ -181,7 +243,7 @@ class Agent:
             tags={Tag.BRIEFING},
         )
 
-    def process_init_script(self):
+    async def process_init_script(self):
         if not self.init_script:
             return
         self.workspace.zero_cell_counter()
@@ -192,10 +254,11 @@ class Agent:
 </run_ipython>"""
         tc_msg = Message(role=Role.USER, content=code, tags={Tag.TOOL_CALL, Tag.INIT_SCRIPT})
         self.add_to_history(tc_msg, log=True, print=True)
-        asyncio.run(self.execute_ipython_code(code, extra_tag=Tag.INIT_SCRIPT))
+        await self.execute_ipython_code(code, extra_tag=Tag.INIT_SCRIPT)
 
     def setup_logging(self, run_path: Path):
         self.run_path = run_path
+        self.history_journal = HistoryJournal(run_path / HISTORY_JOURNAL) if run_path else None
 
         logger_name = str(run_path) if run_path else random_id(8)
         self.logger = logger = logging.Logger(logger_name)
@@ -236,12 +299,14 @@ class Agent:
         return self.run_path / f"{self.step:03d}.xml" if self.run_path else None
 
     def save_step_messages(self):
+        "Render the messages of the current step to the step file."
         if self.run_path:
             self.history.save(self.history_save_path)
 
     def add_to_history(self, msg: Message, log=False, print=False):
         self.history.add_message(msg)
-        self.save_step_messages()
+        if self.history_journal:
+            self.history_journal.add_message(self.step, msg)
         if log:
             self._log(msg)
         if print:
@@ -286,14 +351,17 @@ class Agent:
                     self._report_error("The project's quota of LLM calls is used up.")
                     return False
 
-                self.prepare_step()
-                await self.get_monologue()
-                self.trajectory.next_step()
-                tool_calls_string = await self.get_ipython_code()
+                await self.prepare_step()
+                if self.config.fused_response:
+                    tool_calls_string = await self.get_monologue_and_ipython_code()
+                else:
+                    await self.get_monologue()
+                    self.trajectory.next_step()
+                    tool_calls_string = await self.get_ipython_code()
 
                 done = await self.execute_ipython_code(tool_calls_string)
                 self.stats.set_duration()
-                self.trajectory.save("trajectory", self.run_path)
+                self.trajectory.append("trajectory", self.run_path)
                 if done:
                     if isinstance(self.return_value, Exception):
                         self._log_and_print(f"Project failed: {self.return_value}")
@@ -308,10 +376,18 @@ class Agent:
             self._report_exception(e)
             return False
 
+        finally:
+            # The step files are rendered only at step boundaries, the journal has all messages
+            self.save_step_messages()
+            if self.config.save_checkpoints:
+                self.save()
+            if self.trajectory.n_appended:
+                self.trajectory.compact("trajectory", self.run_path)
+
         self._log_and_print("Function Agent.run should not reach here.")
 
     def get_status(self):
-        n_input_tokens = self.client.count_tokens(self.history.get_messages())
+        n_input_tokens = self.client.count_tokens(self.get_messages(), cache=self.history.token_counts)
         return {
             "now": datetime.now().isoformat(),
             "start_time": self.stats.start_time.isoformat(),
@@ -324,9 +400,11 @@ class Agent:
     def initialize_history(self, msgs: list[Message]):
         for msg in msgs:
             self.history.add_message(msg)
+            if self.history_journal:
+                self.history_journal.add_message(self.step, msg)
             self._log_and_print(msg)
 
-    def prepare_step(self, status: dict = None):
+    async def prepare_step(self, status: dict = None):
         if self.step == 0:
             msgs = [
                 self.briefing_message(),
@@ -334,14 +412,22 @@ class Agent:
                 self.msg_builder.tool_docs_message(),
             ]
             self.initialize_history(msgs)
-            self.process_init_script()
+            await self.process_init_script()
 
         self.log_stats()
+        self.save_step_messages()  # The previous step is finished
+        if self.config.save_checkpoints:
+            self.save()
+        if self.config.snapshot_workspace:
+            self.snapshots[self.step] = (self.workspace.copy(), self.history.copy(copy_messages=True))
         self.step += 1
+        if self.progress:
+            self.progress.step(self.step)
 
-        self.save_step_messages()
-
-        self.history.mark_messages_outdated([Tag.MONOLOGUE_INSTRUCTION, Tag.TOOL_CALL_INSTRUCTION])
+        outdated_tags = [Tag.MONOLOGUE_INSTRUCTION, Tag.TOOL_CALL_INSTRUCTION]
+        self.history.mark_messages_outdated(outdated_tags)
+        if self.history_journal:
+            self.history_journal.mark_messages_outdated(self.step, outdated_tags)
         status = status or self.get_status()
         status_msg = Message(
             Role.USER,
@@ -356,12 +442,31 @@ class Agent:
             self._print(status_msg)
         self.trajectory.next_step(status=status)
 
-    async def get_response(self, response_format: ResponseFormat) -> str:
+    def get_messages(self) -> list[Message]:
+        "Render the history for an LLM call."
+        return self.history.get_messages(stable_prefix=self.config.stable_prefix)
+
+    def record_prefix_reuse(self, messages: list[Message]):
+        """Estimate the share of the input tokens which the LLM server can take from its prefix cache:
+        the messages that are the same as in the beginning of the previous call.
+        Recorded only with config.log_prefix_reuse, as it tokenizes the input of every call."""
+        if not self.config.log_prefix_reuse:
+            return
+        n_common = common_prefix_length(messages, self.last_call_messages)
+        n_input_tokens, n_reused_tokens = self.client.count_tokens_with_prefix(
+            messages, n_common, cache=self.history.token_counts
+        )
+        self.stats.add_prefix_reuse(min(n_reused_tokens, n_input_tokens), n_input_tokens)
+        self.last_call_messages = messages
+
+    async def get_response(self, response_format: ResponseFormat, extra_messages: list[Message] = None) -> str:
+        "Get a response to the history followed by extra_messages which are not added to the history."
         kwargs = {"stream": self.config.verbose and self.config.stream}
         kwargs["response_format"] = response_format
         title = response_format.value.upper()
         self._print(Colors.BLUE + f"==== <{title}> ====")
-        messages = self.history.get_messages()
+        messages = self.get_messages() + (extra_messages or [])
+        self.record_prefix_reuse(messages)
         content = await self.client.call(
             messages,
             stats=self.stats,
@@ -394,11 +499,34 @@ class Agent:
 
         return content
 
+    async def get_monologue_and_ipython_code(self) -> str:
+        """Get the monologue and the tool call with a single LLM call.
+
+        The LLM is prompted with a combined instruction which is not stored. The response is split and
+        the history and trajectory are updated as if get_monologue and get_ipython_code had been called."""
+        inst_msg = self.msg_builder.monologue_tool_call_instruction_message()
+        self._log(inst_msg)
+        self._print(inst_msg)
+
+        content = await self.get_response(ResponseFormat.MONOLOGUE_IPYTHON, extra_messages=[inst_msg])
+        monologue, tool_call = split_monologue_and_tool_call(content)
+
+        self.add_to_history(self.msg_builder.monologue_instruction_message())
+        self.add_to_history(Message(Role.AI, monologue, tags={Tag.MONOLOGUE}), log=True)
+        self.trajectory.set_response(monologue)
+
+        self.trajectory.next_step()
+        self.add_to_history(self.msg_builder.tool_call_instruction_message())
+        self.add_to_history(Message(role=Role.AI, content=tool_call, tags={Tag.TOOL_CALL}), log=True)
+        self.trajectory.set_response(tool_call)
+
+        return tool_call
+
     async def execute_ipython_code(self, tool_calls_string: str, extra_tag: Tag = None) -> bool:
         "Execute ipython code and return True if the task is completed."
         try:
             code = parse_run_ipython(tool_calls_string)
-            status, tool_output = self.workspace.run_ipython(code)
+            status, tool_output = await self.workspace.run_ipython_async(code)
             output = dump_tool_output(tool_output, self.workspace)
         except Exception as e:
             status = TCS.ERROR
@@ -502,6 +630,20 @@ class MessageBuilder:
             short_content=tip.TOOL_CALL_PROMPT,
         )
 
+    def monologue_tool_call_instruction_message(self):
+        "Instruction for AgentConfig.fused_response, it is not stored in the history."
+        sections = self.sectioned_content(separator="")
+        sections.add(tip.MONOLOGUE_TOOL_CALL_PROMPT)
+        if self.config.prompt_config.monologue_format:
+            sections.add(tip.MONOLOGUE_TOOL_CALL_INST, for_teacher=True)
+
+        return Message(
+            role=Role.USER,
+            content=sections.render(),
+            tags={Tag.MONOLOGUE_INSTRUCTION, Tag.TOOL_CALL_INSTRUCTION},
+            short_content=tip.MONOLOGUE_TOOL_CALL_PROMPT,
+        )
+
 
 class ExerciseMessageBuilder(MessageBuilder):
     def __init__(self, config: AgentConfig):
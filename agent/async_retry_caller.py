@@ -1,17 +1,95 @@
 import asyncio
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+import random
 import time
 
+# HTTP status codes of the errors which may succeed on a retry, other 4xx errors (e.g. 400, 401) are not retried
+RETRY_STATUS_CODES = {408, 409, 429}
+
+
+def is_retryable(e: Exception) -> bool:
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        return True  # Connection errors, timeouts and unexpected errors
+    return status_code in RETRY_STATUS_CODES or status_code >= 500
+
+
+def get_retry_after(e: Exception) -> float | None:
+    "Seconds to wait before the retry if the server says so in the Retry-After header of the error response."
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if (retry_after_ms := headers.get("retry-after-ms")) is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    if (retry_after := headers.get("retry-after")) is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                # An HTTP date
+                return max(0., parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
 class AsyncRetryCaller:
-    def __init__(self, max_attempts=3, wait_seconds=1, single_try_timeout=2, log=None):
+    """Calls an async function and retries it when it fails. Used for the LLM calls of all clients.
+
+    Every attempt is limited to single_try_timeout seconds. The wait before the retry n (1, 2, ...) is
+    wait_seconds * backoff_factor ** (n - 1), at most max_wait_seconds, multiplied by a random factor
+    between 0.5 and 1.5 so that concurrent calls do not retry together. The server can ask for a longer
+    wait with the Retry-After header. Errors which do not succeed on a retry (e.g. 400 Bad request)
+    are raised immediately. Cancelling the call cancels the current attempt or wait."""
+    def __init__(
+        self,
+        max_attempts=3,
+        wait_seconds=1,
+        single_try_timeout=2,
+        log=None,
+        limiter=None,
+        n_tokens=0,
+        backoff_factor=2.,
+        max_wait_seconds=60.,
+    ):
         self.max_attempts = max_attempts
         self.wait_seconds = wait_seconds
         self.single_try_timeout = single_try_timeout
+        self.backoff_factor = backoff_factor
+        self.max_wait_seconds = max_wait_seconds
         self.attempt_count = None
         self.success_time = None
+        self.wait_time = 0.  # Total time waiting before the retries
         self.log = log
+        self.limiter = limiter  # Every attempt takes a slot of the limiter, see agent.rate_limit
+        self.n_tokens = n_tokens  # Estimated tokens of the call for the limiter
+
+    @property
+    def retry_count(self) -> int:
+        return self.attempt_count - 1 if self.attempt_count else 0
+
+    def get_wait_seconds(self, attempt: int, e: Exception = None) -> float:
+        "Wait after the failed attempt (0-based)."
+        wait = min(self.wait_seconds * self.backoff_factor ** attempt, self.max_wait_seconds)
+        wait *= random.uniform(0.5, 1.5)
+        retry_after = get_retry_after(e) if e is not None else None
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        return wait
+
+    async def _wait_before_retry(self, attempt: int, e: Exception):
+        wait = self.get_wait_seconds(attempt, e)
+        self.wait_time += wait
+        await asyncio.sleep(wait)
 
     async def _internal_call(self, func, *args, **kwargs):
         for attempt in range(self.max_attempts):
+            self.attempt_count = attempt + 1
             try:
                 if attempt > 0:  # Print retry message only after the first attempt
                     msg = f"Attempt {attempt + 1}: Retrying API call..."
@@ -20,16 +98,18 @@ class AsyncRetryCaller:
                     else:
                         print(msg)
                 start_time = time.time()
-                result = await asyncio.wait_for(
-                    func(*args, **kwargs),
-                    self.single_try_timeout
-                )
+                async with self.limiter.slot(self.n_tokens) if self.limiter else nullcontext():
+                    start_time = time.time()  # Do not count the time waiting for the limiter
+                    result = await asyncio.wait_for(
+                        func(*args, **kwargs),
+                        self.single_try_timeout
+                    )
                 return result, attempt + 1, time.time() - start_time
             except asyncio.exceptions.TimeoutError as e:
                 if self.log:
                     self.log.warning(f"Attempt {attempt + 1} failed in {time.time() - start_time:.2f} seconds")
                 if attempt + 1 < self.max_attempts:
-                    await asyncio.sleep(self.wait_seconds)
+                    await self._wait_before_retry(attempt, e)
                 else:
                     raise Exception("Max attempts reached, giving up") from e
             except Exception as e:
@@ -37,11 +117,12 @@ class AsyncRetryCaller:
                     self.log.warning(f"Attempt {attempt + 1} failed in {time.time() - start_time:.2f} seconds")
                     self.log.warning("Unexpected error:")
                     self.log.exception(e)
-                if attempt + 1 < self.max_attempts:
-                    await asyncio.sleep(self.wait_seconds)
+                if attempt + 1 < self.max_attempts and is_retryable(e):
+                    await self._wait_before_retry(attempt, e)
                 else:
                     if self.log:
-                        self.log.error("Max attempts reached, raising an exception")
+                        reason = "Max attempts reached" if is_retryable(e) else "The error is not retryable"
+                        self.log.error(f"{reason}, raising an exception")
                     raise e
         raise Exception("AsyncRetryCaller internal error")  # We should never end up here
 
@@ -0,0 +1,335 @@
+"""Incremental checkpoints of the agent's workspace.
+
+Every checkpoint (state_NNN.pkl) stores only the variables which have changed since the previous
+checkpoint and the name of that checkpoint, so a step is restored by following the chain back to
+the first checkpoint. Large objects which are shared with the rest of the program are stored as
+references (SharedRef) instead of their values:
+    * the input variables of the agent, which have to be given to Agent.from_saved,
+    * the tools and the objects defined in the packages of the tools, e.g. the datasets returned by load_db,
+    * imported modules.
+The referenced objects are assumed to be read-only. Values that cannot be pickled (e.g. functions
+defined in the cells) are not saved.
+
+Only the variables that a cell may have changed are pickled again: the names used in the cells executed
+since the previous checkpoint and the globals used by the workspace functions and classes they refer to,
+the variables added with add_variables and the variables bound to another object. A value can also be
+changed through another name (e.g. b after b = a; a.append(1)), so the other variables which share an
+object (reachable through containers, attributes or the base of an array) with one of these are pickled too.
+"""
+import ast
+from copy import deepcopy
+from dataclasses import dataclass
+import gc
+import hashlib
+from importlib import import_module
+import os
+from pathlib import Path
+import pickle
+import sys
+from types import BuiltinFunctionType, CodeType, FunctionType, MethodType, ModuleType
+from typing import Any
+import warnings
+
+# Objects of these types are cheap to store by value
+_VALUE_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+
+@dataclass(frozen=True)
+class SharedRef:
+    "Reference to a shared object which is not stored in the checkpoint."
+    kind: str  # "input", "tool" or "module"
+    name: str = None  # Name of the input variable, tool or module
+    attr: str = None  # Attribute of the module
+    index: int = None  # Index in a tuple attribute of the module
+
+
+def is_core_tools(value: Any) -> bool:
+    # CoreTools is created with a new class for every agent, so check the attributes instead of the type
+    return hasattr(value, "tool_names") and hasattr(value, "_agent")
+
+
+def find_shared_refs(variables: dict[str, Any], shared_ids: dict[str, int]) -> dict[int, SharedRef]:
+    """Find the variables which are stored as references: object id -> reference.
+    shared_ids are the ids of the input variables when they were added to the workspace."""
+    return {key: ref for key, (_value, ref) in _find_shared_objects(variables, shared_ids).items()}
+
+
+def _find_shared_objects(variables: dict[str, Any], shared_ids: dict[str, int]) -> dict[int, tuple[Any, SharedRef]]:
+    "object id -> the object and its reference, see find_shared_refs."
+    refs = {}
+    for name, value in variables.items():
+        if shared_ids.get(name) == id(value):
+            refs[id(value)] = value, SharedRef("input", name)
+        elif isinstance(value, ModuleType):
+            refs[id(value)] = value, SharedRef("module", value.__name__)
+        elif is_core_tools(value):
+            refs[id(value)] = value, SharedRef("tool")
+            packages = set()
+            for tool_name in value.tool_names:
+                tool = getattr(value, tool_name)
+                refs[id(tool)] = tool, SharedRef("tool", tool_name)
+                packages.add(tool.func.__module__.rsplit(".", 1)[0])
+            refs.update(_module_attribute_refs(packages))
+    return refs
+
+
+def _module_attribute_refs(packages: set[str]) -> dict[int, tuple[Any, SharedRef]]:
+    refs = {}
+    for module_name, module in list(sys.modules.items()):
+        if module is None or not any(module_name.startswith(package) for package in packages):
+            continue
+        for attr, value in list(vars(module).items()):
+            if isinstance(value, tuple):
+                for i, item in enumerate(value):
+                    if not isinstance(item, _VALUE_TYPES):
+                        refs.setdefault(id(item), (item, SharedRef("module", module_name, attr, i)))
+            if not isinstance(value, _VALUE_TYPES):
+                refs.setdefault(id(value), (value, SharedRef("module", module_name, attr)))
+    return refs
+
+
+def copy_namespace(variables: dict[str, Any], shared_ids: dict[str, int]) -> dict[str, Any]:
+    """Deep copy the variables, e.g. for a snapshot of the workspace. The shared objects (see find_shared_refs)
+    are not copied, and neither are the values that cannot be copied (e.g. generators)."""
+    memo = {key: value for key, (value, _ref) in _find_shared_objects(variables, shared_ids).items()}
+    new_variables = {}
+    for name, value in variables.items():
+        try:
+            new_variables[name] = deepcopy(value, memo)
+        except Exception:
+            new_variables[name] = value
+    return new_variables
+
+
+def resolve_shared_ref(ref: SharedRef, variables: dict[str, Any], input_variables: dict[str, Any]) -> Any:
+    if ref.kind == "input":
+        if ref.name not in input_variables:
+            raise KeyError(f"Input variable '{ref.name}' is needed to restore the checkpoint, pass it to Agent.from_saved")
+        return input_variables[ref.name]
+    if ref.kind == "tool":
+        core_tools = next((value for value in variables.values() if is_core_tools(value)), None)
+        if core_tools is None:
+            raise KeyError("The tools are needed to restore the checkpoint but they are not in the workspace")
+        return core_tools if ref.name is None else getattr(core_tools, ref.name)
+    value = import_module(ref.name)
+    if ref.attr is not None:
+        value = getattr(value, ref.attr)
+    if ref.index is not None:
+        value = value[ref.index]
+    return value
+
+
+def digest(data: bytes | SharedRef) -> str:
+    if isinstance(data, SharedRef):
+        return f"ref:{data!r}"
+    return hashlib.sha1(data).hexdigest()
+
+
+# Names which let a cell change any variable
+_DYNAMIC_NAMES = {"globals", "vars", "locals", "exec", "eval", "get_ipython", "__import__"}
+
+
+def _code_names(code: CodeType) -> set[str]:
+    "The global and attribute names used by the code and its nested functions."
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _workspace_code(value: Any, module_name: str) -> list[CodeType]:
+    "The code of a function or the methods of a class (or its instance) defined in the workspace."
+    if isinstance(value, MethodType):
+        value = value.__func__
+    if isinstance(value, FunctionType):
+        return [value.__code__] if value.__module__ == module_name else []
+    cls = value if isinstance(value, type) else type(value)
+    if cls.__module__ != module_name:
+        return []
+    return [
+        attr.__code__ for klass in cls.__mro__ if klass.__module__ == module_name
+        for attr in vars(klass).values() if isinstance(attr, FunctionType)
+    ]
+
+
+def cell_names(code: str, variables: dict[str, Any], module_name: str = "__main__") -> set[str] | None:
+    """Return the names of the variables that a cell may change, None if the cell may change any variable.
+    code is the cell after IPython's transformations. All the names in the cell are included since a value
+    can be changed through a method call (e.g. lst.append(1)), and so are the globals used by the functions
+    and classes of the workspace which the cell refers to (module_name is the module of the workspace)."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.alias):
+            if node.name == "*":
+                return None
+            names.add(node.asname or node.name.split(".")[0])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+
+    # The workspace functions and classes used by the cell, and the ones they use
+    queue = [name for name in names if name in variables]
+    seen = set(queue)
+    while queue:
+        for code_object in _workspace_code(variables[queue.pop()], module_name):
+            for name in _code_names(code_object):
+                names.add(name)
+                if name in variables and name not in seen:
+                    seen.add(name)
+                    queue.append(name)
+    return None if names & _DYNAMIC_NAMES else names
+
+
+# Objects which are not followed when looking for the objects shared by the variables
+_ATOMIC_TYPES = _VALUE_TYPES + (type, ModuleType, FunctionType, MethodType, BuiltinFunctionType, CodeType)
+
+
+def _reachable_ids(values: list[Any], stop_ids: set[int]) -> set[int]:
+    "Ids of the objects reachable from the values, the objects in stop_ids (e.g. the shared ones) are not followed."
+    seen = set()
+    stack = list(values)
+    while stack:
+        value = stack.pop()
+        if isinstance(value, _ATOMIC_TYPES) or id(value) in seen or id(value) in stop_ids:
+            continue
+        seen.add(id(value))
+        stack.extend(gc.get_referents(value))
+        if (base := getattr(value, "base", None)) is not None:  # A numpy view does not refer to its base for gc
+            stack.append(base)
+    return seen
+
+
+_unpicklable_warned: set[str] = set()  # Warn only once per variable name
+
+def namespace_delta(
+    variables: dict[str, Any],
+    shared_ids: dict[str, int],
+    digests: dict[str, str],  # Digests of the variables in the previous checkpoint
+    unchanged: set[str] = None,  # Variables not used since the previous checkpoint, pickled only if they share an object
+                                 # with the other variables
+    reachable: dict[str, set[int]] = None,  # Ids of the objects reachable from the variables, updated in place
+) -> tuple[dict[str, bytes | SharedRef], list[str], dict[str, str]]:
+    """Return the changed variables (pickled or references), the names of the removed variables and the new digests.
+    The objects reachable from an unchanged variable can change only through another variable which shares one of
+    them, so they are kept in reachable between the checkpoints and only the other variables are traversed."""
+    unchanged = {name for name in unchanged or () if name in digests}
+    reachable = {} if reachable is None else reachable
+    refs = find_shared_refs(variables, shared_ids) if len(unchanged) < len(variables) else {}
+    if not unchanged:
+        reachable.clear()
+    elif len(unchanged) < len(variables):
+        shared_object_ids = set(refs)
+        changed_ids = set()
+        for name, value in variables.items():
+            if name not in unchanged:
+                reachable[name] = _reachable_ids([value], shared_object_ids)
+                changed_ids |= reachable[name]
+        for name in list(unchanged):
+            if name not in reachable:
+                reachable[name] = _reachable_ids([variables[name]], shared_object_ids)
+            if reachable[name] & changed_ids:
+                # Changed through another variable, e.g. b after b = a; a.append(1)
+                unchanged.discard(name)
+                reachable[name] = _reachable_ids([variables[name]], shared_object_ids)
+        for name in set(reachable) - set(variables):
+            del reachable[name]
+    changed = {}
+    new_digests = {}
+    for name, value in variables.items():
+        if name in unchanged:
+            new_digests[name] = digests[name]
+            continue
+        data = refs.get(id(value))
+        if data is None:
+            try:
+                data = pickle.dumps(value)
+            except Exception:  # noqa: BLE001
+                if name not in _unpicklable_warned:
+                    _unpicklable_warned.add(name)
+                    warnings.warn(f"Could not pickle variable {name}, it is not saved in the checkpoint", stacklevel=2)
+                continue
+        new_digests[name] = digest(data)
+        if digests.get(name) != new_digests[name]:
+            changed[name] = data
+    removed = [name for name in digests if name not in new_digests]
+    return changed, removed, new_digests
+
+
+def load_values(
+    values: dict[str, bytes | SharedRef],
+    variables: dict[str, Any],  # Current variables of the workspace, for resolving the tools
+    input_variables: dict[str, Any],
+) -> dict[str, Any]:
+    return {
+        name: resolve_shared_ref(data, variables, input_variables) if isinstance(data, SharedRef) else pickle.loads(data)
+        for name, data in values.items()
+    }
+
+
+class CheckpointWriter:
+    "Writes the incremental checkpoints of an agent, see the module docstring."
+    def __init__(self):
+        self.base: Path | None = None  # The previous checkpoint
+        self.digests: dict[str, str] = {}
+        self.cell_output_names: set[str] = set()
+
+    def save(self, agent_state: dict, workspace, path: os.PathLike):
+        path = Path(path)
+        if path == self.base:
+            # The previous checkpoint is overwritten, so save all variables
+            self.__init__()
+        changed, removed, digests = workspace.checkpoint_delta(self.digests)
+        cell_outputs = {
+            name: content for name, content in workspace._cell_outputs.items()  # noqa: SLF001
+            if name not in self.cell_output_names
+        }
+        checkpoint = {
+            "agent": agent_state,
+            "base": self.base.name if self.base else None,
+            "changed": changed,
+            "removed": removed,
+            "cell_counter": workspace.get_cell_counter(),
+            "cell_outputs": cell_outputs,
+        }
+        with open(path, "wb") as f:
+            pickle.dump(checkpoint, f)
+        self.base = path
+        self.digests = digests
+        self.cell_output_names.update(cell_outputs)
+
+
+def read_checkpoints(path: os.PathLike) -> list[dict]:
+    "Read the checkpoint and the checkpoints it is based on, the first checkpoint first."
+    checkpoints = []
+    path = Path(path)
+    while path is not None:
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+        checkpoint["path"] = path
+        checkpoints.append(checkpoint)
+        path = path.parent / checkpoint["base"] if checkpoint["base"] else None
+    return checkpoints[::-1]
+
+
+def merge_checkpoints(checkpoints: list[dict]) -> tuple[dict[str, bytes | SharedRef], dict[str, str]]:
+    "Return the variables and the cell outputs at the last checkpoint."
+    values = {}
+    cell_outputs = {}
+    for checkpoint in checkpoints:
+        for name in checkpoint["removed"]:
+            values.pop(name, None)
+        values.update(checkpoint["changed"])
+        cell_outputs.update(checkpoint["cell_outputs"])
+    return values, cell_outputs
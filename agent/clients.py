@@ -1,16 +1,34 @@
+import asyncio
+from copy import copy
+from functools import cached_property
 import os
 import sys
 import time
+import weakref
+import numpy as np
 from transformers import AutoTokenizer, TextStreamer
 from typing import Tuple
 from warnings import warn
 
-from .async_retry_caller import AsyncRetryCaller
+from .async_retry_caller import AsyncRetryCaller, is_retryable
+from .rate_limit import estimate_tokens, get_limiter
+from .response_cache import CachedResponse, ResponseCache, cache_key
 from .stats import Stats
 
 from core import MODEL_PATH
-from core.count_tokens import num_tokens_openai
-from core.llm import ResponseFormat, START_SEQUENCES, STOP_SEQUENCES, LLM, MODEL_FULL_NAME, MyStoppingCriteria
+from core.batching import GenerationQueue
+from core.chat_templates import CHECK_CONVERSATIONS, EMPTY_MESSAGE, IncrementalChatTemplate
+from core.count_tokens import (
+    TOKENS_PER_REPLY,
+    count_tokens_cached,
+    get_encoding_openai,
+    message_token_counts,
+    num_tokens_openai,
+    num_tokens_openai_message,
+)
+from core.llm import (
+    KV_CACHE_MAX_BYTES, LLM, MODEL_FULL_NAME, MyStoppingCriteria, ResponseFormat, START_SEQUENCES, STOP_SEQUENCES,
+)
 from core.messages import Message, merge_messages
 from core.usage import Usage
 from core.utils import Colors
@@ -36,11 +54,21 @@ class BaseClient:
     ) -> str:
         raise NotImplementedError
 
-    def count_tokens(self, messages: list[Message]) -> int:
+    def count_tokens(self, messages: list[Message], cache: dict = None) -> int:
+        """Return the number of input tokens in messages.
+        cache stores the token counts of individual messages (see core.count_tokens.count_tokens_cached)."""
         # If token counting is not implemented, return a rough estimate
         n_chars = sum((len(msg.content)+4) for msg in messages)
         return n_chars // 3
 
+    def count_tokens_with_prefix(
+        self, messages: list[Message], n_prefix: int, cache: dict = None
+    ) -> tuple[int, int]:
+        """Return the number of input tokens in messages and in their first n_prefix messages
+        with a single pass over the messages, see Agent.record_prefix_reuse."""
+        n_chars = [len(msg.content)+4 for msg in messages]
+        return sum(n_chars) // 3, sum(n_chars[:n_prefix]) // 3
+
     def format_messages(
         self,
         messages: list[Message],
@@ -58,7 +86,29 @@ def get_tokenizer_name(model_name: str) -> str:
     else:
         raise ValueError(f"Not sure which tokenizer to use for model {model_name}")
 
-def get_client(model: str, base_url: str = "http://localhost:8000/v1") -> BaseClient:
+def get_client(
+    model: str,
+    base_url: str | list[str] = "http://localhost:8000/v1",  # A list of vLLM servers is load balanced
+    cache: ResponseCache | os.PathLike = None,  # Replay the responses from this cache, see CachedClient
+    coalesce: bool = False,  # Share the responses between identical concurrent calls, see CoalescingClient
+    hedge_percentile: float = None,  # Duplicate the calls slower than this percentile, see HedgingClient
+) -> BaseClient:
+    if isinstance(base_url, (list, tuple)):
+        first = _get_client(model, base_url[0])
+        if not isinstance(first, vLLMClient):
+            raise ValueError(f"Several base URLs are supported only for vLLM models, got {model}")
+        client = LoadBalancingClient([first] + [first.with_base_url(url) for url in base_url[1:]])
+    else:
+        client = _get_client(model, base_url)
+    if hedge_percentile is not None:
+        client = HedgingClient(client, percentile=hedge_percentile)
+    if coalesce:
+        client = CoalescingClient(client)
+    if cache is not None:
+        client = CachedClient(client, cache)
+    return client
+
+def _get_client(model: str, base_url: str) -> BaseClient:
     if model.startswith("claude"):
         return ClaudeClient(model=model)
     elif model.startswith("deepseek"):
@@ -66,13 +116,13 @@ def get_client(model: str, base_url: str = "http://localhost:8000/v1") -> BaseCl
     elif model.startswith("gpt") or model.startswith("o1"):
         return OpenAIClient(model=model)
     elif model == "mixtral":
-        llm = LLM("mixtral-instruct")
+        llm = LLM("mixtral-instruct", kv_cache_max_bytes=KV_CACHE_MAX_BYTES)
         return LLMClient(llm, merge_messages_by_role=True)
     elif model == "llama3-8b":
-        llm = LLM("llama3-8b-instruct")
+        llm = LLM("llama3-8b-instruct", kv_cache_max_bytes=KV_CACHE_MAX_BYTES)
         return LLMClient(llm, merge_messages_by_role=False)
     elif model == "llama3-70b":
-        llm = LLM("llama3-70b-instruct")
+        llm = LLM("llama3-70b-instruct", kv_cache_max_bytes=KV_CACHE_MAX_BYTES)
         return LLMClient(llm, merge_messages_by_role=False)
     elif model.startswith("v-"):
         # Example: "v-llama3-8b"
@@ -109,9 +159,23 @@ class OpenAIClient(BaseClient):
         self.merge_messages_by_role = merge_messages_by_role
         self._response_format_warning_issued = False
 
-    def count_tokens(self, messages: list[Message]) -> int:
+    def count_tokens(self, messages: list[Message], cache: dict = None) -> int:
         messages = self.format_messages(messages)
-        return num_tokens_openai(messages, self.model)
+        return num_tokens_openai(messages, self.model, cache=cache)
+
+    def count_tokens_with_prefix(
+        self, messages: list[Message], n_prefix: int, cache: dict = None
+    ) -> tuple[int, int]:
+        # The messages are not merged by role, so that the prefix is counted in messages
+        fmt_messages = [message_to_dict(msg) for msg in messages]
+        encoding = get_encoding_openai(self.model)
+        counts = message_token_counts(
+            fmt_messages,
+            lambda message: num_tokens_openai_message(message, encoding),
+            tokenizer=encoding.name,
+            cache=cache,
+        )
+        return sum(counts) + TOKENS_PER_REPLY, sum(counts[:n_prefix])
 
     async def call(
         self,
@@ -138,12 +202,20 @@ class OpenAIClient(BaseClient):
 
             stop_seq = STOP_SEQUENCES[response_format]
 
+        # The stream is closed as soon as the stop sequence is generated
+        # A JSON response is not cut because its stop sequence may occur inside of it
+        stop_sequence = stop_seq if response_format and response_format != ResponseFormat.JSON else None
+
         fmt_messages = self.format_messages(messages)
         call_outputs = await self._call(
             fmt_messages,
             stats,
             stream=stream,
             return_full_response=return_full_response,
+            max_attempts=max_attempts,
+            wait_seconds=wait_seconds,
+            single_try_timeout=single_try_timeout,
+            stop_sequence=stop_sequence,
             **kwargs)
         if return_full_response:
             content, response = call_outputs
@@ -151,8 +223,11 @@ class OpenAIClient(BaseClient):
             content = call_outputs
 
         # This is a hack that we have to use without guidance
-        if response_format and response_format != ResponseFormat.JSON:
-            content = content.split(stop_seq)[0] + stop_seq
+        if stop_sequence:
+            content, found, tail = content.partition(stop_seq)
+            content += stop_seq
+            if found and not stream and stats:  # A streamed response is closed early, see Stats.saved_output_tokens
+                stats.add_stop_tail(self._count_text_tokens(tail))
 
         return content
 
@@ -163,6 +238,10 @@ class OpenAIClient(BaseClient):
         *,
         return_full_response=False,
         color: str = Colors.BLUE,
+        max_attempts: int = 3,
+        wait_seconds: int = 1,
+        single_try_timeout: int = 120,
+        stop_sequence: str = None,  # When streaming, stop reading the stream after this sequence
         **kwargs
     ) -> str:
         """
@@ -171,13 +250,25 @@ class OpenAIClient(BaseClient):
         messages_or_prompt is either a list of messages or a prompt string.
         If a list is passed, the chat API is used, otherwise the completion API.
         """
+        # The limiter of the endpoint is shared by all clients calling it
+        limiter = get_limiter(self.client.base_url)
+        n_tokens = estimate_tokens(messages_or_prompt) + kwargs.get("max_tokens", 0)
+        retry_caller = AsyncRetryCaller(
+            max_attempts=max_attempts,
+            wait_seconds=wait_seconds,
+            single_try_timeout=single_try_timeout,
+            limiter=limiter,
+            n_tokens=n_tokens,
+        )
         if stream:
-            content, usage = await self.stream_response(messages_or_prompt, color=color, **kwargs)
-            call_time, retry_count = 1., 0
+            content, usage, stopped_early = await retry_caller(
+                self.stream_response, messages_or_prompt, color=color, stop_sequence=stop_sequence, **kwargs
+            )
             response = None
+            if stopped_early and stats:
+                stats.add_early_stop()
 
         else:
-            retry_caller = AsyncRetryCaller(max_attempts=3, wait_seconds=1, single_try_timeout=120)
             chat = isinstance(messages_or_prompt, list)
             if chat:
                 response = await retry_caller(
@@ -202,8 +293,12 @@ class OpenAIClient(BaseClient):
                 input_tokens=response.usage.prompt_tokens,
                 output_tokens=response.usage.completion_tokens,
             )
-            call_time = retry_caller.success_time
-            retry_count = retry_caller.attempt_count - 1
+        call_time = retry_caller.success_time
+        retry_count = retry_caller.retry_count
+        retry_wait_time = retry_caller.wait_time
+
+        if usage.input_tokens or usage.output_tokens:
+            limiter.adjust_tokens(usage.input_tokens + usage.output_tokens - n_tokens)
 
         if stats:
             stats.update(
@@ -211,6 +306,7 @@ class OpenAIClient(BaseClient):
                 call_time=call_time,
                 retry_count=retry_count,
                 model=self.model,
+                retry_wait_time=retry_wait_time,
             )
         if return_full_response:
             return content, response
@@ -222,8 +318,12 @@ class OpenAIClient(BaseClient):
         messages_or_prompt: list[dict] | str,  # List of messages or a prompt string
         *,
         color: str = Colors.BLUE,
+        stop_sequence: str = None,
         **kwargs,  # Additional arguments to pass to the OpenAI API
-    ) -> Tuple[str, Usage]:
+    ) -> Tuple[str, Usage, bool]:
+        """Stream the response and print it. If stop_sequence is given, the stream is closed as soon as
+        the sequence is received, so the server stops generating. Returns the content, the usage and
+        whether the stream was closed early."""
         kwargs["stream"] = True
         chat = isinstance(messages_or_prompt, list)
         if chat:
@@ -241,6 +341,7 @@ class OpenAIClient(BaseClient):
 
         content = ""
         start = True
+        stopped_early = False
         async for chunk in response:
             choice = chunk.choices[0]
             text = choice.delta.content if hasattr(choice, "delta") else choice.text
@@ -249,9 +350,21 @@ class OpenAIClient(BaseClient):
                 if self.remove_leading_space and text.startswith(" "):
                     text = text[1:]
             if text:
+                # The stop sequence may start in one of the previous chunks
+                search_start = max(0, len(content) - len(stop_sequence) + 1) if stop_sequence else 0
                 content += text
+                if stop_sequence and (stop_index := content.find(stop_sequence, search_start)) >= 0:
+                    end = stop_index + len(stop_sequence)
+                    print_response(text[:len(text) - (len(content) - end)], color)
+                    content = content[:end]
+                    stopped_early = True
+                    break
                 print_response(text, color)
         default_color()
+        if stopped_early:
+            await response.close()
+            # The usage is sent at the end of the stream
+            return content, self._estimate_usage(messages_or_prompt, content), stopped_early
 
         if hasattr(chunk, "usage") and chunk.usage:
             # PerplexityAI returns usage in the chunk
@@ -263,11 +376,22 @@ class OpenAIClient(BaseClient):
             elif hasattr(chunk.usage, "prompt_tokens"):
                 usage = Usage.from_openai(chunk.usage)
             else:
-                usage = Usage()
+                usage = self._estimate_usage(messages_or_prompt, content)
         else:
-            usage = Usage()  # Note: OpenAI does not return usage in the stream
+            usage = self._estimate_usage(messages_or_prompt, content)  # Note: OpenAI does not return usage in the stream
 
-        return content, usage
+        return content, usage, stopped_early
+
+    def _estimate_usage(self, messages_or_prompt: list[dict] | str, content: str) -> Usage:
+        "Usage of a streamed response without the usage chunk, counted on the client side."
+        if isinstance(messages_or_prompt, list):
+            input_tokens = num_tokens_openai(messages_or_prompt, self.model)
+        else:
+            input_tokens = self._count_text_tokens(messages_or_prompt)
+        return Usage(input_tokens=input_tokens, output_tokens=self._count_text_tokens(content))
+
+    def _count_text_tokens(self, text: str) -> int:
+        return len(get_encoding_openai(self.model).encode(text))
 
 
 class LLMClient(BaseClient):
@@ -275,7 +399,8 @@ class LLMClient(BaseClient):
         self,
         llm: LLM,
         tokenizer_id: str = None,
-        merge_messages_by_role: bool = False
+        merge_messages_by_role: bool = False,
+        max_batch_size: int = 8,  # Concurrent calls are generated in batches, see core.batching. 1 disables it
     ):
 
         self.llm = llm
@@ -285,6 +410,28 @@ class LLMClient(BaseClient):
         tokenizer_id = tokenizer_id or llm.model_id
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
         self._terminators = [self.tokenizer.eos_token_id]
+        if max_batch_size > 1:
+            self.generation_queue = GenerationQueue(llm, self.tokenizer, max_batch_size=max_batch_size)
+        else:
+            self.generation_queue = None
+        self._sessions = set()  # Sessions whose KV cache is dropped with their Stats
+
+    def _session_key(self, session_id, stats: Stats | None):
+        "The calls of a session reuse the KV cache of the previous call, by default the calls with the same Stats."
+        if session_id is not None:
+            return session_id
+        if stats is not None and self.llm.kv_cache is not None:
+            stats = stats.get_root_stats()
+            key = ("stats", id(stats))
+            if key not in self._sessions:
+                self._sessions.add(key)
+                weakref.finalize(stats, self._drop_session, key)
+            return key
+        return None
+
+    def _drop_session(self, key):
+        self._sessions.discard(key)
+        self.llm.kv_cache.drop(key)
 
     async def call(
         self,
@@ -293,16 +440,28 @@ class LLMClient(BaseClient):
         stats: Stats = None,
         verbose: bool = False,
         response_format: ResponseFormat = None,
+        session_id=None,
         **kwargs,
     ) -> str:
         t0 = time.perf_counter()
 
-        content, truncated = self._call(
-            messages,
-            response_format=response_format,
-            merge_messages_by_role=self.merge_messages_by_role,
-            **kwargs
-        )
+        session_id = self._session_key(session_id, stats)
+        if self.generation_queue is not None and not kwargs.get("stream"):
+            content, truncated = await self._call_batched(
+                messages,
+                response_format=response_format,
+                merge_messages_by_role=self.merge_messages_by_role,
+                session_id=session_id,
+                **kwargs
+            )
+        else:
+            content, truncated = self._call(
+                messages,
+                response_format=response_format,
+                merge_messages_by_role=self.merge_messages_by_role,
+                session_id=session_id,
+                **kwargs
+            )
         call_time = time.perf_counter() - t0
 
         if stats:
@@ -318,6 +477,7 @@ class LLMClient(BaseClient):
         response_format: ResponseFormat = None,
         stream: bool = False,
         merge_messages_by_role: bool = True,
+        session_id=None,
     ) -> tuple[str, bool]:
         if merge_messages_by_role:
             messages = merge_messages(messages)
@@ -348,9 +508,10 @@ class LLMClient(BaseClient):
             max_new_tokens=max_new_tokens,
             streamer=streamer,
             stop_criteria=stop_criteria,
+            session_id=session_id,
         )
 
-        if stop_criteria and stop_criteria(output_tokens, None):
+        if stop_criteria and stop_criteria.stopped is not None and stop_criteria.stopped[0]:
             truncated = True
         else:
             truncated = output_tokens[0, -1] != self.tokenizer.eos_token_id
@@ -361,10 +522,44 @@ class LLMClient(BaseClient):
             response = start_sequence + response
         return response, truncated
 
+    async def _call_batched(
+        self,
+        messages: list[Message] = None,
+        temperature: float = None,
+        max_new_tokens: int = 2000,
+        response_format: ResponseFormat = None,
+        stream: bool = False,
+        merge_messages_by_role: bool = True,
+        session_id=None,
+    ) -> tuple[str, bool]:
+        "The same as _call without streaming, but the prompt is generated together with the concurrent calls."
+        if merge_messages_by_role:
+            messages = merge_messages(messages)
+        prompt = self.llm.messages_to_prompt(messages)
+
+        start_sequence = START_SEQUENCES[response_format] if response_format else None
+        stop_sequence = STOP_SEQUENCES[response_format] if response_format else None
+        if start_sequence:
+            prompt += start_sequence
+
+        result = await self.generation_queue.generate(
+            prompt,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            stop_sequence=stop_sequence,
+            session_id=session_id,
+        )
+
+        response = result.text
+        if start_sequence:
+            response = start_sequence + response
+        return response, result.truncated
+
 
 class MockClient(BaseClient):
     """A mock client that returns a sequence of responses, or a default response if the sequence is empty."""
     def __init__(self, responses: list[str]):
+        super().__init__()
         self.responses = responses
         self.stored_messages = []
 
@@ -434,36 +629,39 @@ class ClaudeClient(BaseClient):
             if stream:
                 print_response(start_seq)
 
-        for retry_count in range(max_attempts):
-            try:
-                if not stream:
-                    message = await self.client.messages.create(
-                        model=self.model,
-                        max_tokens=1000,
-                        temperature=0.0,
-                        messages=fmt_messages,
-                    )
-                    content = message.content[0].text
-                else:
-                    async with self.client.messages.stream(
-                        max_tokens=1024,
-                        messages=fmt_messages,
-                        model=self.model,
-                    ) as response:
-                        content = ""
-                        async for text in response.text_stream:
-                            content += text
-                            print_response(text)
-                            if response_format and stop_seq in content:
-                                break
-
-                    message = response.current_message_snapshot
-
-                usage = Usage.from_anthropic(message.usage)
-                break
-            except Exception as e:
-                print(f"Attempt {retry_count+1}/{max_attempts} failed: {e}")
-                time.sleep(wait_seconds)
+        async def create() -> tuple[str, Usage]:
+            if not stream:
+                message = await self.client.messages.create(
+                    model=self.model,
+                    max_tokens=1000,
+                    temperature=0.0,
+                    messages=fmt_messages,
+                )
+                content = message.content[0].text
+            else:
+                async with self.client.messages.stream(
+                    max_tokens=1024,
+                    messages=fmt_messages,
+                    model=self.model,
+                ) as response:
+                    content = ""
+                    async for text in response.text_stream:
+                        content += text
+                        print_response(text)
+                        if response_format and stop_seq in content:
+                            break
+
+                message = response.current_message_snapshot
+            return content, Usage.from_anthropic(message.usage)
+
+        retry_caller = AsyncRetryCaller(
+            max_attempts=max_attempts,
+            wait_seconds=wait_seconds,
+            single_try_timeout=single_try_timeout,
+            limiter=get_limiter(self.client.base_url),
+            n_tokens=estimate_tokens(fmt_messages) + 1000,
+        )
+        content, usage = await retry_caller(create)
 
         if response_format:
             content = start_seq + content
@@ -471,7 +669,13 @@ class ClaudeClient(BaseClient):
             content = content.split(stop_seq)[0] + stop_seq
 
         if stats:
-            stats.update(usage=usage, retry_count=retry_count, model=self.model)
+            stats.update(
+                usage=usage,
+                call_time=retry_caller.success_time,
+                retry_count=retry_caller.retry_count,
+                model=self.model,
+                retry_wait_time=retry_caller.wait_time,
+            )
 
         return content
 
@@ -510,6 +714,8 @@ class vLLMClient(OpenAIClient):
 
         tokenizer_name = MODEL_FULL_NAME[tokenizer] if tokenizer in MODEL_FULL_NAME else tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        # Renders the prompts of the completion API, caching the rendered messages of the growing history
+        self.prompt_renderer = IncrementalChatTemplate(self.tokenizer)
         self.extra_body = {
             #"top_k": 50,
             #
@@ -526,10 +732,72 @@ class vLLMClient(OpenAIClient):
         self.remove_leading_space = True
         self.merge_messages_by_role = merge_messages_by_role
 
-    def count_tokens(self, messages: list[Message]) -> int:
+    def with_base_url(self, base_url: str) -> "vLLMClient":
+        "Return a client of another server of the same model, sharing the tokenizer."
+        client = copy(self)
+        client.client = type(self.client)(base_url=base_url, api_key=self.client.api_key)
+        return client
+
+    def count_tokens(self, messages: list[Message], cache: dict = None) -> int:
         fmt_messages = self.format_messages(messages)
-        tokenized_messages = self.tokenizer.apply_chat_template(fmt_messages, tokenize=True)
-        return len(tokenized_messages)
+        if cache is None or not fmt_messages or not self._exact_cached_counts:
+            return len(self._tokenize_chat(fmt_messages))
+        return self._count_tokens_cached(fmt_messages, cache)
+
+    def count_tokens_with_prefix(
+        self, messages: list[Message], n_prefix: int, cache: dict = None
+    ) -> tuple[int, int]:
+        """Count the messages in a single pass with the cached message counts if they are exact, otherwise
+        tokenize the rendered prompt once: the prefix tokens are the ones which start in the rendering of
+        the first n_prefix messages. The messages are not merged by role, like in OpenAIClient."""
+        fmt_messages = [message_to_dict(msg) for msg in messages]
+        if not fmt_messages:
+            return 0, 0
+        if cache is not None and self._exact_cached_counts:
+            counts = self._message_token_counts(fmt_messages, cache)
+            return sum(counts), sum(counts[:n_prefix])
+        prompt = self.prompt_renderer.render(fmt_messages)
+        n_prefix_chars = len(self.prompt_renderer.render(fmt_messages[:n_prefix])) if n_prefix else 0
+        offsets = self.tokenizer(prompt, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        return len(offsets), sum(start < n_prefix_chars for start, _end in offsets)
+
+    def _tokenize_chat(self, messages: list[dict]) -> list[int]:
+        return self.tokenizer.apply_chat_template(messages, tokenize=True, return_dict=False)
+
+    def _count_tokens_cached(self, messages: list[dict], cache: dict) -> int:
+        return sum(self._message_token_counts(messages, cache))
+
+    def _message_token_counts(self, messages: list[dict], cache: dict) -> list[int]:
+        """The chat template is a concatenation of message blocks, so the blocks can be counted separately.
+        The template may render the first message differently (e.g. the system prompt of Llama 3.1 follows
+        a date header), so it is counted together with the beginning of the template under its own key."""
+        first, *rest = messages
+        tokenizer = self.tokenizer.name_or_path
+        n_first = count_tokens_cached(
+            [first], lambda message: len(self._tokenize_chat([message])), tokenizer=f"{tokenizer}#first", cache=cache
+        )
+        return [n_first] + message_token_counts(rest, self._count_message_tokens, tokenizer=tokenizer, cache=cache)
+
+    @cached_property
+    def _exact_cached_counts(self) -> bool:
+        "Whether the cached count is the same as the length of apply_chat_template for this template."
+        for messages in CHECK_CONVERSATIONS:
+            try:
+                expected = len(self._tokenize_chat(messages))
+            except Exception:
+                continue  # E.g. the template requires alternating roles
+            try:
+                if self._count_tokens_cached(messages, cache={}) != expected:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    def _count_message_tokens(self, message: dict) -> int:
+        "Number of tokens that the message block adds to the rendered chat template after the first message."
+        without = self._tokenize_chat([EMPTY_MESSAGE])
+        with_message = self._tokenize_chat([EMPTY_MESSAGE, message])
+        return len(with_message) - len(without)
 
     async def call(
         self,
@@ -584,6 +852,9 @@ class vLLMClient(OpenAIClient):
                 stats,
                 stream=stream,
                 return_full_response=return_full_response,
+                max_attempts=max_attempts,
+                wait_seconds=wait_seconds,
+                single_try_timeout=single_try_timeout,
                 **kwargs)
             if return_full_response:
                 content, response = content
@@ -594,7 +865,7 @@ class vLLMClient(OpenAIClient):
 
             # Start the assistant's answer with start_seq
             fmt_messages.append({"role": "assistant", "content": ""})
-            prompt = self.tokenizer.apply_chat_template(fmt_messages, tokenize=False)
+            prompt = self.prompt_renderer.render(fmt_messages)
             # Remove the last EOS token
             prompt = prompt.rsplit(self.tokenizer.eos_token, 1)[0]
             prompt += start_seq
@@ -604,6 +875,9 @@ class vLLMClient(OpenAIClient):
                 stats,
                 stream=stream,
                 return_full_response=return_full_response,
+                max_attempts=max_attempts,
+                wait_seconds=wait_seconds,
+                single_try_timeout=single_try_timeout,
                 **kwargs)
             if return_full_response:
                 completion, response = completion
@@ -621,6 +895,418 @@ class vLLMClient(OpenAIClient):
             return content
 
 
+class ClientWrapper(BaseClient):
+    "Base class of the clients which wrap another client, the other methods and attributes are delegated to it."
+    # Arguments of call which do not change the response
+    _NON_KEY_ARGS = {"verbose", "stream", "max_attempts", "wait_seconds", "single_try_timeout", "session_id"}
+
+    def __init__(self, client: BaseClient):
+        self.client = client
+
+    def __getattr__(self, name):
+        if name == "client":  # Not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def count_tokens(self, messages: list[Message], cache: dict = None) -> int:
+        return self.client.count_tokens(messages, cache=cache)
+
+    def count_tokens_with_prefix(
+        self, messages: list[Message], n_prefix: int, cache: dict = None
+    ) -> tuple[int, int]:
+        return self.client.count_tokens_with_prefix(messages, n_prefix, cache=cache)
+
+    def format_messages(self, messages: list[Message]) -> list[dict]:
+        return self.client.format_messages(messages)
+
+    @property
+    def model_name(self) -> str | None:
+        model = getattr(self.client, "model", None)
+        if model is None and hasattr(self.client, "llm"):
+            model = self.client.llm.model_id
+        return model
+
+    def get_cache_key(self, messages: list[Message], response_format: ResponseFormat = None, **kwargs) -> str:
+        "Key of the call, the same for the calls which get the same response from a deterministic LLM."
+        return cache_key(
+            client=type(self.client).__name__,
+            model=self.model_name,
+            chat=getattr(self.client, "chat", None),
+            messages=self.format_messages(messages),
+            response_format=response_format.value if response_format else None,
+            params={name: value for name, value in kwargs.items() if name not in self._NON_KEY_ARGS},
+        )
+
+    async def call_client(self, messages: list[Message], **kwargs) -> tuple[CachedResponse, Stats]:
+        """Call the wrapped client, return the response with its usage and the stats of the call, whose counters
+        (retries, early stops, hedges, ...) are added to the stats of the caller with update_stats."""
+        call_stats = Stats()
+        content = await self.client.call(messages, stats=call_stats, **kwargs)
+        response = CachedResponse(
+            content=content,
+            usage=call_stats.usage if call_stats.usages else None,
+            call_time=sum(call_stats.call_times),
+            cost_model=self.model_name if call_stats.costs else None,
+        )
+        return response, call_stats
+
+    @staticmethod
+    def update_stats(stats: Stats | None, response: CachedResponse, call_stats: Stats = None):
+        "Record the call, call_stats are given by the caller which made the call (not by a cache hit or a coalesced call)."
+        if stats:
+            stats.update(
+                usage=response.usage,
+                call_time=response.call_time,
+                model=response.cost_model,
+            )
+            if call_stats is not None:
+                stats.add_counters(call_stats)
+
+
+class CachedClient(ClientWrapper):
+    """Wraps a client and stores its responses in a ResponseCache, so that repeating a call
+    (e.g. re-running a taskset after changing an evaluator) does not call the LLM again.
+
+    The cached calls are replayed with the usage and the call time of the original call, so Stats
+    are the same as in the original run; they are counted in Stats.cache_hits.
+    Calls with return_full_response are not cached. The database is accessed in a worker thread,
+    so the event loop is not blocked while SQLite waits for the lock of another process."""
+    def __init__(self, client: BaseClient, cache: ResponseCache | os.PathLike):
+        super().__init__(client)
+        self.cache = cache if isinstance(cache, ResponseCache) else ResponseCache(cache)
+
+    async def call(
+        self,
+        messages: list[Message],
+        *,
+        stats: Stats = None,
+        stream: bool = False,
+        response_format: ResponseFormat = None,
+        return_full_response: bool = False,
+        **kwargs,
+    ) -> str:
+        if return_full_response:
+            return await self.client.call(
+                messages, stats=stats, stream=stream, response_format=response_format, return_full_response=True, **kwargs
+            )
+
+        key = self.get_cache_key(messages, response_format, **kwargs)
+        response = await asyncio.to_thread(self.cache.get, key)
+        if response is None:
+            response, call_stats = await self.call_client(
+                messages, stream=stream, response_format=response_format, **kwargs
+            )
+            await asyncio.to_thread(self.cache.put, key, response)
+        else:
+            call_stats = None
+            if stream:
+                print_response(response.content)
+                default_color()
+            if stats:
+                stats.add_cache_hit()
+
+        self.update_stats(stats, response, call_stats)
+        return response.content
+
+
+class _InFlightCall:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.n_waiters = 0
+
+
+class CoalescingClient(ClientWrapper):
+    """Wraps a client and shares one call of the wrapped client between identical concurrent calls,
+    e.g. the first steps of the trials of a task (see TaskSet.repeat).
+
+    Every caller gets the response and its Stats are updated with the usage of the shared call;
+    the calls which joined a call in flight are counted in Stats.coalesced_calls.
+    The shared call is cancelled only when all its callers are cancelled.
+    Only use it with deterministic sampling (temperature 0), otherwise the trials get the same responses.
+    Calls with return_full_response are not shared."""
+    def __init__(self, client: BaseClient):
+        super().__init__(client)
+        self._in_flight: dict[str, _InFlightCall] = {}
+
+    async def call(
+        self,
+        messages: list[Message],
+        *,
+        stats: Stats = None,
+        stream: bool = False,
+        response_format: ResponseFormat = None,
+        return_full_response: bool = False,
+        **kwargs,
+    ) -> str:
+        if return_full_response:
+            return await self.client.call(
+                messages, stats=stats, stream=stream, response_format=response_format, return_full_response=True, **kwargs
+            )
+
+        key = self.get_cache_key(messages, response_format, **kwargs)
+        in_flight = self._in_flight.get(key)
+        coalesced = in_flight is not None
+        if not coalesced:
+            task = asyncio.ensure_future(
+                self.call_client(messages, stream=stream, response_format=response_format, **kwargs)
+            )
+            in_flight = self._in_flight[key] = _InFlightCall(task)
+            task.add_done_callback(lambda _: self._remove_in_flight(key, in_flight))
+
+        in_flight.n_waiters += 1
+        try:
+            response, call_stats = await asyncio.shield(in_flight.task)
+        except asyncio.CancelledError:
+            in_flight.n_waiters -= 1
+            if in_flight.n_waiters == 0:
+                self._remove_in_flight(key, in_flight)
+                in_flight.task.cancel()
+            raise
+
+        if coalesced:
+            call_stats = None  # The retries and the other counters are counted by the caller which started the call
+            if stream:
+                print_response(response.content)
+                default_color()
+            if stats:
+                stats.add_coalesced_call()
+        self.update_stats(stats, response, call_stats)
+        return response.content
+
+    def _remove_in_flight(self, key: str, in_flight: _InFlightCall):
+        if self._in_flight.get(key) is in_flight:
+            del self._in_flight[key]
+
+
+class _Endpoint:
+    def __init__(self, client: BaseClient):
+        self.client = client
+        self.name = str(getattr(getattr(client, "client", None), "base_url", None) or f"endpoint {id(client)}")
+        self.outstanding = 0  # Calls in flight
+        self.n_calls = 0
+        self.n_failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.  # time.monotonic() until which the endpoint is not used
+
+    def __repr__(self):
+        return (
+            f"{self.name}: outstanding={self.outstanding}, calls={self.n_calls}, failures={self.n_failures}, "
+            f"healthy={self.is_healthy()}"
+        )
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+
+class LoadBalancingClient(ClientWrapper):
+    """Spreads the calls over several clients of the same model, e.g. vLLM servers (see get_client).
+
+    A call goes to the healthy endpoint with the fewest calls in flight. An endpoint whose call fails is
+    ejected for ejection_seconds, doubled with every consecutive failure (up to max_ejection_seconds),
+    and the call is retried on another endpoint. check_health (or start_health_checks) asks the servers
+    for their models and ejects or restores the endpoints.
+
+    With session_affinity, all calls of a session go to the same endpoint while it is healthy, so the
+    server can reuse its prefix cache. The session is given with the session_id argument of call,
+    by default the calls with the same Stats object (i.e. of the same agent) are a session."""
+    def __init__(
+        self,
+        clients: list[BaseClient],
+        *,
+        session_affinity: bool = False,
+        ejection_seconds: float = 10.,
+        max_ejection_seconds: float = 300.,
+        health_check_timeout: float = 5.,
+    ):
+        if not clients:
+            raise ValueError("LoadBalancingClient needs at least one client")
+        super().__init__(clients[0])  # Tokens are counted and messages formatted by the first client
+        self.endpoints = [_Endpoint(client) for client in clients]
+        self.session_affinity = session_affinity
+        self.ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self.health_check_timeout = health_check_timeout
+        self._sessions: dict = {}  # Session id -> endpoint
+        self._next = 0  # For breaking ties between the endpoints in turns
+        self._health_check_task: asyncio.Task = None
+
+    def __repr__(self):
+        return f"LoadBalancingClient({self.endpoints})"
+
+    def _least_outstanding(self) -> _Endpoint:
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy()]
+        if not healthy:
+            # Try the endpoint which has been ejected for the shortest time
+            return min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+        n = len(self.endpoints)
+        endpoint = min(
+            healthy, key=lambda endpoint: (endpoint.outstanding, (self.endpoints.index(endpoint) - self._next) % n)
+        )
+        self._next = (self.endpoints.index(endpoint) + 1) % n
+        return endpoint
+
+    def _session_key(self, session_id, stats: Stats | None):
+        if session_id is not None:
+            return session_id
+        if stats is not None:
+            stats = stats.get_root_stats()
+            key = ("stats", id(stats))
+            if key not in self._sessions:
+                # Forget the session when the agent's Stats are deleted
+                weakref.finalize(stats, self._sessions.pop, key, None)
+            return key
+        return None
+
+    def choose_endpoint(self, session_id=None, stats: Stats = None) -> _Endpoint:
+        key = self._session_key(session_id, stats) if self.session_affinity else None
+        endpoint = self._sessions.get(key) if key is not None else None
+        if endpoint is None or not endpoint.is_healthy():
+            endpoint = self._least_outstanding()
+            if key is not None:
+                self._sessions[key] = endpoint
+        return endpoint
+
+    def record_success(self, endpoint: _Endpoint):
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = 0.
+
+    def record_failure(self, endpoint: _Endpoint):
+        endpoint.n_failures += 1
+        endpoint.consecutive_failures += 1
+        ejection = self.ejection_seconds * 2 ** (endpoint.consecutive_failures - 1)
+        endpoint.ejected_until = time.monotonic() + min(ejection, self.max_ejection_seconds)
+
+    async def _call_endpoint(self, messages: list[Message], session_id, stats: Stats, **kwargs) -> str:
+        endpoint = self.choose_endpoint(session_id, stats)
+        endpoint.outstanding += 1
+        endpoint.n_calls += 1
+        try:
+            # The call is retried here on another endpoint
+            content = await endpoint.client.call(messages, stats=stats, max_attempts=1, **kwargs)
+        except Exception as e:
+            if is_retryable(e):
+                self.record_failure(endpoint)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        self.record_success(endpoint)
+        return content
+
+    async def call(
+        self,
+        messages: list[Message],
+        *,
+        stats: Stats = None,
+        session_id=None,  # Calls of the same session go to the same endpoint if session_affinity is set
+        max_attempts: int = 3,
+        wait_seconds: int = 1,
+        single_try_timeout: int = 120,
+        **kwargs,
+    ) -> str:
+        retry_caller = AsyncRetryCaller(
+            max_attempts=max_attempts,
+            wait_seconds=wait_seconds,
+            single_try_timeout=None,  # The endpoint's client times out the attempt, so the endpoint is ejected
+        )
+        content = await retry_caller(
+            self._call_endpoint, messages, session_id, stats, single_try_timeout=single_try_timeout, **kwargs
+        )
+        if stats and retry_caller.retry_count:
+            stats.add_retries(retry_caller.retry_count, retry_caller.wait_time)
+        return content
+
+    async def _check_endpoint(self, endpoint: _Endpoint) -> bool:
+        try:
+            await asyncio.wait_for(endpoint.client.client.models.list(), self.health_check_timeout)
+        except Exception:
+            self.record_failure(endpoint)
+            return False
+        self.record_success(endpoint)
+        return True
+
+    async def check_health(self) -> list[bool]:
+        "Check all endpoints now, return whether they are healthy."
+        return list(await asyncio.gather(*[self._check_endpoint(endpoint) for endpoint in self.endpoints]))
+
+    def start_health_checks(self, interval: float = 10.):
+        "Check the endpoints every interval seconds in the background, until stop_health_checks."
+        async def run():
+            while True:
+                await self.check_health()
+                await asyncio.sleep(interval)
+
+        self.stop_health_checks()
+        self._health_check_task = asyncio.ensure_future(run())
+
+    def stop_health_checks(self):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+
+
+class HedgingClient(ClientWrapper):
+    """Wraps a client and cuts the tail latency of the calls: if a call has not returned after the given
+    percentile of the latencies of the previous calls, a duplicate call is sent and the response which comes
+    first is used; the other call is cancelled. With a LoadBalancingClient, the duplicate usually goes to
+    another endpoint because the endpoint of the first call has one more call in flight.
+
+    The latencies are learned from the call times in self.stats; there is no hedging until min_samples
+    calls have returned. The caller's Stats count the duplicated calls and the calls where the duplicate
+    won (hedged_calls and hedge_wins). Streaming calls are not hedged."""
+    def __init__(self, client: BaseClient, percentile: float = 95., min_samples: int = 20, window: int = 500):
+        super().__init__(client)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window  # Number of the latest call times used
+        self.stats = Stats()  # Stats of all calls
+
+    def get_hedge_delay(self) -> float | None:
+        "Seconds after which a call is duplicated, None if there are not enough call times yet."
+        call_times = self.stats.call_times[-self.window:]
+        if len(call_times) < self.min_samples:
+            return None
+        return float(np.percentile(call_times, self.percentile))
+
+    async def call(
+        self,
+        messages: list[Message],
+        *,
+        stats: Stats = None,
+        stream: bool = False,
+        return_full_response: bool = False,
+        **kwargs,
+    ) -> str:
+        if stream or return_full_response:
+            return await self.client.call(
+                messages, stats=stats, stream=stream, return_full_response=return_full_response, **kwargs
+            )
+
+        delay = self.get_hedge_delay()
+        first = asyncio.ensure_future(self.call_client(messages, **kwargs))
+        calls = [first]
+        winner = None
+        try:
+            if delay is not None:
+                await asyncio.wait(calls, timeout=delay)
+                if not first.done():
+                    calls.append(asyncio.ensure_future(self.call_client(messages, **kwargs)))
+            pending = set(calls)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((call for call in calls if call in done and call.exception() is None), None)
+        finally:
+            for call in calls:
+                call.cancel()  # Does nothing if the call is done
+
+        # If all calls failed, raise the error of the first call
+        response, call_stats = (winner or first).result()
+        self.update_stats(self.stats, response)
+        if stats and len(calls) > 1:
+            stats.add_hedge(won=winner is not first)
+        self.update_stats(stats, response, call_stats)
+        return response.content
+
+
 def message_to_dict(msg: Message) -> dict:
     return {
         "role": msg.role.value,
@@ -50,6 +50,8 @@ class AgentEngineConfig:
     tools: dict[str, Callable] = None  # If None, use the standard tools
     max_input_tokens: int = 8_192  # Maximum number of tokens in the input
     modify_agent: Callable = None  # Function to modify the agent or its environment
+    workspace_factory: Callable = None  # Function creating the workspace, None means an in-process Workspace
+                                        # See agent.workspace_pool.pooled_workspace
 
     def get_tools(self) -> dict[str, Callable]:
         return self.tools if self.tools is not None else get_standard_tools()
@@ -63,6 +65,12 @@ class AgentConfig:
     engine_config: AgentEngineConfig = field(default_factory=AgentEngineConfig)
     stream: bool = True
     verbose: bool = True
+    fused_response: bool = False  # Get the monologue and the tool call with a single LLM call
+    stable_prefix: bool = False  # Render the history so that the prompt prefix does not change between LLM calls
+    log_prefix_reuse: bool = False  # Record the input tokens reusable from the prefix cache, see Agent.record_prefix_reuse
+    snapshot_workspace: bool = False  # Keep a copy of the workspace after every step, see Agent.branch
+                                      # Values which cannot be deep copied are shared by the copies of a Workspace
+    save_checkpoints: bool = False  # Save an incremental checkpoint after every step, see Agent.save
 
     def copy(self):
         return copy.copy(self)
@@ -1,4 +1,6 @@
+import json
 import os
+from pathlib import Path
 from typing import Union, Iterable
 from xml.etree import ElementTree as ET
 
@@ -6,10 +8,17 @@ from core.messages import Message
 from core.steps import StepMessages
 from core.tags import Tag
 
+HISTORY_JOURNAL = "history.jsonl"
+# Instructions which are needed in full only in the LLM call they are added for, see History.get_stable_messages
+INSTRUCTION_TAGS = {Tag.MONOLOGUE_INSTRUCTION, Tag.TOOL_CALL_INSTRUCTION}
+
+
 class History:
     """History holds and manages the agent messages which are needed for running a single step."""
     def __init__(self):
         self.messages: list[Message] = []
+        # Token counts of the rendered messages: (tokenizer, message hash) -> number of tokens
+        self.token_counts: dict[tuple[str, str], int] = {}
 
     def __str__(self):
         s = ""
@@ -24,7 +33,9 @@ class History:
     def __len__(self) -> int:
         return len(self.messages)
 
-    def get_messages(self) -> list[Message]:
+    def get_messages(self, stable_prefix: bool = False) -> list[Message]:
+        if stable_prefix:
+            return self.get_stable_messages()
         messages: list[Message] = []
         for msg in self.messages:
             if msg is None:
@@ -37,6 +48,24 @@ class History:
                 messages.append(msg)
         return messages
 
+    def get_stable_messages(self) -> list[Message]:
+        """Render the messages so that the messages of the previous LLM call, except its last message,
+        are a prefix of the new messages. This lets the server reuse its prefix (KV) cache.
+
+        An instruction is rendered in full only when it is the last message, i.e. in the call it is for.
+        Otherwise it is rendered as its short version, the same as an outdated message in get_messages.
+        Nothing else is rewritten, so marking messages outdated does not change the rendering."""
+        messages = [msg for msg in self.messages if msg is not None]
+        rendered: list[Message] = []
+        for i, msg in enumerate(messages):
+            if INSTRUCTION_TAGS.intersection(msg.tags) and i < len(messages) - 1:
+                short_msg = msg.short_version()
+                if short_msg.content:
+                    rendered.append(short_msg)
+            else:
+                rendered.append(msg)
+        return rendered
+
     def get_step_messages(self) -> StepMessages:
         return StepMessages(self.get_messages())
 
@@ -47,9 +76,14 @@ class History:
         if verbose:
             print(msg)
 
-    def copy(self):
+    def copy(self, copy_messages: bool = False):
+        "If copy_messages is False, the messages (and their tags) are shared with the copy."
         new_history = History()
-        new_history.messages = self.messages.copy()
+        if copy_messages:
+            new_history.messages = [msg.copy() if msg is not None else None for msg in self.messages]
+        else:
+            new_history.messages = self.messages.copy()
+        new_history.token_counts = self.token_counts  # The counts depend only on the message content
         return new_history
 
     def mark_messages_outdated(self, tags: Union[Tag, Iterable[Tag]]):
@@ -68,6 +102,12 @@ class History:
 
     @classmethod
     def from_xml_path(cls, path):
+        path = Path(path)
+        journal_path = path.parent / HISTORY_JOURNAL
+        if not path.exists() and journal_path.exists():
+            # The step file has not been rendered, e.g. the run was interrupted in the middle of the step
+            return HistoryJournal(journal_path).replay(int(path.stem))
+
         with open(path, 'r') as f:
             data = f.read()
         data_tree = ET.fromstring(data)
@@ -75,3 +115,87 @@ class History:
         for msg in data_tree.findall("message"):
             history.add_message(Message.from_xml_element(msg))
         return history
+
+
+def common_prefix_length(messages: list[Message], other: list[Message]) -> int:
+    "Return the number of leading messages which are the same in both lists."
+    n = 0
+    for msg, other_msg in zip(messages, other):
+        if msg.role != other_msg.role or msg.content != other_msg.content:
+            break
+        n += 1
+    return n
+
+
+class HistoryJournal:
+    """Append-only record of the changes made to the agent's history.
+
+    Every message is written once together with the step at which it was added. The history
+    as it looked at the end of any step (the content of the NNN.xml step files) can be rebuilt with replay."""
+    def __init__(self, path: os.PathLike):
+        self.path = Path(path)
+
+    def _append(self, record: dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def add_message(self, step: int, msg: Message | None):
+        if msg is None:
+            return
+        self._append({"step": step, "message": msg.to_dict()})
+
+    def mark_messages_outdated(self, step: int, tags: Union[Tag, Iterable[Tag]]):
+        tags = {tags} if isinstance(tags, Tag) else set(tags)
+        self._append({"step": step, "outdated": sorted(tag.value for tag in tags)})
+
+    def records(self) -> Iterable[dict]:
+        with open(self.path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    @staticmethod
+    def _apply(history: History, record: dict):
+        if "message" in record:
+            history.add_message(Message.from_dict(record["message"]))
+        else:
+            history.mark_messages_outdated([Tag(tag_str) for tag_str in record["outdated"]])
+
+    def steps(self) -> list[int]:
+        return sorted(set(record["step"] for record in self.records()))
+
+    def replay(self, step: int = None) -> History:
+        "Rebuild the history at the end of the given step (the last recorded step by default)."
+        history = History()
+        for record in self.records():
+            if step is not None and record["step"] > step:
+                break
+            self._apply(history, record)
+        return history
+
+    def replay_steps(self) -> dict[int, StepMessages]:
+        "Rebuild the messages of all steps in a single pass over the journal."
+        steps: dict[int, StepMessages] = {}
+        history = History()
+        step = None
+        for record in self.records():
+            if step is not None and record["step"] != step:
+                # Copy the messages because marking them outdated later modifies their tags
+                steps[step] = StepMessages(msg.copy() for msg in history.get_messages())
+            self._apply(history, record)
+            step = record["step"]
+        if step is not None:
+            steps[step] = history.get_step_messages()
+        return steps
+
+    def save_steps(self, run_path: os.PathLike, overwrite: bool = False) -> list[Path]:
+        "Render the step files NNN.xml from the journal."
+        paths = []
+        for step, step_messages in self.replay_steps().items():
+            path = Path(run_path) / f"{step:03d}.xml"
+            if overwrite or not path.exists():
+                history = History()
+                history.messages = list(step_messages)
+                history.save(path)
+                paths.append(path)
+        return paths
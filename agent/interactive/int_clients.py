@@ -106,3 +106,178 @@ response = await client.call(messages, stream=True)
 print(response)
 
 # %%
+# Check that the incremental rendering of the completion prompts is the same as apply_chat_template
+import random
+import time
+from transformers import AutoTokenizer
+from core.chat_templates import IncrementalChatTemplate
+from core.llm import MODEL_FULL_NAME
+
+for model in ["llama3-8b", "llama3.1-8b"]:
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_FULL_NAME[model])
+    renderer = IncrementalChatTemplate(tokenizer)
+    print(model, "incremental:", renderer.is_incremental)
+
+    random.seed(0)
+    words = ["Hello", " world ", "\n", "<status>", "x = 1", "  ", "ä"]
+    for _ in range(1000):
+        messages = [
+            {"role": random.choice(["system", "user", "assistant"]), "content": "".join(random.choices(words, k=random.randint(0, 8)))}
+        ] + [
+            {"role": random.choice(["user", "assistant"]), "content": "".join(random.choices(words, k=random.randint(0, 8)))}
+            for _ in range(random.randint(0, 15))
+        ]
+        assert renderer.render(messages) == tokenizer.apply_chat_template(messages, tokenize=False), messages
+
+    # A growing history, rendered after every message as in the agent
+    history = [{"role": "user", "content": "Answer questions about the flights table. " * 200}]
+    t_full = t_incremental = 0
+    for i in range(200):
+        history.append({"role": "assistant" if i % 2 == 0 else "user", "content": f"Message {i}. " * 50})
+        t0 = time.perf_counter()
+        tokenizer.apply_chat_template(history, tokenize=False)
+        t1 = time.perf_counter()
+        renderer.render(history)
+        t_full += t1 - t0
+        t_incremental += time.perf_counter() - t1
+    print(f"full: {t_full * 1000:.1f} ms, incremental: {t_incremental * 1000:.1f} ms")
+
+# %%
+# Adaptive concurrency: a simulated endpoint serves at most 8 calls at a time and returns 429 errors otherwise
+import asyncio
+from contextlib import redirect_stdout
+import io
+import time
+from agent.async_retry_caller import AsyncRetryCaller
+from agent.rate_limit import EndpointLimiter
+
+class RateLimitError(Exception):
+    status_code = 429
+
+in_flight = 0
+n_errors = 0
+
+async def endpoint():
+    global in_flight, n_errors
+    in_flight += 1
+    try:
+        if in_flight > 8:
+            n_errors += 1
+            raise RateLimitError("Too many requests")
+        await asyncio.sleep(0.05)
+    finally:
+        in_flight -= 1
+
+for limiter in [None, EndpointLimiter()]:
+    n_errors = 0
+    t0 = time.perf_counter()
+    retry_callers = [AsyncRetryCaller(max_attempts=100, wait_seconds=0.05, max_wait_seconds=0.2, limiter=limiter) for _ in range(200)]
+    with redirect_stdout(io.StringIO()):  # Hide the retry messages
+        await asyncio.gather(*[retry_caller(endpoint) for retry_caller in retry_callers])
+    print(f"{limiter}: {n_errors} rate limit errors, {time.perf_counter() - t0:.2f} s")
+
+# %%
+# The stream is closed as soon as the stop sequence of the response format is generated
+from agent.clients import OpenAIClient
+from agent.stats import Stats
+from core.llm import ResponseFormat
+from core.messages import Message, Role
+
+client = OpenAIClient(model="gpt-4o-mini")
+stats = Stats()
+messages = [Message(
+    Role.USER,
+    "Print the numbers from 1 to 10 in <run_ipython> tags and then explain the code in detail."
+)]
+# The non-streamed response is read to the end, its tail after the stop sequence estimates the saved tokens
+await client.call(messages, stats=stats, stream=False, response_format=ResponseFormat.IPYTHON)
+response = await client.call(messages, stats=stats, stream=True, response_format=ResponseFormat.IPYTHON)
+print(f"\n{response!r}\nearly stops: {stats.early_stops}, saved output tokens: {stats.saved_output_tokens}")
+print(f"usages: {stats.to_dict()['usages']}, cost: {stats.cost}")  # The usage of the early stop is counted by the client
+
+# %%
+# Load balancing over vLLM servers, tested against local stub servers of the OpenAI API
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from agent.clients import get_client
+from agent.stats import Stats
+from core.messages import Message, Role
+
+def start_stub_server(port: int, delay: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, data: dict):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):  # /v1/models, used by the health checks
+            self._reply({"object": "list", "data": [{"id": "stub", "object": "model", "created": 0, "owned_by": "stub"}]})
+
+        def do_POST(self):  # /v1/completions
+            self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(delay)
+            self._reply({
+                "id": "cmpl", "object": "text_completion", "created": 0, "model": "stub",
+                "choices": [{"index": 0, "text": f"port {port}", "finish_reason": "stop", "logprobs": None}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+            })
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+servers = [start_stub_server(port, delay) for port, delay in [(8101, 0.05), (8102, 0.05), (8103, 0.3)]]
+client = get_client("v-llama3-8b", base_url=[f"http://127.0.0.1:{server.server_port}/v1" for server in servers])
+client.session_affinity = True
+print(await client.check_health())
+
+messages = [Message(Role.USER, "Hello!")]
+agent_stats = [Stats() for _ in range(6)]
+for _ in range(3):
+    responses = await asyncio.gather(*[client.call(messages, stats=stats) for stats in agent_stats])
+    print(responses)
+
+servers[0].shutdown()
+servers[0].server_close()
+print(await client.check_health())
+print(client)
+
+# %%
+# Hedged calls: 5% of the calls of a simulated client take 2 s instead of 10-30 ms
+import asyncio
+import random
+import time
+from agent.clients import BaseClient, HedgingClient
+from agent.stats import Stats
+from core.messages import Message, Role
+
+class SlowTailClient(BaseClient):
+    async def call(self, messages, *, stats=None, **kwargs):
+        call_time = 2. if random.random() < 0.05 else random.uniform(0.01, 0.03)
+        await asyncio.sleep(call_time)
+        if stats:
+            stats.update(call_time=call_time)
+        return "response"
+
+random.seed(0)
+messages = [Message(Role.USER, "Hello!")]
+for client in [SlowTailClient(), HedgingClient(SlowTailClient(), percentile=90)]:
+    stats = Stats()
+    t0 = time.perf_counter()
+    for _ in range(10):  # Batches of concurrent calls
+        await asyncio.gather(*[client.call(messages, stats=stats) for _ in range(20)])
+    print(
+        f"{type(client).__name__}: {time.perf_counter() - t0:.2f} s, "
+        f"hedged calls: {stats.hedged_calls}, hedge wins: {stats.hedge_wins}"
+    )
+
+# %%
@@ -0,0 +1,85 @@
+# %%
+# Benchmark: the cost of counting the input tokens for the status message as the history grows.
+# With the token count cache of History, each step tokenizes only the new messages.
+import time
+
+from agent.clients import OpenAIClient
+from agent.history import History
+from core.messages import Message, Role
+from core.tags import Tag
+
+client = OpenAIClient(model="gpt-4o", api_key="not-needed-for-counting")
+
+def tool_output(step: int) -> str:
+    rows = "\n".join(f"{step},{i},Helsinki,{i * 17 % 101},{i * 0.37:.2f}" for i in range(15))
+    return f"<ipython_output>\n<stdout#{step}>{rows}</stdout#{step}>\n</ipython_output>"
+
+def add_step(history: History, step: int):
+    history.mark_messages_outdated([Tag.MONOLOGUE_INSTRUCTION, Tag.TOOL_CALL_INSTRUCTION])
+    history.add_message(Message(Role.USER, f"<status>step {step}</status>", tags={Tag.STATUS}))
+    history.add_message(Message(
+        Role.USER, "Think step by step. " * 20, short_content="Think.", tags={Tag.MONOLOGUE_INSTRUCTION}
+    ))
+    history.add_message(Message(Role.AI, f"<inner_monologue>\nLet's look at the rows of step {step}.\n</inner_monologue>"))
+    history.add_message(Message(
+        Role.USER, "Write the code. " * 20, short_content="Code.", tags={Tag.TOOL_CALL_INSTRUCTION}
+    ))
+    history.add_message(Message(Role.AI, f"<run_ipython>\ndf[df.step == {step}].head(15)\n</run_ipython>"))
+    history.add_message(Message(Role.USER, tool_output(step), tags={Tag.TOOL_OUTPUT}))
+
+# %%
+history = History()
+history.add_message(Message(Role.USER, "Answer questions about the flights table. " * 50, tags={Tag.BRIEFING}))
+
+print(f"{'step':>4} {'tokens':>6} {'uncached ms':>11} {'cached ms':>9}")
+step = 0
+n_tokens = 0
+while n_tokens < 8_192:
+    step += 1
+    add_step(history, step)
+    messages = history.get_messages()
+
+    t0 = time.perf_counter()
+    n_tokens = client.count_tokens(messages)
+    t_uncached = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    n_tokens_cached = client.count_tokens(messages, cache=history.token_counts)
+    t_cached = time.perf_counter() - t0
+
+    assert n_tokens == n_tokens_cached, (n_tokens, n_tokens_cached)
+    print(f"{step:4d} {n_tokens:6d} {t_uncached * 1000:11.2f} {t_cached * 1000:9.2f}")
+
+# %%
+# The same with the tokenizer of a vLLM client, whose cached count is checked against apply_chat_template.
+# The first message is a system message, which the Llama 3.1 template renders after its date header.
+from agent.clients import vLLMClient
+
+vllm_client = vLLMClient(model="llama3.1-8b", tokenizer="llama3.1-8b")
+print(f"exact cached counts: {vllm_client._exact_cached_counts}")  # False makes every count uncached
+
+for first_role in [Role.SYSTEM, Role.USER]:
+    history = History()
+    history.add_message(Message(first_role, "Answer questions about the flights table. " * 50, tags={Tag.BRIEFING}))
+    print(f"{first_role.value}\n{'step':>4} {'tokens':>6} {'uncached ms':>11} {'cached ms':>9}")
+    step = 0
+    n_tokens = 0
+    while n_tokens < 8_192:
+        step += 1
+        add_step(history, step)
+        messages = history.get_messages()
+
+        t0 = time.perf_counter()
+        n_tokens = len(vllm_client.tokenizer.apply_chat_template(
+            vllm_client.format_messages(messages), tokenize=True, return_dict=False
+        ))
+        t_uncached = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        n_tokens_cached = vllm_client.count_tokens(messages, cache=history.token_counts)
+        t_cached = time.perf_counter() - t0
+
+        assert n_tokens == n_tokens_cached, (n_tokens, n_tokens_cached)
+        print(f"{step:4d} {n_tokens:6d} {t_uncached * 1000:11.2f} {t_cached * 1000:9.2f}")
+
+# %%
@@ -0,0 +1,109 @@
+# %%
+# Benchmarks of the generation with an in-process model (LLMClient) on CPU with a tiny random Llama
+import time
+import torch
+from transformers import AutoTokenizer, StoppingCriteria
+
+from core.llm import MODEL_FULL_NAME, MyStoppingCriteria
+from training.tiny_model import get_tiny_llama
+
+tokenizer = AutoTokenizer.from_pretrained(MODEL_FULL_NAME["llama3-8b"])
+torch.manual_seed(0)
+model = get_tiny_llama()
+model.generation_config.pad_token_id = tokenizer.eos_token_id
+model.generation_config.eos_token_id = None  # Generate max_new_tokens tokens
+
+# %%
+# The cost of the stop sequence check as the output grows.
+# The previous check decoded the whole output at every step, so its cost grew quadratically.
+class FullDecodeStoppingCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, prompt_len: int, stop_sequence: str):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.stop_sequence = stop_sequence
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.stop_sequence in self.tokenizer.decode(input_ids[0][self.prompt_len:])
+
+class TimedCriteria(StoppingCriteria):
+    def __init__(self, criteria: StoppingCriteria):
+        self.criteria = criteria
+        self.time = 0.
+
+    def __call__(self, input_ids, scores, **kwargs):
+        t0 = time.perf_counter()
+        stop = self.criteria(input_ids, scores)
+        self.time += time.perf_counter() - t0
+        return stop
+
+inputs = tokenizer(["Answer questions about the flights table."], return_tensors="pt")
+prompt_len = inputs.input_ids.size(1)
+print(f"{'tokens':>6} {'full decode ms':>14} {'incremental ms':>14}")
+for n_tokens in [250, 500, 1000, 2000]:
+    times = []
+    for criteria_cls in [FullDecodeStoppingCriteria, MyStoppingCriteria]:
+        criteria = TimedCriteria(criteria_cls(tokenizer, prompt_len, "</run_ipython>"))
+        model.generate(**inputs, max_new_tokens=n_tokens, min_new_tokens=n_tokens, do_sample=False, stopping_criteria=[criteria])
+        times.append(criteria.time)
+    print(f"{n_tokens:6d} {times[0] * 1000:14.1f} {times[1] * 1000:14.1f}")
+
+# %%
+# Every row of a batch stops at its own stop sequence
+texts = ["<run_ipython>\nx = 1\n</run_ipython> and more", "no stop sequence here", "</run_ipython>"]
+rows = [tokenizer.encode(text, add_special_tokens=False) for text in texts]
+length = max(len(row) for row in rows)
+batch = torch.tensor([row + [tokenizer.eos_token_id] * (length - len(row)) for row in rows])
+criteria = MyStoppingCriteria(tokenizer, 0, "</run_ipython>")
+first_stop = [None] * len(texts)
+for i in range(1, length + 1):
+    for row, stopped in enumerate(criteria(batch[:, :i], None).tolist()):
+        if stopped and first_stop[row] is None:
+            first_stop[row] = i
+for text, row, stop in zip(texts, rows, first_stop):
+    print(f"{text!r}: stopped after {stop} of {len(row)} tokens")
+
+# %%
+# Dynamic batching: the throughput of 16 concurrent calls as the batch size grows
+import asyncio
+from core.batching import GenerationQueue
+from core.llm import KV_CACHE_MAX_BYTES, LLM
+
+llm = LLM("llama3-8b-instruct", kv_cache_max_bytes=KV_CACHE_MAX_BYTES)
+llm.model = model  # The tiny model instead of load_model
+prompts = [f"Question {i}: " + "how many flights are there " * (i % 4 + 1) for i in range(16)]
+
+async def run_concurrent(max_batch_size: int):
+    queue = GenerationQueue(llm, tokenizer, max_batch_size=max_batch_size)
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[queue.generate(prompt, max_new_tokens=128) for prompt in prompts])
+    t = time.perf_counter() - t0
+    await queue.close()
+    n_tokens = sum(result.n_tokens for result in results)
+    print(f"batch size {max_batch_size:2d}: {queue.n_batches:2d} batches, {t:.2f} sec, {n_tokens / t:.0f} tokens/sec")
+
+for max_batch_size in [1, 2, 4, 8, 16]:
+    await run_concurrent(max_batch_size)
+
+# %%
+# KV cache reuse between the steps of an agent: the prompt of a step starts with the previous prompt and response,
+# so only the new suffix is fed to the model. The outputs are the same with and without the cache.
+from core.messages import Message, Role
+
+def run_steps(kv_cache_max_bytes: int, n_steps: int = 8) -> list[str]:
+    llm = LLM("llama3-8b-instruct", kv_cache_max_bytes=kv_cache_max_bytes)
+    llm.model = model
+    messages = [Message(Role.SYSTEM, "Answer questions about the flights table. " * 50)]
+    responses = []
+    t0 = time.perf_counter()
+    for step in range(n_steps):
+        messages.append(Message(Role.USER, f"Observation of step {step}: " + "42 rows. " * 30))
+        input_ids = tokenizer(llm.messages_to_prompt(messages), return_tensors="pt").input_ids
+        output_tokens = llm.generate(input_ids, max_new_tokens=30, do_sample=False, session_id="agent")
+        responses.append(tokenizer.decode(output_tokens[0], skip_special_tokens=True))
+        messages.append(Message(Role.AI, responses[-1]))
+    print(f"{time.perf_counter() - t0:.2f} sec, {llm.kv_cache}")
+    return responses
+
+assert run_steps(0) == run_steps(1 << 30)
+
+# %%
@@ -7,6 +7,7 @@ stats = Stats()
 stats.start_time = datetime.now()
 stats.call_times = [1, 2, 3]
 stats.retry_count = 6
+stats.retry_wait_time = 9.3
 stats.usage = Usage()
 stats.usage.input_tokens = 7
 stats.usage.output_tokens = 8
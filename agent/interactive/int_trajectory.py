@@ -22,3 +22,21 @@ print(traj.get_responses())
 print(traj.get_feedbacks())
 
 # %%
+# Append-only saving: one line per half-step, compacted to JSON at the end of the run
+import tempfile
+from pathlib import Path
+
+run_path = Path(tempfile.mkdtemp())
+traj.next_step(status={"step": 1})
+traj.set_response("<inner_monologue>\nLet's compute.\n</inner_monologue>")
+print(traj.append("trajectory", run_path))
+traj.next_step()
+traj.set_response("<run_ipython>\nprint(2 + 3)\n</run_ipython>")
+jsonl_path = traj.append("trajectory", run_path)
+print(jsonl_path.read_text())
+
+print(Trajectory.from_json(jsonl_path.read_text()).half_steps == traj.half_steps)
+json_path = traj.compact("trajectory", run_path)
+print(Trajectory.from_json(json_path.read_text()).half_steps == traj.half_steps, jsonl_path.exists())
+
+# %%
@@ -44,3 +44,118 @@ def test_pickle():
     print(id(new_ws))
 
 # %%
+def test_process_workspace():
+    # %%
+    import time
+    from agent.workspace import Workspace
+    from agent.workspace_pool import configure_workspace_pool
+
+    pool = configure_workspace_pool(size=2)
+    time.sleep(10)  # Let the workers start
+
+    # %%
+    t0 = time.perf_counter()
+    Workspace()
+    print(f"Workspace: {time.perf_counter() - t0:.3f}s")
+
+    t0 = time.perf_counter()
+    ws = pool.acquire()
+    print(f"Warm ProcessWorkspace: {time.perf_counter() - t0:.3f}s")
+
+    # %%
+    ws.add_variables({"a": 123, "math": __import__("math")})
+    print(ws.run_ipython("b = math.sqrt(a)\nb"))
+    print(ws.get_variable("b"))
+
+    t0 = time.perf_counter()
+    for _ in range(100):
+        ws.run_ipython("a += 1")
+    print(f"Cell round trip: {(time.perf_counter() - t0) * 10:.2f}ms")
+
+    # %%
+    # copy forks the worker, the namespace is shared copy-on-write
+    ws.run_ipython("import numpy as np\nbig = np.ones((2000, 5000))\nnumbers = iter(range(10))")
+    t0 = time.perf_counter()
+    ws_copy = ws.copy()
+    print(f"Copy: {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+    ws_copy.run_ipython("big[0, 0] = 5")
+    print(ws_copy.eval_expr("(a, b, big[0, 0], next(numbers))"))
+    print(ws.eval_expr("(a, b, big[0, 0], next(numbers))"))
+    ws.close()
+    ws_copy.close()
+
+# %%
+def test_checkpoint_delta():
+    # %%
+    from agent.workspace import Workspace
+
+    ws = Workspace()
+    dataset = list(range(1_000_000))
+    ws.add_variables({"dataset": dataset}, shared=True)  # Stored as a reference
+
+    ws.run_ipython("import math\nsubset = dataset[:10]\nn = 1")
+    changed, removed, digests = ws.checkpoint_delta({})
+    print({name: data if not isinstance(data, bytes) else f"{len(data)} bytes" for name, data in changed.items()})
+
+    # %%
+    ws.run_ipython("n += 1\ndel subset")
+    changed, removed, digests = ws.checkpoint_delta(digests)
+    print(changed, removed)
+
+# %%
+def test_checkpoint_delta_dirty_variables():
+    # %%
+    # Only the variables used by the cells since the previous checkpoint are pickled again
+    import time
+    from agent.workspace import Workspace
+
+    ws = Workspace()
+    # and the variables which share an object with them
+    ws.run_ipython(
+        "import numpy as np\nflights = np.zeros(10_000_000)\nfirst_flights = flights[:5]\ncounts = []\n"
+        "def count():\n    counts.append(1)\nrows = [1]\ntable = {'rows': rows}"
+    )
+    changed, removed, digests = ws.checkpoint_delta({})
+    for code in ["count()", "n = len(counts)", "rows.append(2)", "flights[0] = 1"]:
+        ws.run_ipython(code)
+        t0 = time.perf_counter()
+        changed, removed, digests = ws.checkpoint_delta(digests)
+        print(f"{code}: {sorted(changed)} {(time.perf_counter() - t0) * 1000:.1f}ms")
+    # count(): ['counts'] 3ms, n = len(counts): ['n'] 0.1ms, rows.append(2): ['rows', 'table'] 0.1ms,
+    # flights[0] = 1: ['first_flights', 'flights'] 190ms (pickling flights)
+
+# %%
+async def test_branch():
+    # %%
+    # A branch continues from the workspace of the snapshot, with its own copy of the variables and its own tools
+    from pathlib import Path
+    import tempfile
+    from agent.agent import Agent
+    from agent.clients import MockClient
+    from agent.configs import AgentConfig
+    from agent.workspace_pool import configure_workspace_pool, pooled_workspace
+
+    configure_workspace_pool(size=1)
+    for workspace_factory in (None, pooled_workspace):
+        config = AgentConfig(log_stats=False, verbose=False, snapshot_workspace=True)
+        config.engine_config.workspace_factory = workspace_factory
+        agent = Agent(task="Return 10 times 5.", run_path=Path(tempfile.mkdtemp()) / "run", config=config)
+        responses = [
+            "I will store 5 first.",
+            "<run_ipython>\nx = 5\nitems = [x]\n</run_ipython>",
+            "Let's return 10 times x.",
+            "<run_ipython>\nitems.append(10)\ntools.complete_task('Done.', x * 10)\n</run_ipython>",
+        ]
+        await agent.run(client=MockClient(responses), max_llm_calls=10)
+
+        branch = agent.branch(1)
+        branch.setup_logging(Path(tempfile.mkdtemp()) / "branch")
+        responses = [
+            "Let's return x plus the number of items.",
+            "<run_ipython>\ntools.complete_task('Done.', x + len(items))\n</run_ipython>",
+        ]
+        await branch.run(client=MockClient(responses), max_llm_calls=10)
+        print(workspace_factory, agent.return_value, branch.return_value)  # 50 6: items is [5] in the branch
+
+# %%
@@ -198,3 +198,99 @@ await agent.run(
 )
 
 # %%
+# Test the fused monologue + tool call responses
+run_name = "test_run"
+run_path = AGENT_RUN_PATH / run_name
+
+config = AgentConfig(log_stats=False, fused_response=True)
+
+agent = Agent(
+  task="Add 2 and 3 and report the result.",
+  run_path=run_path,
+  config=config,
+)
+
+responses = [
+"""<inner_monologue>
+I will add 2 and 3.
+</inner_monologue>
+<run_ipython>
+result = 2 + 3
+result
+</run_ipython>""",
+###
+"""<inner_monologue>
+Let's return the result.
+</inner_monologue>
+<run_ipython>
+tools.complete_task("The result of adding 2 and 3 is 5.", result)
+</run_ipython>""",
+]
+client = MockClient(responses)
+
+await agent.run(
+  client=client,
+  max_llm_calls=10
+)
+print(agent.trajectory.get_responses())
+
+# %%
+# Compare the prefix reuse of the standard and the prefix-stable rendering of the history
+for stable_prefix in (False, True):
+    config = AgentConfig(log_stats=False, verbose=False, stable_prefix=stable_prefix, log_prefix_reuse=True)
+    agent = Agent(
+      task="Add 2 and 3 and report the result.",
+      run_path=run_path,
+      config=config,
+    )
+    responses = [
+        "I will add 2 and 3.",
+        "<run_ipython>\nresult = 2 + 3\nresult\n</run_ipython>",
+        "Let's check the result.",
+        "<run_ipython>\nprint(result == 5)\n</run_ipython>",
+        "Let's return the result.",
+        "<run_ipython>\ntools.complete_task('The result of adding 2 and 3 is 5.', result)\n</run_ipython>",
+    ]
+    await agent.run(client=MockClient(responses), max_llm_calls=10)
+    print(f"{stable_prefix=}: prefix reuse per call {agent.stats.to_dict()['prefix_reuse']}")
+
+# %%
+# Replay a run from the response cache: the second run does not call the (empty) mock client
+from agent.clients import CachedClient  # noqa
+from agent.response_cache import ResponseCache  # noqa
+
+cache = ResponseCache(AGENT_RUN_PATH / "response_cache.sqlite")
+cache.clear()
+responses = [
+    "I will add 2 and 3.",
+    "<run_ipython>\nresult = 2 + 3\ntools.complete_task('The result of adding 2 and 3 is 5.', result)\n</run_ipython>",
+]
+for mock_responses in (responses, []):
+    agent = Agent(
+      task="Add 2 and 3 and report the result.",
+      run_path=run_path,
+      config=AgentConfig(log_stats=False, verbose=False),
+    )
+    await agent.run(client=CachedClient(MockClient(mock_responses), cache), max_llm_calls=10)
+    print(f"return value: {agent.return_value}, cache hits: {agent.stats.cache_hits}, {cache}")
+
+# %%
+# Concurrent trials of a task share the responses to their identical prompts:
+# the mock client has the responses for a single trial
+import asyncio  # noqa
+from agent.clients import CoalescingClient  # noqa
+
+client = CoalescingClient(MockClient(responses))
+agents = [
+    Agent(
+      task="Add 2 and 3 and report the result.",
+      run_path=AGENT_RUN_PATH / f"test_coalescing_{i}",
+      config=AgentConfig(log_stats=False, verbose=False),
+    )
+    for i in range(3)
+]
+await asyncio.gather(*[agent.run(client=client, max_llm_calls=10) for agent in agents])
+for agent in agents:
+    print(f"return value: {agent.return_value}, calls: {agent.stats.n_calls}, coalesced: {agent.stats.coalesced_calls}")
+
+# %%
@@ -0,0 +1,153 @@
+"""Progress of concurrent agent runs, see tasks.batch_eval.Manager.
+
+The agents publish events (a step has started, the run has finished with a status) to a ProgressBus
+in memory, so the progress is not polled from the run directories. The monitor consumes the new events
+at every refresh and redraws the progress with a renderer only if something has changed:
+    * TerminalRenderer clears the terminal and prints a line per run,
+    * HTMLRenderer displays the same in IPython with links to the logs,
+    * JSONLinesRenderer appends the events to a file (or a stream), e.g. for another process to follow,
+    * QueueRenderer forwards the events to a multiprocessing queue, see tasks.batch_eval.ShardedManager.
+"""
+from collections import deque
+from dataclasses import asdict, dataclass, field
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import TextIO
+
+from IPython.display import clear_output, HTML, display
+
+from core.concurrent import is_ipython
+
+
+@dataclass
+class ProgressEvent:
+    run_name: str
+    kind: str  # "step" or "status"
+    step: int | None = None
+    status: str | None = None
+    time: float = field(default_factory=time.time)
+
+
+@dataclass
+class RunProgress:
+    run_name: str
+    log_path: Path | None = None
+    n_steps: int = 0
+    status: str | None = None  # The status of the finished run, see tasks.batch_eval.execute_task
+
+    def apply(self, event: ProgressEvent):
+        if event.kind == "step":
+            self.n_steps = event.step
+        elif event.kind == "status":
+            self.status = event.status
+
+
+class ProgressPublisher:
+    "Publishes the events of a single run, see Agent.prepare_step."
+    def __init__(self, bus: "ProgressBus", run_name: str):
+        self.bus = bus
+        self.run_name = run_name
+
+    def step(self, step: int):
+        self.bus.publish(ProgressEvent(self.run_name, "step", step=step))
+
+    def status(self, status: str):
+        self.bus.publish(ProgressEvent(self.run_name, "status", status=status))
+
+
+class ProgressBus:
+    def __init__(self):
+        self._events: deque[ProgressEvent] = deque()  # Appending is thread safe
+        self.runs: dict[str, RunProgress] = {}
+
+    def add_run(self, run_name: str, log_path: Path = None) -> ProgressPublisher:
+        self.runs[run_name] = RunProgress(run_name, log_path)
+        return self.publisher(run_name)
+
+    def publisher(self, run_name: str) -> ProgressPublisher:
+        return ProgressPublisher(self, run_name)
+
+    def publish(self, event: ProgressEvent):
+        self._events.append(event)
+
+    def consume(self) -> list[ProgressEvent]:
+        "Apply the events published since the previous call to the progress of the runs and return them."
+        events = []
+        while self._events:
+            event = self._events.popleft()
+            if event.run_name in self.runs:
+                self.runs[event.run_name].apply(event)
+            events.append(event)
+        return events
+
+
+class ProgressRenderer:
+    def render(self, runs: list[RunProgress], events: list[ProgressEvent], n_finished: int, n_jobs: int):
+        raise NotImplementedError
+
+
+def format_progress(run: RunProgress) -> str:
+    progress = "." * run.n_steps
+    if run.status is not None:
+        progress += f" {run.status.splitlines()[0] if run.status else ''}"
+    return progress
+
+
+class TerminalRenderer(ProgressRenderer):
+    def __init__(self, clear: bool = True):
+        self.clear = clear  # If False, the progress is printed below the previous one
+
+    def render(self, runs: list[RunProgress], events: list[ProgressEvent], n_finished: int, n_jobs: int):
+        if self.clear:
+            os.system('cls' if os.name == 'nt' else 'clear')
+        content = "".join(f"{run.run_name}: {format_progress(run)}\n" for run in runs)
+        content += f"Finished: {n_finished}/{n_jobs}"
+        print(content)
+
+
+class HTMLRenderer(ProgressRenderer):
+    def __init__(self, clear: bool = True):
+        self.clear = clear
+
+    def render(self, runs: list[RunProgress], events: list[ProgressEvent], n_finished: int, n_jobs: int):
+        if self.clear:
+            clear_output(wait=True)
+        content = ""
+        for run in runs:
+            content += f'{run.run_name}: <a href="file://{run.log_path}" target="_blank">log</a> {format_progress(run)}<br>'
+        content += f"Finished: {n_finished}/{n_jobs}"
+        html_content = '''<div style="font-family: Menlo, Monaco, 'Courier New', monospace; font-size: inherit;">{content}</div>'''
+        display(HTML(html_content.format(content=content)))
+
+
+class JSONLinesRenderer(ProgressRenderer):
+    "Appends every event as a JSON line to the file at path, or to the stream (stdout by default)."
+    def __init__(self, path: os.PathLike = None, stream: TextIO = None):
+        self.path = Path(path) if path is not None else None
+        self.stream = stream or sys.stdout
+
+    def render(self, runs: list[RunProgress], events: list[ProgressEvent], n_finished: int, n_jobs: int):
+        lines = "".join(json.dumps(asdict(event)) + "\n" for event in events)
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(lines)
+        else:
+            self.stream.write(lines)
+            self.stream.flush()
+
+
+class QueueRenderer(ProgressRenderer):
+    "Forwards the events to a multiprocessing queue, e.g. from a worker process to the monitor of the main process."
+    def __init__(self, queue):
+        self.queue = queue
+
+    def render(self, runs: list[RunProgress], events: list[ProgressEvent], n_finished: int, n_jobs: int):
+        for event in events:
+            self.queue.put(event)
+
+
+def default_renderer(clear: bool = True) -> ProgressRenderer:
+    return HTMLRenderer(clear) if is_ipython() else TerminalRenderer(clear)
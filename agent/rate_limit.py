@@ -0,0 +1,179 @@
+"""Rate limiting and adaptive concurrency of the LLM calls per endpoint.
+
+Every attempt of an LLM call to an endpoint (base_url) takes a slot of the endpoint's limiter, which is
+shared by all clients calling the endpoint:
+    * requests per minute and tokens per minute are limited with token buckets if the budgets are set
+      with configure_rate_limit, e.g. to the limits of a DeepSeek or DeepInfra account,
+    * the number of calls in flight is adjusted AIMD-style (additive increase, multiplicative decrease):
+      a rate limit error (429), a timeout or a call slower than max_latency halves the limit (once for
+      the calls started before the previous decrease) and every successful call raises it by 1 / limit,
+      i.e. by one per round of calls.
+Until the first error, the number of calls in flight is limited only by max_concurrency.
+A waiting call sleeps until a call in flight finishes or until the buckets have refilled enough for it.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import math
+import time
+
+
+class EndpointLimiter:
+    def __init__(
+        self,
+        requests_per_minute: float = None,  # None means no limit
+        tokens_per_minute: float = None,  # None means no limit
+        max_concurrency: int = None,  # Upper bound on the calls in flight, None means no bound
+        min_concurrency: int = 1,
+        max_latency: float = None,  # Calls slower than this (seconds) are a sign of overload, None disables it
+        decrease_factor: float = 0.5,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_latency = max_latency
+        self.decrease_factor = decrease_factor
+
+        self.concurrency: float | None = max_concurrency  # Current limit of the calls in flight
+        self.in_flight = 0
+        self.n_decreases = 0
+        self._requests = requests_per_minute  # Available requests in the bucket
+        self._tokens = tokens_per_minute  # Available tokens in the bucket
+        self._refill_time = time.monotonic()
+        self._decrease_time = 0.  # Time of the last decrease of the concurrency
+        self._changed: asyncio.Event | None = None  # Set when a slot or tokens are returned, see _wait_for_change
+        self._changed_loop = None
+
+    def __repr__(self):
+        concurrency = f"{self.concurrency:.1f}" if self.concurrency is not None else None
+        return (
+            f"EndpointLimiter(rpm={self.requests_per_minute}, tpm={self.tokens_per_minute}, "
+            f"concurrency={concurrency}, in_flight={self.in_flight})"
+        )
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._refill_time) / 60
+        self._refill_time = now
+        if self.requests_per_minute is not None:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed_minutes * self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed_minutes * self.tokens_per_minute)
+
+    def _wait_time(self, n_tokens: int) -> float:
+        "Seconds until the call can start, 0 if it can start now."
+        if self.concurrency is not None and self.in_flight >= max(int(self.concurrency), self.min_concurrency):
+            return math.inf  # Wait for a call to finish
+        self._refill()
+        wait = 0.
+        if self.requests_per_minute is not None and self._requests < 1:
+            wait = max(wait, (1 - self._requests) / self.requests_per_minute * 60)
+        if self.tokens_per_minute is not None:
+            # A call larger than the whole budget waits for the full bucket
+            n_tokens = min(n_tokens, self.tokens_per_minute)
+            if self._tokens < n_tokens:
+                wait = max(wait, (n_tokens - self._tokens) / self.tokens_per_minute * 60)
+        return wait
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+
+    async def _wait_for_change(self, timeout: float):
+        "Wait until a slot or tokens are returned, or at most timeout seconds (inf for no timeout)."
+        loop = asyncio.get_running_loop()
+        if self._changed_loop is not loop:  # The limiters are shared by the event loops run one after another
+            self._changed, self._changed_loop = asyncio.Event(), loop
+        # The waiters woken by set are not affected by clear
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), None if math.isinf(timeout) else timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def acquire(self, n_tokens: int = 0):
+        while (wait := self._wait_time(n_tokens)) > 0:
+            await self._wait_for_change(wait)
+        self.in_flight += 1
+        if self.requests_per_minute is not None:
+            self._requests -= 1
+        if self.tokens_per_minute is not None:
+            self._tokens -= n_tokens
+
+    def release(self):
+        self.in_flight -= 1
+        self._notify()
+
+    def adjust_tokens(self, n_tokens: int):
+        "Correct the estimate of the tokens of a call by n_tokens after the call."
+        if self.tokens_per_minute is not None:
+            self._tokens -= n_tokens
+            if n_tokens < 0:
+                self._notify()
+
+    def on_success(self, start_time: float):
+        if self.max_latency is not None and time.monotonic() - start_time > self.max_latency:
+            self.on_overload(start_time)
+        elif self.concurrency is not None:
+            self.concurrency += 1 / self.concurrency
+            if self.max_concurrency is not None:
+                self.concurrency = min(self.concurrency, self.max_concurrency)
+
+    def on_overload(self, start_time: float = None):
+        "Decrease the concurrency after a rate limit error, a timeout or a slow call which started at start_time."
+        if start_time is not None and start_time < self._decrease_time:
+            return  # The call started before the last decrease, so it is not a sign that the decrease was not enough
+        self._decrease_time = time.monotonic()
+        self.n_decreases += 1
+        current = self.concurrency if self.concurrency is not None else self.in_flight
+        self.concurrency = max(self.min_concurrency, current * self.decrease_factor)
+
+    @asynccontextmanager
+    async def slot(self, n_tokens: int = 0):
+        "Hold a slot for a single attempt of a call with about n_tokens tokens (input and output)."
+        await self.acquire(n_tokens)
+        start_time = time.monotonic()
+        try:
+            yield self
+        except Exception as e:
+            if is_overload_error(e):
+                self.on_overload(start_time)
+            raise
+        else:
+            self.on_success(start_time)
+        finally:
+            self.release()
+
+
+def is_overload_error(e: Exception) -> bool:
+    "Whether the error means that the endpoint is overloaded: a rate limit error or a timeout."
+    status_code = getattr(e, "status_code", None)
+    return status_code == 429 or isinstance(e, TimeoutError) or "Timeout" in type(e).__name__
+
+
+def estimate_tokens(messages_or_prompt: list[dict] | str) -> int:
+    "Rough number of tokens in the messages or the prompt, for the tokens per minute budget."
+    text = messages_or_prompt if isinstance(messages_or_prompt, str) else json.dumps(messages_or_prompt)
+    return len(text) // 4
+
+
+_limiters: dict[str, EndpointLimiter] = {}
+
+
+def _normalize_url(base_url) -> str:
+    return str(base_url).rstrip("/")
+
+
+def configure_rate_limit(base_url: str, **kwargs) -> EndpointLimiter:
+    "Set the limits of an endpoint (see EndpointLimiter), e.g. requests_per_minute and tokens_per_minute."
+    limiter = _limiters[_normalize_url(base_url)] = EndpointLimiter(**kwargs)
+    return limiter
+
+
+def get_limiter(base_url) -> EndpointLimiter:
+    "The limiter shared by all clients calling base_url."
+    base_url = _normalize_url(base_url)
+    if base_url not in _limiters:
+        _limiters[base_url] = EndpointLimiter()
+    return _limiters[base_url]
@@ -0,0 +1,128 @@
+"""Disk-backed cache of LLM responses, see agent.clients.CachedClient.
+
+The responses are stored in a SQLite database under a key computed from everything that determines
+the response: the formatted messages, the model, the response format and the sampling parameters.
+The usage of the original call is stored with the response, so replayed calls are counted in Stats
+as if they were made. When the database grows over max_size_bytes, the least recently used responses
+are removed. The size is tracked with a running total, which is recomputed from the database when it
+exceeds max_size_bytes and every SYNC_SIZE_EVERY puts (other processes may write to the same file).
+"""
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from core.usage import Usage
+
+
+@dataclass
+class CachedResponse:
+    content: str
+    usage: Usage | None  # None if the client does not report the usage
+    call_time: float  # Duration of the original call
+    cost_model: str | None  # Model for computing the cost of the call, None if the client does not report it
+
+
+def cache_key(**params) -> str:
+    "Content-addressed key of an LLM call, the parameters must be JSON serializable (others are converted to str)."
+    data = json.dumps(params, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResponseCache:
+    SYNC_SIZE_EVERY = 1000  # Puts between two recomputations of the size of the database
+
+    def __init__(self, path: os.PathLike, max_size_bytes: int = 1 << 30):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        # The database can be used from several threads and processes, SQLite locks the file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT, input_tokens INTEGER, output_tokens INTEGER, "
+                "call_time REAL, cost_model TEXT, size INTEGER, last_access REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self._size = self._total_size()
+        self._puts = 0
+
+    def __repr__(self):
+        return f"ResponseCache({str(self.path)!r}, hits={self.hits}, misses={self.misses})"
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._total_size()
+
+    def _total_size(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> CachedResponse | None:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT content, input_tokens, output_tokens, call_time, cost_model FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        content, input_tokens, output_tokens, call_time, cost_model = row
+        usage = Usage(input_tokens, output_tokens) if input_tokens is not None else None
+        return CachedResponse(content, usage, call_time, cost_model)
+
+    def put(self, key: str, response: CachedResponse):
+        size = len(key) + len(response.content.encode())
+        usage = response.usage
+        input_tokens, output_tokens = (usage.input_tokens, usage.output_tokens) if usage else (None, None)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, response.content, input_tokens, output_tokens,
+                    response.call_time, response.cost_model, size, time.time(),
+                ),
+            )
+            # The running total overestimates the size when a response is replaced, _evict recomputes it
+            self._size += size
+            self._puts += 1
+            if self._size > self.max_size_bytes or self._puts % self.SYNC_SIZE_EVERY == 0:
+                self._evict()
+
+    def _evict(self):
+        "Remove the least recently used responses until the cache fits in max_size_bytes."
+        total = self._size = self._total_size()
+        if total <= self.max_size_bytes:
+            return
+        keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if total <= self.max_size_bytes:
+                break
+            keys.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self._size = total
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -15,8 +15,18 @@ class Stats:
     call_times: List[float] = field(default_factory=list)
     tool_calls: DefaultDict[str, int] = field(default_factory=lambda: defaultdict(int))
     retry_count: int = 0
+    retry_wait_time: float = 0.  # Seconds waited before the retries, see AsyncRetryCaller.wait_time
     usages: List[Usage] = field(default_factory=list)
     costs: List[float] = field(default_factory=list)
+    # Input tokens that the LLM server can take from its prefix cache and all input tokens, per call
+    prefix_reuse: List[tuple[int, int]] = field(default_factory=list)
+    cache_hits: int = 0  # Calls answered from the response cache, see agent.clients.CachedClient
+    coalesced_calls: int = 0  # Calls which shared the response of an identical call, see agent.clients.CoalescingClient
+    early_stops: int = 0  # Streamed responses which were closed at the stop sequence, see OpenAIClient.stream_response
+    # Output tokens after the stop sequence in the responses which were not closed early, see saved_output_tokens
+    stop_tails: List[int] = field(default_factory=list)
+    hedged_calls: int = 0  # Calls which were duplicated because they were slow, see agent.clients.HedgingClient
+    hedge_wins: int = 0  # Hedged calls where the duplicate returned first
     parent_stats: "Stats" = None
 
     @classmethod
@@ -26,6 +36,28 @@ class Stats:
         else:
             return cls()
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        "Restore the stats saved with to_dict, e.g. in a run report. The per-call costs and prefix reuse are not saved."
+        stats = cls(
+            start_time=datetime.fromisoformat(data["start_time"]),
+            duration=timedelta(seconds=data["duration"]) if data.get("duration") is not None else None,
+            call_times=list(data.get("call_times", [])),
+            retry_count=data.get("retry_count", 0),
+            retry_wait_time=data.get("retry_wait_time", 0.),
+            usages=[Usage(input_tokens, output_tokens) for input_tokens, output_tokens in data.get("usages", [])],
+            costs=[data["total_cost"]] if data.get("total_cost") is not None else [],
+            cache_hits=data.get("cache_hits", 0),
+            coalesced_calls=data.get("coalesced_calls", 0),
+            early_stops=data.get("early_stops", 0),
+            # The mean tail of the saved estimate, like the total cost
+            stop_tails=[data["saved_output_tokens"] / data["early_stops"]] if data.get("saved_output_tokens") else [],
+            hedged_calls=data.get("hedged_calls", 0),
+            hedge_wins=data.get("hedge_wins", 0),
+        )
+        stats.tool_calls.update(data.get("tool_calls", {}))
+        return stats
+
     def get_root_stats(self):
         return self.parent_stats.get_root_stats() if self.parent_stats else self
 
@@ -40,7 +72,7 @@ class Stats:
             mean_time = np.mean(self.call_times)
             max_time = max(self.call_times)
         else:
-            min_time = mean_time = max_time = np.NaN
+            min_time = mean_time = max_time = np.nan
 
         d = self.to_dict()
         d["call times"] = f"{min_time:.1f} <-> {mean_time:.1f} <-> {max_time:.1f}"
@@ -65,6 +97,71 @@ class Stats:
         else:
             return sum(self.costs)
 
+    @property
+    def prefix_reuse_ratio(self) -> float | None:
+        n_tokens = sum(total for _, total in self.prefix_reuse)
+        return sum(reused for reused, _ in self.prefix_reuse) / n_tokens if n_tokens else None
+
+    @property
+    def saved_output_tokens(self) -> int | None:
+        """Estimate of the output tokens which were not generated because of the early stops: the mean tail
+        after the stop sequence of the responses which were read to the end. None if no tail was seen."""
+        if not self.early_stops:
+            return 0
+        return round(self.early_stops * np.mean(self.stop_tails)) if self.stop_tails else None
+
+    def add_prefix_reuse(self, n_reused_tokens: int, n_input_tokens: int):
+        self.prefix_reuse.append((n_reused_tokens, n_input_tokens))
+        if self.parent_stats:
+            self.parent_stats.add_prefix_reuse(n_reused_tokens, n_input_tokens)
+
+    def add_retries(self, retry_count: int, retry_wait_time: float = 0.):
+        "Count retries which are not a part of a call recorded with update."
+        self.retry_count += retry_count
+        self.retry_wait_time += retry_wait_time
+        if self.parent_stats:
+            self.parent_stats.add_retries(retry_count, retry_wait_time)
+
+    def add_counters(self, other: "Stats"):
+        """Add the counters of the stats of a call made by a wrapped client (see agent.clients.ClientWrapper),
+        except the calls themselves, which are recorded with update."""
+        self.retry_count += other.retry_count
+        self.retry_wait_time += other.retry_wait_time
+        self.cache_hits += other.cache_hits
+        self.coalesced_calls += other.coalesced_calls
+        self.early_stops += other.early_stops
+        self.stop_tails.extend(other.stop_tails)
+        self.hedged_calls += other.hedged_calls
+        self.hedge_wins += other.hedge_wins
+        if self.parent_stats:
+            self.parent_stats.add_counters(other)
+
+    def add_cache_hit(self):
+        self.cache_hits += 1
+        if self.parent_stats:
+            self.parent_stats.add_cache_hit()
+
+    def add_coalesced_call(self):
+        self.coalesced_calls += 1
+        if self.parent_stats:
+            self.parent_stats.add_coalesced_call()
+
+    def add_early_stop(self):
+        self.early_stops += 1
+        if self.parent_stats:
+            self.parent_stats.add_early_stop()
+
+    def add_stop_tail(self, n_tokens: int):
+        self.stop_tails.append(n_tokens)
+        if self.parent_stats:
+            self.parent_stats.add_stop_tail(n_tokens)
+
+    def add_hedge(self, won: bool):
+        self.hedged_calls += 1
+        self.hedge_wins += won
+        if self.parent_stats:
+            self.parent_stats.add_hedge(won)
+
     def set_duration(self):
         self.duration = datetime.now() - self.start_time
 
@@ -74,16 +171,18 @@ class Stats:
         call_time: float = 1.,
         retry_count: int = 0,
         model: str = None,
+        retry_wait_time: float = 0.,
     ):
         self.call_times.append(call_time)
         self.retry_count += retry_count
+        self.retry_wait_time += retry_wait_time
         if usage:
             self.usages.append(usage)
         if model is not None:
             cost = usage.to_cost(model)
             self.costs.append(cost)
         if self.parent_stats:
-            self.parent_stats.update(usage, call_time, retry_count)
+            self.parent_stats.update(usage, call_time, retry_count, retry_wait_time=retry_wait_time)
 
     def to_dict(self):
         return {
@@ -93,10 +192,19 @@ class Stats:
             "call_times": [round(time, 1) for time in self.call_times],
             "tool_calls": dict(self.tool_calls),
             "retry_count": self.retry_count,
+            "retry_wait_time": round(self.retry_wait_time, 1),
+            "cache_hits": self.cache_hits,
+            "coalesced_calls": self.coalesced_calls,
+            "early_stops": self.early_stops,
+            "saved_output_tokens": self.saved_output_tokens,
+            "hedged_calls": self.hedged_calls,
+            "hedge_wins": self.hedge_wins,
             "usages": [
                 (usage.input_tokens, usage.output_tokens)
                 for usage in self.usages
             ],
             "total_usage": self.usage.to_dict(),
             "total_cost": round(self.cost, 2) if self.cost is not None else None,
+            "prefix_reuse": [round(reused / total, 2) if total else None for reused, total in self.prefix_reuse],
+            "total_prefix_reuse": round(self.prefix_reuse_ratio, 2) if self.prefix_reuse_ratio is not None else None,
         }
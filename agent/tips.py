@@ -62,6 +62,15 @@ TOOL_CALL_INST = """\
 <run_ipython>
 # iPython cell goes here
 </run_ipython>"""
+MONOLOGUE_TOOL_CALL_PROMPT = "Please proceed with your inner monologue to prepare your next action and then act by running an iPython cell."
+MONOLOGUE_TOOL_CALL_INST = """\
+ Strictly follow the XML-like format below:
+<inner_monologue>
+Thoughts
+</inner_monologue>
+<run_ipython>
+# iPython cell goes here
+</run_ipython>"""
 
 
 class SectionedContent:
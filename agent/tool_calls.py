@@ -1,3 +1,4 @@
+from core.llm import ResponseFormat, START_SEQUENCES, STOP_SEQUENCES
 from .workspace import Workspace
 
 def parse_run_ipython(content: str) -> str:
@@ -12,6 +13,23 @@ def parse_run_ipython(content: str) -> str:
     return content.strip()
 
 
+def split_monologue_and_tool_call(content: str) -> tuple[str, str]:
+    """Split a response in the ResponseFormat.MONOLOGUE_IPYTHON format into the monologue and the tool call
+    so that they look like the responses in the MONOLOGUE and IPYTHON formats."""
+    monologue_end = STOP_SEQUENCES[ResponseFormat.MONOLOGUE]
+    tool_call_start = START_SEQUENCES[ResponseFormat.IPYTHON].strip()
+    if monologue_end in content:
+        monologue, tool_call = content.split(monologue_end, maxsplit=1)
+    elif tool_call_start in content:
+        # The monologue was not closed properly
+        monologue, tool_call = content.split(tool_call_start, maxsplit=1)
+        tool_call = tool_call_start + tool_call
+    else:
+        # No tool call: parse_run_ipython will report the error
+        return content, tool_call_start
+    return monologue.rstrip() + "\n" + monologue_end, tool_call.strip()
+
+
 def dump_tool_output(
     tool_output: dict | str,
     ws: Workspace,
@@ -19,6 +19,7 @@ class Trajectory:
     metadata: dict = None
     half_steps: list[dict] = field(default_factory=list)
     random_suffix: str = field(default_factory=lambda: random_id(4))
+    n_appended: int = field(default=0, repr=False, compare=False)  # Number of half-steps written by append
 
     def to_dict(self) -> dict:
         return {
@@ -59,6 +60,36 @@ class Trajectory:
             f.write(self.to_json())
         return path
 
+    def append(self, basename: str, run_path=None):
+        """Append the half-steps added since the previous call to a JSON lines file.
+        The first line holds the other fields of the trajectory. Use compact to write the final JSON file."""
+        if run_path is None:
+            return "Not saved."
+        if not os.path.exists(run_path):
+            os.makedirs(run_path)
+        path = run_path / f"{basename}-{self.random_suffix}.jsonl"
+        lines = []
+        if self.n_appended == 0 or not path.exists():
+            header = self.to_dict()
+            del header["half_steps"]
+            lines.append(json.dumps({"trajectory": header}, default=Trajectory.serializer))
+            self.n_appended = 0
+        for half_step in self.half_steps[self.n_appended:]:
+            lines.append(json.dumps({"half_step": half_step}, default=Trajectory.serializer))
+        with open(path, "a") as f:
+            f.writelines(line + "\n" for line in lines)
+        self.n_appended = len(self.half_steps)
+        return path
+
+    def compact(self, basename: str, run_path=None):
+        "Save the trajectory as a JSON file and remove the JSON lines file written by append."
+        path = self.save(basename, run_path)
+        if run_path is not None:
+            jsonl_path = run_path / f"{basename}-{self.random_suffix}.jsonl"
+            if jsonl_path.exists():
+                jsonl_path.unlink()
+        return path
+
     @classmethod
     def from_dict(cls, data: dict):
         # Backward compatibility
@@ -71,7 +102,30 @@ class Trajectory:
 
     @classmethod
     def from_json(cls, json_str: str):
-        data = json.loads(json_str)
+        "Load a trajectory written by save (JSON) or append (JSON lines)."
+        try:
+            data = json.loads(json_str)
+        except json.JSONDecodeError:
+            return cls.from_jsonl(json_str)
+        if "trajectory" in data:  # JSON lines with only the first line
+            return cls.from_jsonl(json_str)
+        return cls.from_dict(data)
+
+    @classmethod
+    def from_jsonl(cls, jsonl_str: str):
+        data = None
+        half_steps = []
+        for line in jsonl_str.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "trajectory" in record:
+                data = record["trajectory"]
+            else:
+                half_steps.append(record["half_step"])
+        if data is None:
+            raise ValueError("The first line of the trajectory is missing.")
+        data["half_steps"] = half_steps
         return cls.from_dict(data)
 
     def get_feedbacks(self):
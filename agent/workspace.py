@@ -1,12 +1,20 @@
 from abc import ABC, abstractmethod
+import asyncio
 import ast
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
+import ctypes
+from functools import cached_property
 import io
+from IPython.core.display_trap import DisplayTrap
 from IPython.core.interactiveshell import InteractiveShell
 from IPython.core.ultratb import FormattedTB
 import sys
+import threading
+from traitlets.config import Config
 from typing import Any, Optional
 
+from .checkpoints import SharedRef, cell_names, copy_namespace, load_values, namespace_delta
 from .tool_call_status import TCStatus
 from core.utils import check_for_input_function_in_string
 
@@ -23,9 +31,111 @@ def is_plain_variable_name(name: str) -> bool:
         return False
 
 
+class ThreadLocalOutput:
+    """Stream which writes to a buffer set for the current thread or to the wrapped stream otherwise.
+
+    contextlib.redirect_stdout replaces sys.stdout for all threads, so it cannot be used when
+    cells of several workspaces are executed concurrently (see run_ipython_async)."""
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def get_buffer(self) -> io.StringIO | None:
+        return getattr(self._local, "buffer", None)
+
+    def set_buffer(self, buffer: io.StringIO | None):
+        self._local.buffer = buffer
+
+    def write(self, s: str) -> int:
+        return (self.get_buffer() or self.stream).write(s)
+
+    def flush(self):
+        (self.get_buffer() or self.stream).flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+
+_redirect_lock = threading.Lock()
+
+@contextlib.contextmanager
+def redirect_output(stdout_buf: io.StringIO, stderr_buf: io.StringIO):
+    "Thread-safe version of contextlib.redirect_stdout and contextlib.redirect_stderr."
+    with _redirect_lock:
+        if not isinstance(sys.stdout, ThreadLocalOutput):
+            sys.stdout = ThreadLocalOutput(sys.stdout)
+        if not isinstance(sys.stderr, ThreadLocalOutput):
+            sys.stderr = ThreadLocalOutput(sys.stderr)
+        stdout, stderr = sys.stdout, sys.stderr
+
+    old_buffers = stdout.get_buffer(), stderr.get_buffer()
+    stdout.set_buffer(stdout_buf)
+    stderr.set_buffer(stderr_buf)
+    try:
+        yield
+    finally:
+        stdout.set_buffer(old_buffers[0])
+        stderr.set_buffer(old_buffers[1])
+
+
+class ThreadLocalDisplayTrap(DisplayTrap):
+    """DisplayTrap which sets the display hook only for the current thread.
+
+    The default DisplayTrap replaces sys.displayhook for all threads, so the cell outputs (Out[n])
+    of concurrently running shells would be sent to a wrong shell."""
+    _local = threading.local()
+    _lock = threading.Lock()
+    _default_hook = None
+
+    @staticmethod
+    def _dispatch(value):
+        hook = getattr(ThreadLocalDisplayTrap._local, "hook", None) or ThreadLocalDisplayTrap._default_hook
+        return hook(value)
+
+    def set(self):
+        with self._lock:
+            if sys.displayhook is not ThreadLocalDisplayTrap._dispatch:
+                ThreadLocalDisplayTrap._default_hook = sys.displayhook
+                sys.displayhook = ThreadLocalDisplayTrap._dispatch
+        self.old_hook = getattr(self._local, "hook", None)
+        self._local.hook = self.hook
+
+    def unset(self):
+        self._local.hook = self.old_hook
+
+
+_cell_executor: ThreadPoolExecutor | None = None
+_cell_executor_max_workers: int | None = None  # None means the default of ThreadPoolExecutor
+
+def configure_cell_executor(max_workers: int | None):
+    """Set the number of threads that execute IPython cells in run_ipython_async.
+    Use max_workers=0 to execute cells in the event loop thread."""
+    global _cell_executor, _cell_executor_max_workers
+    if _cell_executor is not None:
+        _cell_executor.shutdown(wait=False)
+        _cell_executor = None
+    _cell_executor_max_workers = max_workers
+
+
+def get_cell_executor() -> ThreadPoolExecutor | None:
+    global _cell_executor
+    if _cell_executor_max_workers == 0:
+        return None
+    if _cell_executor is None:
+        _cell_executor = ThreadPoolExecutor(_cell_executor_max_workers, thread_name_prefix="ipython-cell")
+    return _cell_executor
+
+
+def interrupt_thread(thread_id: int):
+    "Raise KeyboardInterrupt in the thread, like Ctrl-C does for the main thread."
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(KeyboardInterrupt))
+
+
 class WorkspaceBase(ABC):
     def __init__(self):
         self._cell_outputs: dict[str, str] = {}
+        # Ids of the input variables, which are stored as references in the checkpoints
+        self._shared_ids: dict[str, int] = {}
 
     def __repr__(self) -> str:
         return str(self)
@@ -42,9 +152,52 @@ class WorkspaceBase(ABC):
     def run_ipython(self, code: str) -> dict[str, Any]:
         pass
 
+    async def run_ipython_async(self, code: str) -> dict[str, Any]:
+        """Run run_ipython in the cell executor so that the event loop (and other agents) are not blocked.
+        If the calling task is cancelled, the running cell is interrupted with KeyboardInterrupt."""
+        executor = get_cell_executor()
+        if executor is None:
+            return self.run_ipython(code)
+
+        lock = threading.Lock()
+        running = {}
+
+        def run():
+            with lock:
+                running["thread_id"] = threading.get_ident()
+            try:
+                return self.run_ipython(code)
+            finally:
+                with lock:
+                    running.pop("thread_id")
+
+        future = asyncio.get_running_loop().run_in_executor(executor, run)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            with lock:
+                if "thread_id" in running:
+                    interrupt_thread(running["thread_id"])
+            raise
+
     @abstractmethod
-    def add_variables(self, variables: dict[str, Any]) -> None:
-        """Add variables to the workspace."""
+    def add_variables(self, variables: dict[str, Any], shared: bool = False) -> None:
+        """Add variables to the workspace.
+        Shared variables are large read-only objects, e.g. datasets, which are not saved in the checkpoints."""
+        pass
+
+    @abstractmethod
+    def checkpoint_delta(
+        self, digests: dict[str, str]
+    ) -> tuple[dict[str, bytes | SharedRef], list[str], dict[str, str]]:
+        "Return the variables that have changed since the checkpoint with the given digests, see checkpoints.namespace_delta."
+        pass
+
+    @abstractmethod
+    def load_checkpoint(
+        self, values: dict[str, bytes | SharedRef], input_variables: dict[str, Any], cell_counter: int = None
+    ) -> None:
+        "Restore the variables saved in the checkpoints."
         pass
 
     @abstractmethod
@@ -70,6 +223,11 @@ class CustomInteractiveShell(InteractiveShell):
         # Disable colored output
         self.InteractiveTB = FormattedTB(color_scheme='NoColor', mode='Plain')
 
+    def init_displayhook(self):
+        super().init_displayhook()
+        # Cells of different shells can be executed concurrently in threads
+        self.display_trap = ThreadLocalDisplayTrap(hook=self.displayhook)
+
     "The same as InteractiveShell except the errors are printed to stderr instead of stdout."
     def _showtraceback(self, etype, evalue, stb: str):
         """Actually show a traceback.
@@ -87,11 +245,36 @@ class CustomInteractiveShell(InteractiveShell):
 
 
 class Workspace(WorkspaceBase):
-    def __init__(self):
-        self._shell = CustomInteractiveShell()
-        self._variables = self._shell.user_ns
+    def __init__(self, user_ns: dict[str, Any] = None, execution_count: int = None):
+        # The namespace and the cell counter of a copy, whose shell is created when it is first used,
+        # so that keeping a snapshot after every step is cheap (see __copy__)
+        self._user_ns = user_ns
+        self._execution_count = execution_count
+        self._variables = self._shell.user_ns if user_ns is None else user_ns
+        # Variables that may have changed since the previous checkpoint (None means all) and the ids of
+        # the variables at that checkpoint, see checkpoint_delta
+        self._dirty_names: set[str] | None = None
+        self._checkpoint_ids: dict[str, int] = {}
+        self._checkpoint_reachable: dict[str, set[int]] = {}  # See checkpoints.namespace_delta
         super().__init__()
 
+    @cached_property
+    def _shell(self) -> CustomInteractiveShell:
+        config = Config()
+        if self._user_ns is not None:
+            # The shell of a copy may be created in a cell thread, where the history database cannot be used
+            config.HistoryManager.enabled = False
+        shell = CustomInteractiveShell(user_ns=self._user_ns, config=config)
+        if self._execution_count is not None:
+            shell.execution_count = self._execution_count
+        return shell
+
+    def _mark_dirty(self, names: set[str] | None):
+        if names is None:
+            self._dirty_names = None
+        elif self._dirty_names is not None:
+            self._dirty_names |= names
+
     def get_cell_counter(self):
         return self._shell.execution_count
 
@@ -113,6 +296,14 @@ class Workspace(WorkspaceBase):
     def get_variable_names(self) -> list[str]:
         return list(self._variables.keys())
 
+    def get_user_variables(self) -> dict[str, Any]:
+        "Return the variables except IPython's internal variables and the cell outputs _, __, _1, ..."
+        hidden_names = self._shell.user_ns_hidden
+        return {
+            name: value for name, value in self._variables.items()
+            if not name.startswith("_") and name not in hidden_names
+        }
+
     def get_variable(self, name: str) -> Any:
         return self._variables[name]
 
@@ -122,9 +313,14 @@ class Workspace(WorkspaceBase):
     def execute_expr(self, expr: str) -> tuple[str, str, Exception | None]: # python 3.10
     # def execute_expr(self, expr: str) -> Tuple[str, str, Optional[Exception]]: # python 3.9
         stdout, stderr, exception = None, None, None
+        try:
+            code = self._shell.transform_cell(expr)
+            self._mark_dirty(cell_names(code, self._variables, self._shell.user_module.__name__))
+        except Exception:  # noqa: BLE001
+            self._mark_dirty(None)
         with (
-            io.StringIO() as stdout_buf, contextlib.redirect_stdout(stdout_buf),
-            io.StringIO() as stderr_buf, contextlib.redirect_stderr(stderr_buf),
+            io.StringIO() as stdout_buf, io.StringIO() as stderr_buf,
+            redirect_output(stdout_buf, stderr_buf),
         ):
             try:
                 result = self._shell.run_cell(expr)
@@ -169,8 +365,42 @@ class Workspace(WorkspaceBase):
 
         return out
 
-    def add_variables(self, variables: dict[str, Any]) -> None:
+    def add_variables(self, variables: dict[str, Any], shared: bool = False) -> None:
+        self._variables.update(variables)
+        self._mark_dirty(set(variables))
+        for name, value in variables.items():
+            if shared:
+                self._shared_ids[name] = id(value)
+            else:
+                self._shared_ids.pop(name, None)
+
+    def checkpoint_delta(
+        self, digests: dict[str, str]
+    ) -> tuple[dict[str, bytes | SharedRef], list[str], dict[str, str]]:
+        variables = self.get_user_variables()
+        unchanged = None
+        if self._dirty_names is not None:
+            unchanged = {
+                name for name, value in variables.items()
+                if name not in self._dirty_names and self._checkpoint_ids.get(name) == id(value)
+            }
+        delta = namespace_delta(variables, self._shared_ids, digests, unchanged, self._checkpoint_reachable)
+        self._dirty_names = set()
+        self._checkpoint_ids = {name: id(value) for name, value in variables.items()}
+        return delta
+
+    def load_checkpoint(
+        self, values: dict[str, bytes | SharedRef], input_variables: dict[str, Any], cell_counter: int = None
+    ) -> None:
+        self.add_variables(input_variables, shared=True)
+        variables = load_values(values, self._variables, input_variables)
         self._variables.update(variables)
+        self._mark_dirty(None)
+        for name, value in variables.items():
+            if value is input_variables.get(name):
+                self._shared_ids[name] = id(value)
+        if cell_counter is not None:
+            self._shell.execution_count = cell_counter
 
     def add_variables_from_other(self, other: "Workspace", variable_names: list[str]) -> None:
         missing_names = set(variable_names) - set(other.get_variable_names())
@@ -180,8 +410,19 @@ class Workspace(WorkspaceBase):
 
         for name in variable_names:
             self._variables[name] = other._variables[name]  # noqa: SLF001
+        self._mark_dirty(set(variable_names))
 
     def __copy__(self) -> "Workspace":
-        new_workspace = Workspace()
-        new_workspace._variables = self._variables.copy()  # noqa: SLF001
+        """Copy the variables except IPython's internal ones, which the shell of the copy sets. The values are
+        deep copied, so that changing them in one workspace does not change them in the other, except
+        the shared objects, e.g. the input variables and the tools (see checkpoints.copy_namespace)."""
+        if "_shell" in self.__dict__:
+            hidden_names = self._shell.user_ns_hidden
+            variables = {name: value for name, value in self._variables.items() if name not in hidden_names}
+            execution_count = self._shell.execution_count
+        else:  # A copy which has not been used
+            variables, execution_count = self._variables, self._execution_count
+        new_workspace = Workspace(copy_namespace(variables, self._shared_ids), execution_count)
+        new_workspace._shared_ids = self._shared_ids.copy()  # noqa: SLF001
+        new_workspace._cell_outputs = self._cell_outputs.copy()  # noqa: SLF001
         return new_workspace
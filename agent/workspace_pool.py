@@ -0,0 +1,452 @@
+"""Workspaces whose IPython shells run in separate worker processes.
+
+Starting a process and creating an IPython shell takes a while, so WorkspacePool keeps a number of
+pre-started (warm) worker processes and hands one out to every new ProcessWorkspace.
+
+To run the agents in worker processes:
+    configure_workspace_pool(size=8, warmup_code="import pandas")
+    config.engine_config.workspace_factory = pooled_workspace
+
+With the default start method "spawn", the workers import the main module, so a script which
+configures the pool needs the if __name__ == "__main__" guard (interactive sessions do not).
+"""
+import asyncio
+from dataclasses import dataclass
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+from pathlib import Path
+import pickle
+import signal
+import sys
+import threading
+from types import ModuleType
+from typing import Any, Callable
+import warnings
+import weakref
+
+from .checkpoints import SharedRef
+from .stats import Stats
+from .tool_call_status import TCStatus
+from .workspace import WorkspaceBase, Workspace, get_cell_executor
+
+
+@dataclass
+class _ToolRef:
+    "A tool of the agent, created in the worker process."
+    name: str
+
+
+@dataclass
+class _CoreToolsRef:
+    "The CoreTools of the agent, created in the worker process."
+    tools: dict[str, Callable]
+    run_path: Path
+    return_cls_name: str
+
+
+@dataclass
+class _ModuleRef:
+    "A module in the namespace of a workspace, imported again when the variables are loaded."
+    name: str
+
+
+def _to_picklable(value: Any) -> Any:
+    "Return value or, if it cannot be sent to another process, its string representation."
+    try:
+        pickle.dumps(value)
+        return value
+    except Exception:  # noqa: BLE001
+        return str(value)
+
+
+class _WorkerAgent:
+    """The attributes of Agent which the tools use, available in the worker process.
+    The changes are sent back to the agent after every cell (see ProcessWorkspace.run_ipython)."""
+    def __init__(self, run_path: Path, return_cls_name: str):
+        self.run_path = run_path
+        self.return_cls_name = return_cls_name
+        self.stats = Stats()
+        self.final_report = None
+        self.return_value = None
+
+    def pop_updates(self) -> dict[str, Any]:
+        updates = {"tool_calls": dict(self.stats.tool_calls)}
+        self.stats.tool_calls.clear()
+        if self.final_report is not None or self.return_value is not None:
+            return_value = self.return_value
+            if _to_picklable(return_value) is not return_value:
+                warnings.warn("The return value cannot be pickled, returning its string representation", stacklevel=2)
+                return_value = str(return_value)
+            updates["final_report"] = self.final_report
+            updates["return_value"] = return_value
+            self.final_report = self.return_value = None
+        return updates
+
+
+class _WorkspaceServer:
+    "Executes the requests of ProcessWorkspace in the worker process."
+    def __init__(self):
+        self.workspace = Workspace()
+        self.agent: _WorkerAgent | None = None
+        self.core_tools = None
+        self.conn: Connection | None = None
+        self.forks: set[int] = set()
+        # The history of the shell is saved in a thread, which would not survive fork
+        history_manager = self.workspace._shell.history_manager  # noqa: SLF001
+        if history_manager.save_thread is not None:
+            history_manager.save_thread.stop()
+            history_manager.save_thread = None
+
+    def fork(self, conn: Connection) -> int:
+        """Fork the worker process. The new process gets a copy-on-write copy of the namespace
+        and serves the requests sent to conn."""
+        for pid in list(self.forks):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                self.forks.discard(pid)  # The fork has been stopped
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.conn.close()
+            self.forks = set()
+            _serve(conn, self)
+            os._exit(0)
+        conn.close()
+        self.forks.add(pid)
+        return pid
+
+    def _resolve(self, value: Any) -> Any:
+        if isinstance(value, _CoreToolsRef):
+            from .agent import CoreTools
+            self.agent = _WorkerAgent(value.run_path, value.return_cls_name)
+            self.core_tools = CoreTools(value.tools, agent=self.agent)
+            return self.core_tools
+        if isinstance(value, _ToolRef):
+            return getattr(self.core_tools, value.name)
+        if isinstance(value, _ModuleRef):
+            return __import__(value.name, fromlist=["_"])
+        return value
+
+    def _to_ref(self, value: Any) -> Any:
+        if self.core_tools is not None:
+            if value is self.core_tools:
+                return _CoreToolsRef(
+                    {name: getattr(value, name).func for name in value.tool_names},
+                    self.agent.run_path,
+                    self.agent.return_cls_name,
+                )
+            for name in self.core_tools.tool_names:
+                if value is getattr(self.core_tools, name):
+                    return _ToolRef(name)
+        if isinstance(value, ModuleType):
+            return _ModuleRef(value.__name__)
+        return value
+
+    def run_ipython(self, code: str, cwd: str) -> tuple[TCStatus, dict[str, Any], dict[str, Any]]:
+        if cwd and os.getcwd() != cwd:
+            os.chdir(cwd)  # Follow the working directory of the agent, see BaseTask.__enter__
+        status, out = self.workspace.run_ipython(code)
+        out = {name: _to_picklable(value) for name, value in out.items()}
+        updates = self.agent.pop_updates() if self.agent else {}
+        return status, out, updates
+
+    def execute_expr(self, expr: str) -> tuple[str, str, Exception | None]:
+        stdout, stderr, exception = self.workspace.execute_expr(expr)
+        return stdout, stderr, _to_picklable(exception)
+
+    def add_variables(self, variables: dict[str, Any], shared: bool = False) -> None:
+        self.workspace.add_variables({name: self._resolve(value) for name, value in variables.items()}, shared)
+
+    def dump_variables(self, variable_names: list[str] = None) -> dict[str, Any]:
+        """Return the variables which can be sent to another process.
+        Tools and modules are sent as references, other values that cannot be pickled are skipped."""
+        variables = {}
+        hidden_names = self.workspace._shell.user_ns_hidden  # noqa: SLF001
+        for name in variable_names or self.workspace.get_variable_names():
+            if name.startswith("_") or name in hidden_names:
+                continue  # IPython's internal variables and the cell outputs _, __, _1, ...
+            value = self._to_ref(self.workspace.get_variable(name))
+            try:
+                pickle.dumps(value)
+            except Exception:  # noqa: BLE001
+                continue
+            variables[name] = value
+        return variables
+
+    def load_variables(self, variables: dict[str, Any]) -> None:
+        # Load the tools first so that the references to individual tools can be resolved
+        names = sorted(variables, key=lambda name: not isinstance(variables[name], _CoreToolsRef))
+        self.add_variables({name: variables[name] for name in names})
+
+    def __getattr__(self, name: str):
+        # eval_expr, get_variable, get_variable_names, the checkpoint and the cell counter methods
+        return getattr(self.workspace, name)
+
+
+def _serve(conn: Connection, server: "_WorkspaceServer"):
+    server.conn = conn
+    while True:
+        try:
+            request = conn.recv()
+        except KeyboardInterrupt:
+            continue  # The interruption arrived after the cell had completed
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        method, args = request
+        try:
+            response = ("ok", getattr(server, method)(*args))
+        except BaseException as e:  # noqa: BLE001
+            response = ("error", _to_picklable(e))
+        try:
+            conn.send(response)
+        except Exception as e:  # noqa: BLE001
+            conn.send(("error", RuntimeError(f"Could not send the result of {method}: {e}")))
+
+
+def _worker_main(conn: Connection, warmup_code: str = None):
+    server = _WorkspaceServer()
+    if warmup_code:
+        exec(warmup_code, {})  # Import slow modules before the worker is used
+    conn.send(os.getpid())
+    _serve(conn, server)
+
+
+def _stop_worker(conn: Connection, process: multiprocessing.Process = None):
+    try:
+        conn.send(None)
+        conn.close()
+    except OSError:
+        pass
+    if process is not None:
+        process.join(timeout=1)
+        if process.is_alive():
+            process.kill()
+
+
+class ProcessWorkspace(WorkspaceBase):
+    """Workspace whose IPython shell runs in a worker process of a WorkspacePool.
+
+    The variables of the workspace live in the worker process. The tools of the agent are
+    created in the worker too, and the tool calls, final report and return value are copied back
+    to the agent after every cell. Values sent between the processes (variables, return values) have
+    to be picklable; cell outputs which cannot be pickled are replaced with their string representation."""
+    def __init__(
+        self,
+        pid: int,
+        conn: Connection,
+        pool: "WorkspacePool",
+        process: multiprocessing.Process = None,  # None for workers forked from other workers
+    ):
+        super().__init__()
+        self._pid = pid
+        self._conn = conn
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._core_tools = None  # CoreTools of the agent
+        self._finalizer = weakref.finalize(self, _stop_worker, conn, process)
+
+    def __str__(self) -> str:
+        return f"ProcessWorkspace(pid={self._pid})"
+
+    def _call(self, method: str, *args) -> Any:
+        with self._lock:
+            self._conn.send((method, args))
+            status, result = self._conn.recv()
+        if status == "error":
+            raise result if isinstance(result, BaseException) else RuntimeError(result)
+        return result
+
+    def close(self):
+        "Stop the worker process."
+        self._finalizer()
+
+    def interrupt(self):
+        "Interrupt the running cell with KeyboardInterrupt."
+        try:
+            os.kill(self._pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    def get_cell_counter(self):
+        return self._call("get_cell_counter")
+
+    def zero_cell_counter(self):
+        self._call("zero_cell_counter")
+
+    def increment_cell_counter(self):
+        self._call("increment_cell_counter")
+
+    def add_cell_output(self, name: str, content: str):
+        self._cell_outputs[name] = content
+
+    def get_cell_output(self, name: str) -> str | None:
+        if name not in self._cell_outputs:
+            raise KeyError(f"No cell output with name '{name}' found.")
+        return self._cell_outputs.get(name, None)
+
+    def get_variable_names(self) -> list[str]:
+        return self._call("get_variable_names")
+
+    def get_variable(self, name: str) -> Any:
+        return self._call("get_variable", name)
+
+    def eval_expr(self, expr: str) -> Any:
+        return self._call("eval_expr", expr)
+
+    def execute_expr(self, expr: str) -> tuple[str, str, Exception | None]:
+        return self._call("execute_expr", expr)
+
+    def run_ipython(self, code: str) -> tuple[TCStatus, dict[str, Any]]:
+        status, out, updates = self._call("run_ipython", code, os.getcwd())
+        self._apply_agent_updates(updates)
+        return status, out
+
+    async def run_ipython_async(self, code: str) -> tuple[TCStatus, dict[str, Any]]:
+        """Wait for the worker process in the cell executor.
+        If the calling task is cancelled, the running cell is interrupted in the worker process."""
+        future = asyncio.get_running_loop().run_in_executor(get_cell_executor(), self.run_ipython, code)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.interrupt()
+            raise
+
+    def _apply_agent_updates(self, updates: dict[str, Any]):
+        if self._core_tools is None:
+            return
+        agent = self._core_tools._agent  # noqa: SLF001
+        for tool_name, n_calls in updates.get("tool_calls", {}).items():
+            for _ in range(n_calls):
+                agent.stats.add_tool_call(tool_name)
+        if "final_report" in updates:
+            agent.final_report = updates["final_report"]
+            agent.return_value = updates["return_value"]
+
+    def _to_ref(self, value: Any) -> Any:
+        # CoreTools is created with a new class for every agent, so check the attributes instead of the type
+        if hasattr(value, "tool_names") and hasattr(value, "_agent"):
+            self._core_tools = value
+            agent = value._agent  # noqa: SLF001
+            tools = {name: getattr(value, name).func for name in value.tool_names}
+            return _CoreToolsRef(tools, agent.run_path, agent.return_cls_name)
+        if self._core_tools is not None:
+            for name in self._core_tools.tool_names:
+                if value is getattr(self._core_tools, name):
+                    return _ToolRef(name)
+        if isinstance(value, ModuleType):
+            return _ModuleRef(value.__name__)
+        return value
+
+    def add_variables(self, variables: dict[str, Any], shared: bool = False) -> None:
+        self._call("add_variables", {name: self._to_ref(value) for name, value in variables.items()}, shared)
+
+    def checkpoint_delta(
+        self, digests: dict[str, str]
+    ) -> tuple[dict[str, bytes | SharedRef], list[str], dict[str, str]]:
+        return self._call("checkpoint_delta", digests)
+
+    def load_checkpoint(
+        self, values: dict[str, bytes | SharedRef], input_variables: dict[str, Any], cell_counter: int = None
+    ) -> None:
+        self._call("load_checkpoint", values, input_variables, cell_counter)
+
+    def add_variables_from_other(self, other: WorkspaceBase, variable_names: list[str]) -> None:
+        missing_names = set(variable_names) - set(other.get_variable_names())
+        if missing_names:
+            msg = f"Variables {missing_names} are not found in the workspace"
+            raise KeyError(msg)
+
+        if isinstance(other, ProcessWorkspace):
+            self._call("load_variables", other._call("dump_variables", variable_names))  # noqa: SLF001
+        else:
+            self.add_variables({name: other.get_variable(name) for name in variable_names})
+
+    def __copy__(self) -> "ProcessWorkspace":
+        """Fork the worker process. This takes milliseconds since nothing is pickled or re-executed,
+        and the objects of the namespace are shared copy-on-write until either workspace modifies them."""
+        conn, child_conn = multiprocessing.Pipe()
+        pid = self._call("fork", child_conn)
+        child_conn.close()
+        new_workspace = ProcessWorkspace(pid, conn, pool=self._pool)
+        new_workspace._core_tools = self._core_tools  # noqa: SLF001
+        new_workspace._cell_outputs = self._cell_outputs.copy()  # noqa: SLF001
+        return new_workspace
+
+
+class WorkspacePool:
+    """Pool of pre-started worker processes for ProcessWorkspace.
+
+    Every worker serves one workspace and is stopped together with it. When a worker is taken,
+    a new one is started in the background so that the pool stays warm."""
+    def __init__(
+        self,
+        size: int = 4,  # Number of idle workers kept ready
+        start_method: str = "spawn",  # See multiprocessing.get_context
+        warmup_code: str = None,  # Code executed in every worker before it is used, e.g. "import pandas"
+    ):
+        self.size = size
+        self.warmup_code = warmup_code
+        self._context = multiprocessing.get_context(start_method)
+        self._idle: list[tuple[multiprocessing.Process, Connection]] = []
+        self._lock = threading.Lock()
+        self.fill()
+
+    def _start_worker(self) -> tuple[multiprocessing.Process, Connection]:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn, self.warmup_code), name="workspace-worker", daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def fill(self):
+        "Start workers until there are size idle workers."
+        with self._lock:
+            while len(self._idle) < self.size:
+                self._idle.append(self._start_worker())
+
+    def acquire(self) -> ProcessWorkspace:
+        "Return a workspace running in a warm worker (or in a new one if the pool is empty)."
+        with self._lock:
+            process, conn = self._idle.pop(0) if self._idle else self._start_worker()
+        self.fill()
+        try:
+            pid = conn.recv()  # Wait until the worker is ready
+        except EOFError as e:
+            raise RuntimeError(f"Workspace worker {process.pid} exited with code {process.exitcode}") from e
+        return ProcessWorkspace(pid, conn, pool=self, process=process)
+
+    def shutdown(self):
+        "Stop the idle workers."
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for process, conn in idle:
+            _stop_worker(conn, process)
+
+
+_default_pool: WorkspacePool | None = None
+
+def configure_workspace_pool(size: int = 4, start_method: str = "spawn", warmup_code: str = None) -> WorkspacePool:
+    "Create the pool used by pooled_workspace."
+    global _default_pool
+    if _default_pool is not None:
+        _default_pool.shutdown()
+    _default_pool = WorkspacePool(size=size, start_method=start_method, warmup_code=warmup_code)
+    return _default_pool
+
+
+def get_workspace_pool() -> WorkspacePool:
+    if _default_pool is None:
+        configure_workspace_pool()
+    return _default_pool
+
+
+def pooled_workspace() -> ProcessWorkspace:
+    "Workspace factory for AgentEngineConfig.workspace_factory, uses the pool set with configure_workspace_pool."
+    return get_workspace_pool().acquire()
@@ -0,0 +1,175 @@
+"""Dynamic batching of the generation with an in-process model, see agent.clients.LLMClient.
+
+Concurrent calls put their prompts in a queue. A worker takes the waiting prompts (up to max_batch_size,
+waiting at most max_wait_seconds for more after the first one), left-pads them to the same length and
+generates them as a single batch in a thread, so the event loop is not blocked. Every row stops at its
+own stop sequence or EOS, the batch finishes when all rows have stopped. The prompts which arrive during
+the generation form the next batch, so the batches grow with the load.
+
+Only the prompts with the same sampling parameters and stop sequence are batched together. A prompt
+which is generated alone reuses the KV cache of its session (see core.kv_cache), a batch does not.
+"""
+import asyncio
+from dataclasses import dataclass, field
+import time
+
+import torch
+
+from .llm import DEVICE, LLM, MyStoppingCriteria
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    max_new_tokens: int
+    temperature: float | None
+    stop_sequence: str | None
+    future: asyncio.Future = field(repr=False)
+    session_id: object = None
+
+    @property
+    def batch_key(self) -> tuple:
+        return self.temperature, self.stop_sequence
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    truncated: bool  # Stopped by the stop sequence or max_new_tokens, not by EOS
+    n_tokens: int  # Generated tokens of the row
+    batch_size: int  # Number of prompts generated together with this one (including it)
+
+
+class GenerationQueue:
+    def __init__(self, llm: LLM, tokenizer, max_batch_size: int = 8, max_wait_seconds: float = 0.01):
+        self.llm = llm
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.n_batches = 0
+        self.n_requests = 0
+        self.generation_time = 0.
+        self._queue: asyncio.Queue[GenerationRequest] | None = None
+        self._worker: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        if tokenizer.pad_token_id is None:
+            self.pad_token_id = tokenizer.eos_token_id
+        else:
+            self.pad_token_id = tokenizer.pad_token_id
+
+    def __repr__(self):
+        return (
+            f"GenerationQueue(max_batch_size={self.max_batch_size}, batches={self.n_batches}, "
+            f"requests={self.n_requests})"
+        )
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.n_requests / self.n_batches if self.n_batches else 0.
+
+    def _start(self):
+        "Start the worker in the running event loop, e.g. after the previous asyncio.run has finished."
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def generate(
+        self,
+        prompt: str,
+        *,
+        max_new_tokens: int = 2000,
+        temperature: float = None,
+        stop_sequence: str = None,
+        session_id=None,
+    ) -> GenerationResult:
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(
+            GenerationRequest(prompt, max_new_tokens, temperature, stop_sequence, future, session_id)
+        )
+        return await future
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _next_batch(self) -> list[GenerationRequest]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return [request for request in batch if not request.future.done()]  # Skip the cancelled calls
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            groups: dict[tuple, list[GenerationRequest]] = {}
+            for request in batch:
+                groups.setdefault(request.batch_key, []).append(request)
+            for requests in groups.values():
+                try:
+                    results = await asyncio.to_thread(self.generate_batch, requests)
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                for request, result in zip(requests, results):
+                    if not request.future.done():
+                        request.future.set_result(result)
+
+    def generate_batch(self, requests: list[GenerationRequest]) -> list[GenerationResult]:
+        "Generate the prompts with the same temperature and stop sequence as a single batch."
+        t0 = time.perf_counter()
+        rows = [self.tokenizer.encode(request.prompt) for request in requests]
+        prompt_len = max(len(row) for row in rows)
+        # Left padding, so that the generated tokens of all rows start at prompt_len
+        input_ids = torch.tensor([[self.pad_token_id] * (prompt_len - len(row)) + row for row in rows])
+        attention_mask = torch.tensor([[0] * (prompt_len - len(row)) + [1] * len(row) for row in rows])
+
+        stop_sequence = requests[0].stop_sequence
+        stop_criteria = MyStoppingCriteria(self.tokenizer, prompt_len, stop_sequence) if stop_sequence else None
+        output_tokens = self.llm.generate(
+            input_ids,
+            attention_mask=attention_mask.to(DEVICE),
+            temperature=requests[0].temperature,
+            max_new_tokens=max(request.max_new_tokens for request in requests),
+            stop_criteria=stop_criteria,
+            session_id=requests[0].session_id if len(requests) == 1 else None,
+        ).tolist()
+
+        results = []
+        end_token_ids = {self.tokenizer.eos_token_id, self.pad_token_id}
+        for i, (request, tokens) in enumerate(zip(requests, output_tokens)):
+            tokens = tokens[:request.max_new_tokens]
+            stopped = stop_criteria is not None and stop_criteria.stopped is not None and bool(stop_criteria.stopped[i])
+            # The rows which have finished before the others are filled with the pad token
+            end = next((j for j, token in enumerate(tokens) if token in end_token_ids), None)
+            if end is not None:
+                tokens = tokens[:end + 1]
+            truncated = stopped or end is None
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            results.append(GenerationResult(text, truncated, len(tokens), len(requests)))
+
+        self.n_batches += 1
+        self.n_requests += len(requests)
+        self.generation_time += time.perf_counter() - t0
+        return results
@@ -1,3 +1,5 @@
+from functools import cached_property, lru_cache
+
 
 SYSTEM_MESSAGES = {
     "llama": """Cutting Knowledge Date: December 2023
@@ -5,3 +7,85 @@ Today Date: 26 Jul 2024
 
 """,
 }
+
+
+EMPTY_MESSAGE = {"role": "user", "content": ""}  # Placeholder used for rendering and counting message blocks
+
+# Conversations used to check that a chat template can be rendered (and its tokens counted) message by message
+CHECK_CONVERSATIONS = [
+    [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Hello!"},
+        {"role": "assistant", "content": " Hi, how can I help? "},
+        {"role": "user", "content": "Add 2 and 3.\n"},
+        {"role": "assistant", "content": ""},
+    ],
+    [
+        {"role": "user", "content": "Hello!"},
+        {"role": "user", "content": "<status>\nstep 1\n</status>"},
+        {"role": "assistant", "content": "<inner_monologue>\nThoughts\n</inner_monologue>"},
+        {"role": "user", "content": ""},
+    ],
+    [
+        {"role": "user", "content": "Hello!"},
+    ],
+]
+
+
+class IncrementalChatTemplate:
+    """Renders a chat template like tokenizer.apply_chat_template(messages, tokenize=False) by joining
+    the cached renderings of the individual messages, so only the new messages of a growing history are rendered.
+
+    The rendering of a message is the text that it adds after a placeholder message, except for the first
+    message which is rendered alone. This works for templates which render every message independently of
+    the other messages (e.g. Llama 3). The template is checked on a few conversations first and if the results
+    differ from apply_chat_template, every call falls back to apply_chat_template."""
+    def __init__(self, tokenizer, max_cached_messages: int = 100_000):
+        self.tokenizer = tokenizer
+        self._render_first = lru_cache(maxsize=max_cached_messages)(self._render_first_uncached)
+        self._render_block = lru_cache(maxsize=max_cached_messages)(self._render_block_uncached)
+
+    def apply_chat_template(self, messages: list[dict]) -> str:
+        return self.tokenizer.apply_chat_template(messages, tokenize=False)
+
+    def _render_first_uncached(self, role: str, content: str) -> str:
+        return self.apply_chat_template([{"role": role, "content": content}])
+
+    @cached_property
+    def _placeholder(self) -> str:
+        return self.apply_chat_template([EMPTY_MESSAGE])
+
+    def _render_block_uncached(self, role: str, content: str) -> str:
+        with_message = self.apply_chat_template([EMPTY_MESSAGE, {"role": role, "content": content}])
+        if not with_message.startswith(self._placeholder):
+            raise ValueError("The chat template cannot be rendered message by message")
+        return with_message[len(self._placeholder):]
+
+    def render_incremental(self, messages: list[dict]) -> str:
+        first, *rest = messages
+        return self._render_first(first["role"], first["content"]) + "".join(
+            self._render_block(msg["role"], msg["content"]) for msg in rest
+        )
+
+    @cached_property
+    def is_incremental(self) -> bool:
+        "Whether render_incremental gives the same result as apply_chat_template for this template."
+        for messages in CHECK_CONVERSATIONS:
+            try:
+                expected = self.apply_chat_template(messages)
+            except Exception:  # noqa: BLE001
+                continue  # E.g. the template requires alternating roles
+            try:
+                if self.render_incremental(messages) != expected:
+                    return False
+            except Exception:  # noqa: BLE001
+                return False
+        return True
+
+    def render(self, messages: list[dict]) -> str:
+        if messages and self.is_incremental:
+            try:
+                return self.render_incremental(messages)
+            except Exception:  # noqa: BLE001, S110
+                pass  # Let apply_chat_template report the error
+        return self.apply_chat_template(messages)
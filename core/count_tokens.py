@@ -1,7 +1,35 @@
+from functools import lru_cache
+import hashlib
+import json
+from typing import Callable
+
 import tiktoken
 
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+@lru_cache(maxsize=None)
+def get_encoding_openai(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_openai_message(message: dict[str, str], encoding: tiktoken.Encoding) -> int:
+    "Return the number of tokens that a single message adds to the input, see num_tokens_openai."
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += TOKENS_PER_NAME
+    return num_tokens
+
 
-def num_tokens_openai(messages: list[dict[str, str]], model: str):
+def num_tokens_openai(messages: list[dict[str, str]], model: str, cache: dict = None):
     """Return the number of tokens used by a list of messages.
     Based on https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken.
     They mention only older models, so the number of tokens for newer models is a guess.
@@ -19,22 +47,50 @@ def num_tokens_openai(messages: list[dict[str, str]], model: str):
     },
     ...
     Not sure how name is used.
+
+    If cache is given, the token counts of individual messages are stored in it (see count_tokens_cached).
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding_openai(model)
+    num_tokens = count_tokens_cached(
+        messages,
+        lambda message: num_tokens_openai_message(message, encoding),
+        tokenizer=encoding.name,
+        cache=cache,
+    )
+    return num_tokens + TOKENS_PER_REPLY
+
 
-    tokens_per_message = 3
-    tokens_per_name = 1
+def message_key(tokenizer: str, message: dict[str, str]) -> tuple[str, str]:
+    "Key of a formatted message in a token count cache."
+    digest = hashlib.sha1(json.dumps(message, sort_keys=True).encode("utf-8")).hexdigest()
+    return tokenizer, digest
 
-    num_tokens = 0
+
+def count_tokens_cached(
+    messages: list[dict[str, str]],  # Formatted messages
+    count_message: Callable[[dict[str, str]], int],  # Number of tokens in a single message
+    tokenizer: str,  # Name of the tokenizer, part of the cache key
+    cache: dict = None,  # (tokenizer, message hash) -> number of tokens
+) -> int:
+    """Sum the token counts of the messages, tokenizing only the messages which are not in the cache.
+    The cache is usually History.token_counts so that each agent step tokenizes only the new messages."""
+    return sum(message_token_counts(messages, count_message, tokenizer, cache))
+
+
+def message_token_counts(
+    messages: list[dict[str, str]],
+    count_message: Callable[[dict[str, str]], int],
+    tokenizer: str,
+    cache: dict = None,
+) -> list[int]:
+    "The token counts of the individual messages, see count_tokens_cached."
+    counts = []
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+        if cache is None:
+            counts.append(count_message(message))
+            continue
+        key = message_key(tokenizer, message)
+        if key not in cache:
+            cache[key] = count_message(message)
+        counts.append(cache[key])
+    return counts
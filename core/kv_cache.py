@@ -0,0 +1,104 @@
+"""Reuse of the KV cache (past_key_values) of an in-process model between the calls of a session, see LLM.generate.
+
+The prompt of an agent's step starts with the prompt of the previous step and the generated text, so
+the keys and values of these tokens need not be computed again. After a call, the cache of the prompt
+and the generated tokens is kept for the session. The next call of the session reuses it up to the
+longest common token prefix with the new prompt (the rest is cropped) and only the new suffix is fed
+to the model. When the caches of all sessions take more than max_bytes, the least recently used are
+removed.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable
+
+import torch
+
+
+def cache_nbytes(past_key_values) -> int:
+    if hasattr(past_key_values, "layers"):
+        tensors = [
+            tensor for layer in past_key_values.layers
+            for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None))
+        ]
+    else:  # Older versions of transformers
+        tensors = [*past_key_values.key_cache, *past_key_values.value_cache]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors if isinstance(tensor, torch.Tensor))
+
+
+def common_prefix_length(tokens: torch.Tensor, other: torch.Tensor) -> int:
+    n = min(len(tokens), len(other))
+    mismatches = (tokens[:n] != other[:n]).nonzero()
+    return mismatches[0].item() if len(mismatches) else n
+
+
+@dataclass
+class KVCacheEntry:
+    tokens: torch.Tensor  # The tokens whose keys and values are in the cache (on CPU)
+    past_key_values: object  # transformers Cache, e.g. DynamicCache
+    nbytes: int
+
+
+class SessionKVCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, KVCacheEntry] = OrderedDict()  # From the least recently used
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0  # Prompt tokens which were not fed to the model again
+        self.evictions = 0
+
+    def __repr__(self):
+        return (
+            f"SessionKVCache(sessions={len(self)}, {self.nbytes / 2**20:.1f} MiB, hits={self.hits}, "
+            f"misses={self.misses}, reused_tokens={self.reused_tokens})"
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, session_id: Hashable) -> bool:
+        return session_id in self._entries
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def take(self, session_id: Hashable, input_ids: torch.Tensor):
+        """Return the cache of the session cropped to the longest common prefix with input_ids (1D) and its length,
+        (None, 0) if there is nothing to reuse. The cache is removed from the session until it is stored again,
+        so concurrent calls of the same session do not share it."""
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            self.misses += 1
+            return None, 0
+        n = common_prefix_length(entry.tokens, input_ids.cpu())
+        n = min(n, len(input_ids) - 1)  # At least one token must be fed to the model
+        if n <= 0:
+            self.misses += 1
+            return None, 0
+        cache_length = entry.past_key_values.get_seq_length()
+        if n < cache_length:
+            entry.past_key_values.crop(n - cache_length)
+        self.hits += 1
+        self.reused_tokens += n
+        return entry.past_key_values, n
+
+    def store(self, session_id: Hashable, tokens: torch.Tensor, past_key_values):
+        "Keep the cache of tokens (1D, prompt and generated) for the next call of the session."
+        n = past_key_values.get_seq_length()  # The last generated token is not in the cache
+        self._entries.pop(session_id, None)
+        self._entries[session_id] = KVCacheEntry(tokens[:n].cpu(), past_key_values, cache_nbytes(past_key_values))
+        self._evict()
+
+    def _evict(self):
+        total = self.nbytes
+        while total > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.nbytes
+            self.evictions += 1
+
+    def drop(self, session_id: Hashable):
+        self._entries.pop(session_id, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -7,9 +7,10 @@ from peft.peft_model import PeftModelForCausalLM
 from peft.utils import set_peft_model_state_dict, load_peft_weights
 import time
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextStreamer, StoppingCriteria
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache, TextStreamer, StoppingCriteria
 from typing import Union
 
+from .kv_cache import SessionKVCache
 from .messages import Role
 from .utils import get_adapter_path, MyEnum
 
@@ -17,22 +18,26 @@ from .utils import get_adapter_path, MyEnum
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+KV_CACHE_MAX_BYTES = 4 << 30  # Memory for the KV caches of the agents' sessions, see LLM and agent.clients.get_client
 
 class ResponseFormat(MyEnum):
     JSON = "json"
     MONOLOGUE = "inner_monologue"
     IPYTHON = "run_ipython"
+    MONOLOGUE_IPYTHON = "inner_monologue_run_ipython"  # Monologue followed by a tool call in one response
 
 
 START_SEQUENCES = {
     ResponseFormat.JSON: "{",
     ResponseFormat.MONOLOGUE: "<inner_monologue>\n",
     ResponseFormat.IPYTHON: "<run_ipython>\n",
+    ResponseFormat.MONOLOGUE_IPYTHON: "<inner_monologue>\n",
 }
 STOP_SEQUENCES = {
     ResponseFormat.JSON: "}",
     ResponseFormat.MONOLOGUE: "</inner_monologue>",
     ResponseFormat.IPYTHON: "</run_ipython>",
+    ResponseFormat.MONOLOGUE_IPYTHON: "</run_ipython>",
 }
 
 MODEL_FULL_NAME = {
@@ -78,11 +83,13 @@ class LLM:
         model_id: Union[str, Path],  # The base model's name or path
         adapter_ids: list[Path] = None,  # list of adapter's paths
         tokenizer_id: str = None, # defaults to model_id
+        kv_cache_max_bytes: int = 0,  # Memory for the KV caches of the sessions, see core.kv_cache. 0 disables it
     ):
         self.model_id = process_model_id(model_id)
         self.model_family = get_model_family(self.model_id)
         self.model = None
         self.temperature = 0.5
+        self.kv_cache = SessionKVCache(kv_cache_max_bytes) if kv_cache_max_bytes else None
 
         adapter_ids = adapter_ids or []
         self.adapter_ids = [get_adapter_path(adapter_id) for adapter_id in adapter_ids]
@@ -196,11 +203,21 @@ class LLM:
         stop_criteria: StoppingCriteria = None,
         do_sample: bool = True,
         synced_gpus: bool = False,
+        session_id=None,  # The KV cache of the previous call of the session is reused, only for a single prompt
     ) -> torch.Tensor:
         input_ids = input_ids.to(DEVICE)
 
         t0 = time.perf_counter()
 
+        use_kv_cache = session_id is not None and self.kv_cache is not None and input_ids.size(0) == 1
+        if use_kv_cache:
+            past_key_values, n_reused = self.kv_cache.take(session_id, input_ids[0])
+            if past_key_values is None:
+                past_key_values = DynamicCache()
+        else:
+            past_key_values, n_reused = None, 0
+
+        # With past_key_values, only the tokens which are not in the cache are fed to the model
         tokens = self.model.generate(
             input_ids=input_ids,
             attention_mask=attention_mask,
@@ -210,28 +227,45 @@ class LLM:
             streamer=streamer,
             stopping_criteria=stop_criteria,
             synced_gpus=synced_gpus,
+            past_key_values=past_key_values,
         )
+        if use_kv_cache:
+            self.kv_cache.store(session_id, tokens[0], past_key_values)
         prompt_length = input_ids.size(1)
         output_tokens = tokens[:, prompt_length:]
         t = time.perf_counter() - t0
         n_generated = output_tokens.size(1)
-        print(f"Generated {n_generated} tokens, time: {t:.02f} sec total, {n_generated / t:.02f} tokens/sec")
+        reused = f", {n_reused} of {prompt_length} prompt tokens cached" if use_kv_cache else ""
+        print(f"Generated {n_generated} tokens, time: {t:.02f} sec total, {n_generated / t:.02f} tokens/sec{reused}")
 
         return output_tokens
 
 
 class MyStoppingCriteria(StoppingCriteria):
+    """Stops the generation of every row of the batch when its generated text contains stop_sequence.
+
+    At every step only the last tokens of the rows, enough to contain the stop sequence, are decoded,
+    so the cost of a step does not depend on the number of generated tokens."""
     def __init__(self, tokenizer, prompt_len: int, stop_sequence: str):
         StoppingCriteria.__init__(self)
         self.tokenizer = tokenizer
         self.stop_sequence = stop_sequence
         self.prompt_len = prompt_len
-        self.generated_len = 0
-
-    def __call__(self, input_ids, scores, **kwargs):
-        generated_text = self.tokenizer.decode(input_ids[0][self.prompt_len:])
-        self.generated_len = len(generated_text)
-        return self.stop_sequence in generated_text
+        # Every token of the stop sequence contains at least one of its bytes. An extra token is decoded
+        # because some tokenizers drop the leading space of the decoded text.
+        self.window = len(stop_sequence.encode()) + 2
+        self.stopped: torch.Tensor = None  # Rows which have generated the stop sequence
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        batch_size = input_ids.size(0)
+        if self.stopped is None or self.stopped.size(0) != batch_size:
+            self.stopped = torch.zeros(batch_size, dtype=torch.bool)
+        n_tokens = min(self.window, input_ids.size(1) - self.prompt_len)
+        if n_tokens > 0:
+            for row, tail_ids in enumerate(input_ids[:, -n_tokens:].tolist()):
+                if not self.stopped[row] and self.stop_sequence in self.tokenizer.decode(tail_ids):
+                    self.stopped[row] = True
+        return self.stopped.to(input_ids.device, copy=True)
 
     def __len__(self):
         return 1
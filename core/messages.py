@@ -100,6 +100,17 @@ class Message:
             "color": self.color,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        tags = set([Tag(tag_str) for tag_str in data.get("tags", [])])
+        return cls(
+            Role.from_value(data["role"]),
+            data["content"],
+            tags=tags,
+            short_content=data.get("short_content"),
+            color=data.get("color"),
+        )
+
 
 def render_for_message(object):
     try:
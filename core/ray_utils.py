@@ -5,8 +5,11 @@ from IPython.display import clear_output
 import queue
 import os
 import ray
+import threading
 import time
-from typing import Callable
+from typing import Any, Callable
+
+from .shared_data import get_shared_data, has_shared_data, set_shared_data
 
 # Actor to manage heartbeats
 @ray.remote
@@ -20,6 +23,65 @@ class HeartbeatActor:
     def time_since_heartbeat(self, idx: int):
         return time.time() - self.last_heartbeat[idx]
 
+    def times_since_heartbeat(self, idxs: list[int]) -> list[float]:
+        "The ages of the last heartbeats of all tasks in a single call."
+        now = time.time()
+        return [now - self.last_heartbeat[idx] for idx in idxs]
+
+    def forget(self, idxs: list[int]):
+        "Remove the finished tasks."
+        for idx in idxs:
+            self.last_heartbeat.pop(idx, None)
+
+
+class Heartbeat:
+    """The heartbeat function of a task, which is passed to the Ray remote function.
+    Calling it sends a heartbeat at most once per min_interval seconds, so a task can call it as often as it likes."""
+    def __init__(self, actor: HeartbeatActor, idx: int, min_interval: float = 1.):
+        self.actor = actor
+        self.idx = idx
+        self.min_interval = min_interval
+        self._last_sent = float("-inf")
+
+    def __call__(self):
+        now = time.monotonic()
+        if now - self._last_sent >= self.min_interval:
+            self._last_sent = now
+            self.actor.send_heartbeat.remote(self.idx)
+
+
+def init_ray(**kwargs):
+    "Connect to the Ray cluster (or start a local one) unless already connected, so later calls reuse the workers."
+    if not ray.is_initialized():
+        ray.init(**kwargs)
+
+
+# Object references of the shared data in the object store, put once per Ray session (job)
+_shared_data_refs: dict[str, ray.ObjectRef] = {}
+_shared_data_job_id = None
+
+
+def put_shared_data(loaders: dict[str, Callable[[], Any]]) -> dict[str, ray.ObjectRef]:
+    """Put the read-only data of the tools into the object store, see core.shared_data.
+    The numpy arrays (e.g. of the numeric DataFrame columns) are then read by the workers of the node without a copy."""
+    global _shared_data_job_id
+    init_ray()
+    job_id = ray.get_runtime_context().get_job_id()
+    if job_id != _shared_data_job_id:  # Ray has been restarted, the old references are not valid
+        _shared_data_refs.clear()
+        _shared_data_job_id = job_id
+    for name, load in loaders.items():
+        if name not in _shared_data_refs:
+            _shared_data_refs[name] = ray.put(get_shared_data(name, load))
+    return {name: _shared_data_refs[name] for name in loaders}
+
+
+def install_shared_data(refs: dict[str, ray.ObjectRef]):
+    "Make the data put with put_shared_data available to the tools of this worker, called in the Ray tasks."
+    names = [name for name in refs if not has_shared_data(name)]
+    for name, value in zip(names, ray.get([refs[name] for name in names])):
+        set_shared_data(name, value)
+
 
 def run_ray_tasks(
     f: Callable,  # Ray remote function
@@ -27,8 +89,11 @@ def run_ray_tasks(
     max_concurrent: int,
     timeout: int,
     monitor: RayRunsMonitor,
+    shutdown: bool = False,  # Shut Ray down at the end, otherwise its workers are reused by the next call
+    heartbeat_interval: float = 1.,  # Minimum interval of the heartbeats of a task and of checking them
+    stop: threading.Event = None,  # When set (e.g. from another thread), the running tasks are cancelled
 ):
-    ray.init(ignore_reinit_error=True)
+    init_ray()
 
     task_queue = queue.Queue()
     for process_args in args:
@@ -38,17 +103,21 @@ def run_ray_tasks(
     heartbeat_actor = HeartbeatActor.remote()
 
     task_index = 0
+    last_check = float("-inf")
 
     results = {}
     while not task_queue.empty() or running_tasks:
+        if stop is not None and stop.is_set():
+            for future in running_tasks.values():
+                ray.cancel(future)
+            heartbeat_actor.forget.remote(list(running_tasks))
+            break
+
         # While we have capacity, submit tasks
         while len(running_tasks) < max_concurrent and not task_queue.empty():
             input_data = task_queue.get()
             # Start the task
-            future = f.remote(
-                input_data,
-                lambda idx=task_index: heartbeat_actor.send_heartbeat.remote(idx)
-            )
+            future = f.remote(input_data, Heartbeat(heartbeat_actor, task_index, heartbeat_interval))
             running_tasks[task_index] = future
             monitor.started(task_index, input_data)
             task_index += 1
@@ -57,6 +126,10 @@ def run_ray_tasks(
         futures = list(running_tasks.values())
         ready, _not_ready = ray.wait(futures, timeout=1)
         if ready:
+            # Take all finished tasks at once, not one per iteration
+            ready, _not_ready = ray.wait(futures, num_returns=len(futures), timeout=0)
+            ready = set(ready)
+            finished = []
             for idx, future in list(running_tasks.items()):
                 if future in ready:
                     try:
@@ -71,22 +144,29 @@ def run_ray_tasks(
                         monitor.failed(idx, str(e))
                     # Remove the task from running_tasks
                     del running_tasks[idx]
-
-        # Check the heartbeats of the remaining running tasks
-        for idx, future in list(running_tasks.items()):
-            time_since_heartbeat = ray.get(heartbeat_actor.time_since_heartbeat.remote(idx))
-            if time_since_heartbeat > timeout + 5:  # Allow 5 s for responding to ray.cancel
-                monitor.failed_to_stop(idx)
-                ray.cancel(future, force=True)
-            elif time_since_heartbeat > timeout:
-                monitor.no_hearbeat(idx)
-                ray.cancel(future)
-            else:
-                monitor.heartbeat(idx, time_since_heartbeat)
+                    finished.append(idx)
+            heartbeat_actor.forget.remote(finished)
+
+        # Check the heartbeats of the remaining running tasks, all in a single call to the actor
+        if running_tasks and time.monotonic() - last_check >= heartbeat_interval:
+            last_check = time.monotonic()
+            idxs = list(running_tasks)
+            times_since_heartbeat = ray.get(heartbeat_actor.times_since_heartbeat.remote(idxs))
+            for idx, time_since_heartbeat in zip(idxs, times_since_heartbeat):
+                future = running_tasks[idx]
+                if time_since_heartbeat > timeout + 5:  # Allow 5 s for responding to ray.cancel
+                    monitor.failed_to_stop(idx)
+                    ray.cancel(future, force=True)
+                elif time_since_heartbeat > timeout:
+                    monitor.no_hearbeat(idx)
+                    ray.cancel(future)
+                else:
+                    monitor.heartbeat(idx, time_since_heartbeat)
 
         monitor.display_progress()
 
-    ray.shutdown()
+    if shutdown:
+        ray.shutdown()
     return results
 
 
@@ -0,0 +1,23 @@
+"""Large read-only data of the tools (e.g. the ToolQA tables and the DBLP graphs), loaded once per process.
+
+The tools get the data with get_shared_data(name, load). In the workers of a Ray batch run, the data are
+put into the object store once by the driver and installed here before the first task of the worker runs,
+see core.ray_utils.put_shared_data, so the workers do not load the data from the disk.
+"""
+from typing import Any, Callable
+
+_shared_data: dict[str, Any] = {}
+
+
+def get_shared_data(name: str, load: Callable[[], Any]) -> Any:
+    if name not in _shared_data:
+        _shared_data[name] = load()
+    return _shared_data[name]
+
+
+def set_shared_data(name: str, value: Any):
+    _shared_data[name] = value
+
+
+def has_shared_data(name: str) -> bool:
+    return name in _shared_data
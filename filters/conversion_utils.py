@@ -8,6 +8,7 @@ from xml.etree import ElementTree as ET
 from agent import AGENT_DATASET_PATH
 from agent.agent import ExerciseMessageBuilder
 from agent.configs import AgentConfig
+from agent.history import HistoryJournal, HISTORY_JOURNAL
 from core.llm import ResponseFormat, START_SEQUENCES, STOP_SEQUENCES
 from core.steps import StepMessages
 from core.tags import Tag
@@ -20,9 +21,17 @@ MERGE_MESSAGES = False
 
 # %%
 def get_steps_from_run(run_path: Path) -> list[StepMessages]:
-    step_paths = sorted([p for p in run_path.glob("[0-9][0-9][0-9].xml") if p.name != "000.xml"])
+    # The steps which were not rendered to step files (e.g. the run was interrupted in the middle of a step)
+    # are rendered from the history journal, which is replayed only then
+    journal_path = run_path / HISTORY_JOURNAL
+    if journal_path.exists():
+        journal = HistoryJournal(journal_path)
+        if any(not (run_path / f"{step:03d}.xml").exists() for step in journal.steps()):
+            journal.save_steps(run_path)
+
+    step_paths = [p for p in run_path.glob("[0-9][0-9][0-9].xml") if p.name != "000.xml"]
     steps: list[StepMessages] = []
-    for step_path in step_paths:
+    for step_path in sorted(step_paths):
         step_messages = StepMessages.from_xml_path(step_path)
         step_messages.metadata.update({
             "path": absolute_to_relative_path(str(step_path)),
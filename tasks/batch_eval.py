@@ -1,20 +1,29 @@
 import asyncio
 from copy import deepcopy
+from dataclasses import dataclass
 from datetime import datetime
-from IPython.display import clear_output, HTML, display
 import json
+import multiprocessing
 import os
 from pathlib import Path
+from queue import Empty
+import traceback
+from typing import Callable
 
 from agent import AGENT_BATCH_RUNS_PATH
 from agent.agent import Agent
-from agent.clients import BaseClient
+from agent.clients import BaseClient, get_client
 from agent.configs import AgentConfig
+from agent.progress import ProgressBus, ProgressEvent, ProgressPublisher, ProgressRenderer, QueueRenderer, default_renderer
 from agent.stats import Stats
+from agent.workspace import configure_cell_executor
 import tasks as t
 
 
 RUN_REPORT = "run_report.json"
+# Statuses of the runs which are run again when a batch run is resumed, see Manager.run
+RETRY_FAILED = ("failed", "code failure", "asyncio-cancelled")
+RETRY_ERRORS = ("code failure", "asyncio-cancelled")  # Only the runs which did not finish because of an error
 
 def save_score_and_stats(run_path: Path, status: str, score: float | None, stats: Stats | None):
     score_stats = {
@@ -26,12 +35,22 @@ def save_score_and_stats(run_path: Path, status: str, score: float | None, stats
     with open(run_rpt_path, "w") as f:
         json.dump(score_stats, f, indent=2)
 
+def load_run_report(run_path: Path) -> dict | None:
+    "The report saved by save_score_and_stats, None if the run has not finished (or the report is incomplete)."
+    run_rpt_path = run_path / RUN_REPORT
+    try:
+        with open(run_rpt_path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
 async def execute_task(
     task: t.BaseTask,
     run_path: Path,
     config: AgentConfig,
     client: BaseClient,
     verbose: bool = True,
+    progress: ProgressPublisher = None,
 ) -> tuple[str, float | None, Agent]:
     agent = Agent(
         task=task.task,
@@ -40,6 +59,7 @@ async def execute_task(
         input_variables=task.input_variables,
         return_cls_name=task.return_cls_name,
         init_script=task.init_script,
+        progress=progress,
     )
     task.agent_home = run_path
     with task:
@@ -76,6 +96,8 @@ async def execute_task(
             agent.logger.exception("An error occurred: %s", e)
 
         save_score_and_stats(run_path, status, score, agent.stats)
+        if progress:
+            progress.status(status)
 
     return status, score, agent, task
 
@@ -129,7 +151,10 @@ class Manager:
         agent_configs: list[AgentConfig],
         batch_run_paths: Path | list[Path],
         max_concurrent_tasks: int = None,  # None means no limit
-        debug: bool = False
+        debug: bool = False,
+        max_cell_workers: int = None,  # Threads executing IPython cells, None means the default, 0 means no threads
+        renderer: ProgressRenderer = None,  # None means HTML in IPython, otherwise the terminal
+        refresh_seconds: float = 1.,  # Interval of redrawing the progress
     ):
         self.tasks = tasks
         self.agent_configs = agent_configs
@@ -139,62 +164,47 @@ class Manager:
         self.run_paths = []
         self.max_concurrent_tasks = max_concurrent_tasks or len(tasks)
         self.debug = debug
-        try:
-            __IPYTHON__  # noqa
-            self._ipython = True
-        except NameError:
-            self._ipython = False
+        configure_cell_executor(max_cell_workers)
+        self.renderer = renderer
+        self.refresh_seconds = refresh_seconds
+        # The agents publish their progress to the bus, so the run directories are not polled
+        self.progress_bus = ProgressBus()
+        self._n_finished = None  # The number of finished jobs at the last redraw
+        self.stats: list[Stats | None] = []  # Stats of the runs, including the resumed ones, set by run
+        self.n_resumed = 0  # Finished runs which were not run again, see run
 
     # Coroutine to monitor the progress of concurrent runs
     async def monitor(self):
         try:
             while True:
                 self.display_progress()
-                await asyncio.sleep(1)
+                await asyncio.sleep(self.refresh_seconds)
         except asyncio.CancelledError:
-            self.display_progress()
+            self.display_progress(force=True)
 
-    def clear_terminal(self):
-        if self._ipython:
-            clear_output(wait=True)
-        else:
-            os.system('cls' if os.name == 'nt' else 'clear')
+    def display_progress(self, force: bool = False):
+        "Redraw the progress if there are new events or finished jobs since the last redraw."
+        events = self.progress_bus.consume()
+        n_finished, n_jobs = self.count_finished()
+        if not (force or events or n_finished != self._n_finished):
+            return
+        self._n_finished = n_finished
 
-    def display_progress(self):
         if self.debug:
             print(self.jobs)
-        else:
-            self.clear_terminal()
-
-        content = ""
-        for run_name, run_path in zip(self.run_names, self.run_paths, strict=True):
-            n_steps = len(list(run_path.glob("**/*.xml")))
-            progress = f"{'.'*n_steps}"
-            run_rpt_path = run_path / RUN_REPORT
-            if run_rpt_path.exists():
-                with open(run_rpt_path, "r") as f:
-                    report = json.load(f)
-                status = report["status"].split("\n")[0]
-                progress += f" {status}"
-
-            log_path = run_path / "output.ans"
-            if self._ipython:
-                content += f'{run_name}: <a href="file://{log_path}" target="_blank">log</a> {progress}<br>'
-            else:
-                content += f'{run_name}: {progress}\n'
+        renderer = self.renderer or default_renderer(clear=not self.debug)
+        runs = [self.progress_bus.runs[run_name] for run_name in self.run_names]
+        renderer.render(runs, events, n_finished, n_jobs)
 
-        done = [job.done() for job in self.jobs]
-        content += f"Finished: {sum(done)}/{len(self.jobs)}"
-        if self._ipython:
-            html_content = '''<div style="font-family: Menlo, Monaco, 'Courier New', monospace; font-size: inherit;">{content}</div>'''
-            display(HTML(html_content.format(content=content)))
-        else:
-            print(content)
+    def count_finished(self) -> tuple[int, int]:
+        "The numbers of the finished runs and of all runs."
+        return sum(job.done() for job in self.jobs), len(self.jobs)
 
     async def run_task_with_semaphore(self, semaphore, task, run_name, run_path, config, client):
+        progress = self.progress_bus.publisher(run_name)
         try:
             async with semaphore:
-                return await execute_task(task, run_path, config, client, verbose=False)
+                return await execute_task(task, run_path, config, client, verbose=False, progress=progress)
                 #for i in range(10):
                 #    print(f"{run_name}: {i}")
                 #    await asyncio.sleep(1)
@@ -202,11 +212,23 @@ class Manager:
             #print(f"Task {run_name} cancelled.")
             return None, None, None, task
 
+    async def reuse_run(self, report: dict, task, run_name):
+        "The result of a run which has finished in a previous batch run, see run."
+        self.progress_bus.publisher(run_name).status(report["status"])
+        return report["status"], report["score"], None, task
+
     async def run(
         self,
         client,
-        debug=False  # Use True to see exceptions
+        debug=False,  # Use True to see exceptions
+        resume: bool = False,  # Skip the runs which have finished in the batch run paths
+        retry_statuses: tuple[str, ...] = RETRY_FAILED,  # With resume, the runs with these statuses are run again
     ):
+        """Run the tasks concurrently and return their run names, statuses, scores, agents and tasks.
+
+        With resume, the runs whose run report has a status not starting with one of retry_statuses are
+        not run again. Their status and score are taken from the report, their agent is None and their
+        stats (restored from the report) are in self.stats like the stats of the other runs."""
         self.debug = debug
         try:
             self.monitor_job = asyncio.create_task(self.monitor())
@@ -223,7 +245,16 @@ class Manager:
                 run_names.append(run_name)
                 run_path = batch_run_path / run_name
                 self.run_paths.append(run_path)
+                self.progress_bus.add_run(run_name, log_path=run_path / "output.ans")
+
+                report = load_run_report(run_path) if resume else None
+                if report is not None and not report["status"].startswith(tuple(retry_statuses)):
+                    self.n_resumed += 1
+                    self.stats.append(Stats.from_dict(report["stats"]) if report["stats"] else None)
+                    jobs.append(asyncio.create_task(self.reuse_run(report, task, run_name)))
+                    continue
 
+                self.stats.append(None)  # Set when the run finishes
                 jobs.append(asyncio.create_task(
                     self.run_task_with_semaphore(semaphore, deepcopy(task), run_name, run_path, agent_config, client)))
 
@@ -234,12 +265,16 @@ class Manager:
                 except Exception as e:
                     print(f"An exception occurred: {e}")
                     self.monitor_job.cancel()
+                    await self.monitor_job
                     raise e
 
             else:
                 task_results = await asyncio.gather(*jobs, return_exceptions=True)
 
             statuses, scores, agents, tasks = zip(*task_results, strict=True)
+            for i, agent in enumerate(agents):
+                if agent is not None:
+                    self.stats[i] = agent.stats
             self.monitor_job.cancel()
             await self.monitor_job
             print("Jobs finished.")
@@ -256,10 +291,204 @@ class Manager:
             await self.monitor_job
             print("Jobs cancelled.")
 
-            return None, None, None, None
+            return None, None, None, None, None
+
+
+@dataclass
+class RunResult:
+    "Lightweight handle of a run executed in a worker process, returned instead of its Agent, see ShardedManager."
+    run_name: str
+    run_path: Path
+    status: str | None
+    score: float | None
+    stats_dict: dict | None  # Stats.to_dict, the stats are not picklable
+    final_report: str | None = None
+
+    @property
+    def stats(self) -> Stats | None:
+        return Stats.from_dict(self.stats_dict) if self.stats_dict else None
+
+
+def _run_shard(
+    shard_id: int,
+    tasks: list[t.BaseTask],
+    agent_configs: list[AgentConfig],
+    batch_run_paths: list[Path],
+    client: str | Callable[[], BaseClient],
+    manager_kwargs: dict,
+    run_kwargs: dict,
+    queue,
+):
+    "Run a shard of the tasks in a worker process of ShardedManager, the progress and the results go to the queue."
+    try:
+        # A single client for all agents of the worker, so they share its connection pool
+        client = get_client(client) if isinstance(client, str) else client()
+        manager = Manager(tasks, agent_configs, batch_run_paths, renderer=QueueRenderer(queue), **manager_kwargs)
+        run_names, statuses, scores, agents, tasks = asyncio.run(manager.run(client, **run_kwargs))
+        if run_names is None:
+            raise RuntimeError("The runs were cancelled")
+        results = [
+            RunResult(
+                run_name=run_name,
+                run_path=run_path,
+                status=status,
+                score=score,
+                stats_dict=stats.to_dict() if stats else None,
+                final_report=getattr(agent, "final_report", None),
+            )
+            for run_name, run_path, status, score, stats, agent in zip(
+                run_names, manager.run_paths, statuses, scores, manager.stats, agents, strict=True
+            )
+        ]
+        queue.put(("results", shard_id, (statuses, scores, results, tasks)))
+    except BaseException:
+        queue.put(("error", shard_id, traceback.format_exc()))
+
+
+class ShardedManager(Manager):
+    """Runs the tasks in n_workers processes, each with its own event loop, Manager and client.
+
+    The agents of a single process compete for the GIL when they execute their tools, so more concurrent
+    agents stop helping beyond a few. The tasks are assigned to the workers in turns. The workers forward
+    their progress events to the monitor of this process and send back the results, which are merged in
+    the order of the tasks. run returns the same values as Manager.run, with RunResult handles in place
+    of the agents."""
+    def __init__(
+        self,
+        tasks: list[t.BaseTask],
+        agent_configs: list[AgentConfig],
+        batch_run_paths: Path | list[Path],
+        n_workers: int = os.cpu_count(),
+        max_concurrent_tasks: int = None,  # Per worker, None means no limit
+        debug: bool = False,
+        max_cell_workers: int = None,  # Per worker, see Manager
+        renderer: ProgressRenderer = None,
+        refresh_seconds: float = 1.,
+    ):
+        super().__init__(
+            tasks, agent_configs, batch_run_paths, max_concurrent_tasks, debug,
+            max_cell_workers=max_cell_workers, renderer=renderer, refresh_seconds=refresh_seconds,
+        )
+        self.n_workers = min(n_workers, len(tasks))
+        self.max_concurrent_tasks = max_concurrent_tasks
+        self.max_cell_workers = max_cell_workers
+        self.processes = []
+
+    def count_finished(self) -> tuple[int, int]:
+        n_finished = sum(run.status is not None for run in self.progress_bus.runs.values())
+        return n_finished, len(self.run_names)
+
+    def _start_workers(self, client, queue, run_kwargs: dict) -> list[list[int]]:
+        shards = [list(range(i, len(self.tasks), self.n_workers)) for i in range(self.n_workers)]
+        manager_kwargs = {
+            "max_concurrent_tasks": self.max_concurrent_tasks,
+            "debug": self.debug,
+            "max_cell_workers": self.max_cell_workers,
+            "refresh_seconds": self.refresh_seconds,
+        }
+        # Spawn, not fork: the workers do not inherit the threads and the event loop of this process
+        context = multiprocessing.get_context("spawn")
+        for shard_id, indices in enumerate(shards):
+            process = context.Process(
+                target=_run_shard,
+                args=(
+                    shard_id,
+                    [self.tasks[i] for i in indices],
+                    [self.agent_configs[i] for i in indices],
+                    [self.batch_run_paths[i] for i in indices],
+                    client,
+                    manager_kwargs,
+                    run_kwargs,
+                    queue,
+                ),
+                daemon=False,  # The agents may start processes
+            )
+            process.start()
+            self.processes.append(process)
+        return shards
+
+    def _receive(self, queue, results: dict, errors: dict):
+        while True:
+            try:
+                message = queue.get_nowait()
+            except Empty:
+                return
+            if isinstance(message, ProgressEvent):
+                self.progress_bus.publish(message)
+            else:
+                kind, shard_id, payload = message
+                (results if kind == "results" else errors)[shard_id] = payload
+
+    async def run(
+        self,
+        client: str | Callable[[], BaseClient],  # A model for get_client or a picklable function creating a client
+        debug=False,  # Use True to raise the errors of the workers
+        resume: bool = False,
+        retry_statuses: tuple[str, ...] = RETRY_FAILED,
+    ):
+        self.debug = debug
+        for task, batch_run_path in zip(self.tasks, self.batch_run_paths, strict=True):
+            run_path = batch_run_path / task.name
+            self.run_names.append(task.name)
+            self.run_paths.append(run_path)
+            self.progress_bus.add_run(task.name, log_path=run_path / "output.ans")
+
+        queue = multiprocessing.get_context("spawn").Queue()
+        self.monitor_job = asyncio.create_task(self.monitor())
+        shards = self._start_workers(client, queue, {"resume": resume, "retry_statuses": retry_statuses})
+        results, errors = {}, {}
+        try:
+            while len(results) + len(errors) < len(shards):
+                self._receive(queue, results, errors)
+                for shard_id, process in enumerate(self.processes):
+                    if process.exitcode is not None and shard_id not in results and shard_id not in errors:
+                        self._receive(queue, results, errors)  # The results may have been sent just before the exit
+                        if shard_id not in results and shard_id not in errors:
+                            errors[shard_id] = f"The worker exited with code {process.exitcode}"
+                await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            for process in self.processes:
+                process.terminate()
+            self.monitor_job.cancel()
+            await self.monitor_job
+            print("Jobs cancelled.")
+            return None, None, None, None, None
+        finally:
+            for process in self.processes:
+                process.join(timeout=5)
+
+        n = len(self.tasks)
+        statuses, scores, agents, tasks, self.stats = [None] * n, [None] * n, [None] * n, list(self.tasks), [None] * n
+        for shard_id, indices in enumerate(shards):
+            if shard_id in errors:
+                if debug:
+                    self.monitor_job.cancel()
+                    await self.monitor_job
+                    raise RuntimeError(f"Worker {shard_id} failed:\n{errors[shard_id]}")
+                print(f"Worker {shard_id} failed:\n{errors[shard_id]}")
+                for i in indices:
+                    statuses[i] = f"code failure: worker {shard_id} failed"
+                    self.progress_bus.publisher(self.run_names[i]).status(statuses[i])
+                continue
+            shard_statuses, shard_scores, shard_results, shard_tasks = results[shard_id]
+            for i, status, score, result, task in zip(
+                indices, shard_statuses, shard_scores, shard_results, shard_tasks, strict=True
+            ):
+                statuses[i], scores[i], agents[i], tasks[i] = status, score, result, task
+                self.stats[i] = result.stats
+
+        self.monitor_job.cancel()
+        await self.monitor_job
+        print("Jobs finished.")
+        return self.run_names, tuple(statuses), tuple(scores), tuple(agents), tuple(tasks)
 
 
-def create_batch_run_path(model: str, taskset_name: str, stime: str = None):
+def create_batch_run_path(model: str, taskset_name: str, stime: str = None, resume: bool = False):
+    "With resume and no stime, return the latest batch run path of the taskset, see Manager.run."
+    if stime is None and resume:
+        batch_run_paths = sorted((AGENT_BATCH_RUNS_PATH / model).glob(f"????????-??????_{taskset_name}"))
+        if batch_run_paths:
+            return batch_run_paths[-1]
     if stime is None:
         stime = datetime.now().strftime("%Y%m%d-%H%M%S")
     batch_run_path = AGENT_BATCH_RUNS_PATH / model / f"{stime}_{taskset_name}"
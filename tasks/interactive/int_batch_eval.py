@@ -0,0 +1,47 @@
+# %%
+# A shard of ShardedManager with tasks which have an init script. The shard is run in a thread, where it
+# starts its own event loop with asyncio.run as in a worker process, so the init script must not start another one
+import asyncio
+from functools import partial
+from pathlib import Path
+from queue import Queue
+import tempfile
+
+from agent.clients import MockClient
+from agent.configs import AgentConfig
+from tasks.base import BaseTask
+from tasks.batch_eval import _run_shard
+
+
+class InitScriptTask(BaseTask):
+    task = "Add 3 to the variable a and report the result."
+    init_script = "a = 2"
+    n_variants = 2
+
+    def evaluate(self, agent, verbose: bool = False) -> tuple[float, str]:
+        score = float(agent.return_value == 5)
+        return score, f"Returned {agent.return_value}"
+
+
+responses = [
+    "I will add 3 to a.",
+    "<run_ipython>\ntools.complete_task('The result of adding 3 to a is 5.', a + 3)\n</run_ipython>",
+]
+tasks = InitScriptTask.generate_variants()
+queue = Queue()
+await asyncio.to_thread(
+    _run_shard,
+    0,
+    tasks,
+    [AgentConfig(stream=False, verbose=0, log_stats=False) for _ in tasks],
+    [Path(tempfile.mkdtemp())] * len(tasks),
+    partial(MockClient, responses * len(tasks)),  # The runs of the shard share the client, one at a time
+    {"max_concurrent_tasks": 1},
+    {},
+    queue,
+)
+messages = [queue.get() for _ in range(queue.qsize())]
+kind, shard_id, payload = messages[-1]  # After the progress events
+print(kind, payload[0] if kind == "results" else payload)  # results ('done: 1.00', 'done: 1.00')
+
+# %%
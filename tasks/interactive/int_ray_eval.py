@@ -0,0 +1,101 @@
+# %%
+# Batch evaluation on a local single-node Ray cluster with a mock client
+from pathlib import Path
+import tempfile
+
+import numpy as np
+import ray
+
+from agent.clients import MockClient
+from agent.configs import AgentConfig
+from core.ray_utils import install_shared_data, put_shared_data
+from core.shared_data import get_shared_data
+from tasks.base import BaseTask
+from tasks.ray_eval import RayManager
+
+
+class AddTask(BaseTask):
+    task = "Add 3 to the variable a and report the result."
+    init_script = "a = 2"  # Executed in the event loop of the worker
+    n_variants = 8
+
+    def evaluate(self, agent, verbose: bool = False) -> tuple[float, str]:
+        score = float(agent.return_value == 5)
+        return score, f"Returned {agent.return_value}"
+
+
+def create_client():
+    return MockClient([
+        "I will add 3 to a.",
+        "<run_ipython>\nresult = a + 3\ntools.complete_task('The result of adding 3 to a is 5.', result)\n</run_ipython>",
+    ])
+
+
+tasks = AddTask.generate_variants()
+batch_run_path = Path(tempfile.mkdtemp())
+manager = RayManager(
+    tasks,
+    [AgentConfig(stream=False) for _ in tasks],
+    [batch_run_path] * len(tasks),
+    max_concurrent_tasks=4,
+    timeout=60,
+)
+run_names, statuses, scores, results, tasks = await manager.run(create_client)
+print(statuses)  # 'done: 1.00' for all runs, about 20 sec on a single CPU
+print([result.stats.n_calls for result in results])  # 2 calls per run
+
+# %%
+# Resuming: all runs have finished, so nothing is run again
+run_names, statuses, scores, results, tasks = await RayManager(
+    tasks, [AgentConfig(stream=False) for _ in tasks], [batch_run_path] * len(tasks)
+).run(create_client, resume=True)
+print(statuses, results)  # The same statuses, no RunResult handles as nothing has run
+
+# %%
+# The shared data is put into the object store once, the workers read the numpy arrays without a copy
+shared_data_refs = put_shared_data({"numbers": lambda: np.arange(10_000_000)})
+
+@ray.remote
+def shared_sum(refs: dict) -> tuple[int, bool]:
+    install_shared_data(refs)
+    numbers = get_shared_data("numbers", lambda: None)
+    return int(numbers.sum()), numbers.flags.writeable
+
+print(ray.get([shared_sum.remote(shared_data_refs) for _ in range(4)]))  # writeable is False: the array is not copied
+
+# %%
+# Heartbeats of 1,000 running tasks: a query per task against a single batched query
+import time
+from core.ray_utils import HeartbeatActor, RayRunsMonitor, run_ray_tasks
+
+heartbeat_actor = HeartbeatActor.remote()
+idxs = list(range(1000))
+
+t0 = time.perf_counter()
+ages = [ray.get(heartbeat_actor.time_since_heartbeat.remote(idx)) for idx in idxs]
+t_per_task = time.perf_counter() - t0
+
+t0 = time.perf_counter()
+ages = ray.get(heartbeat_actor.times_since_heartbeat.remote(idxs))
+t_batched = time.perf_counter() - t0
+print(f"per task: {t_per_task * 1000:.0f} ms, batched: {t_batched * 1000:.1f} ms")  # About 1500 ms against 1.4 ms
+
+# %%
+# 1,000 no-op tasks, all running concurrently
+class SilentMonitor(RayRunsMonitor):
+    def display_progress(self):
+        pass
+
+@ray.remote
+def noop(input_data, heartbeat):
+    for _ in range(100):
+        heartbeat()  # Throttled, at most one heartbeat per second is sent
+    return input_data
+
+args = list(range(1000))
+t0 = time.perf_counter()
+results = run_ray_tasks(noop, args, max_concurrent=1000, timeout=60, monitor=SilentMonitor(args, overwrite=False))
+print(f"{len(results)} tasks in {time.perf_counter() - t0:.1f} sec")  # About 7 sec, 885 sec with unthrottled heartbeats and a query per task
+assert [results[i] for i in range(len(args))] == args
+
+# %%
@@ -0,0 +1,170 @@
+"""Batch evaluation on a Ray cluster, with the same interface as tasks.batch_eval.Manager.
+
+Every run is a Ray task, scheduled with core.ray_utils.run_ray_tasks: a run which stops sending
+heartbeats for timeout seconds is cancelled. The heartbeats are sent by the agent when it makes progress
+(see HeartbeatPublisher), so timeout is the longest allowed step. The read-only data of the tools (see
+core.shared_data) is put into the object store once and installed in every worker before its first run,
+so the workers do not load it from the disk. The runs write their artifacts to their run paths as usual, so on a
+multi-node cluster the batch run paths have to be on a file system shared by the nodes.
+
+For a local single-node cluster nothing has to be set up: Ray is started by the first run and its
+workers are reused by the next ones.
+"""
+import asyncio
+from pathlib import Path
+import threading
+from typing import Any, Callable
+
+import ray
+
+from agent.clients import BaseClient, get_client
+from agent.configs import AgentConfig
+from agent.progress import ProgressPublisher
+from agent.stats import Stats
+from core.ray_utils import RayRunsMonitor, install_shared_data, put_shared_data, run_ray_tasks
+import tasks as t
+from tasks.batch_eval import RETRY_FAILED, RunResult, execute_task, load_run_report
+
+
+class HeartbeatPublisher(ProgressPublisher):
+    """Sends a heartbeat for every progress event of the run (a step has started, the run has finished),
+    so a run is cancelled when its agent is stuck, not only when its worker is."""
+    def __init__(self, heartbeat: Callable, run_name: str):
+        super().__init__(bus=None, run_name=run_name)
+        self.heartbeat = heartbeat
+
+    def step(self, step: int):
+        self.heartbeat()
+
+    def status(self, status: str):
+        self.heartbeat()
+
+
+async def _execute_with_heartbeat(input_data: dict, heartbeat: Callable):
+    heartbeat()  # The run has started, the first step follows the initialization of the agent
+    client = input_data["client"]
+    client = get_client(client) if isinstance(client, str) else client()
+    task = input_data["task"]
+    return await execute_task(
+        task, input_data["run_path"], input_data["config"], client, verbose=False,
+        progress=HeartbeatPublisher(heartbeat, task.name),
+    )
+
+
+@ray.remote
+def run_task_remote(input_data: dict, heartbeat: Callable):
+    "Run a single task in a Ray worker and return its status, score, RunResult and task."
+    install_shared_data(input_data["shared_data"])
+    status, score, agent, task = asyncio.run(_execute_with_heartbeat(input_data, heartbeat))
+    result = RunResult(
+        run_name=task.name,
+        run_path=input_data["run_path"],
+        status=status,
+        score=score,
+        stats_dict=agent.stats.to_dict(),
+        final_report=getattr(agent, "final_report", None),
+    )
+    return status, score, result, task
+
+
+class RayBatchMonitor(RayRunsMonitor):
+    "Shows the runs by their names and the statuses of the finished runs."
+    def set_task_names(self):
+        self.task_names = [input_data["task"].name for input_data in self.args]
+
+    def completed(self, idx: int, result: tuple):
+        self._status[idx] = result[0].split("\n")[0]
+        self._completed[idx] = True
+
+    def get_status(self, idx: int) -> str:
+        return self._status[idx]
+
+
+class RayManager:
+    def __init__(
+        self,
+        tasks: list[t.BaseTask],
+        agent_configs: list[AgentConfig],
+        batch_run_paths: list[Path],
+        max_concurrent_tasks: int = None,  # None means no limit
+        timeout: int = 600,  # Seconds without a step (heartbeat) after which a run is cancelled
+        shared_data: dict[str, Callable[[], Any]] = None,  # Loaders of the data to share, e.g. tools.SHARED_DATA_LOADERS
+        debug: bool = False,
+    ):
+        self.tasks = tasks
+        self.agent_configs = agent_configs
+        self.batch_run_paths = batch_run_paths
+        self.max_concurrent_tasks = max_concurrent_tasks or len(tasks)
+        self.timeout = timeout
+        self.shared_data = shared_data or {}
+        self.debug = debug
+        self.run_names = []
+        self.run_paths = []
+        self.stats: list[Stats | None] = []  # Stats of the runs, including the resumed ones, set by run
+        self.n_resumed = 0
+        self.monitor = None
+
+    async def run(
+        self,
+        client: str | Callable[[], BaseClient],  # A model for get_client or a function creating a client
+        debug=False,
+        resume: bool = False,  # Skip the runs which have finished in the batch run paths, see Manager.run
+        retry_statuses: tuple[str, ...] = RETRY_FAILED,
+    ):
+        """Run the tasks on the Ray cluster and return their run names, statuses, scores, RunResult handles
+        (in place of the agents) and tasks, like Manager.run."""
+        self.debug = debug
+        shared_data_refs = put_shared_data(self.shared_data)
+
+        n = len(self.tasks)
+        statuses, scores, results, tasks = [None] * n, [None] * n, [None] * n, list(self.tasks)
+        self.stats = [None] * n
+        args, indices = [], []
+        for i, (task, agent_config, batch_run_path) in enumerate(
+            zip(self.tasks, self.agent_configs, self.batch_run_paths, strict=True)
+        ):
+            agent_config.verbose = 0
+            run_path = batch_run_path / task.name
+            self.run_names.append(task.name)
+            self.run_paths.append(run_path)
+
+            report = load_run_report(run_path) if resume else None
+            if report is not None and not report["status"].startswith(tuple(retry_statuses)):
+                self.n_resumed += 1
+                statuses[i], scores[i] = report["status"], report["score"]
+                self.stats[i] = Stats.from_dict(report["stats"]) if report["stats"] else None
+                continue
+
+            args.append({
+                "task": task,
+                "config": agent_config,
+                "run_path": run_path,
+                "client": client,
+                "shared_data": shared_data_refs,
+            })
+            indices.append(i)
+
+        self.monitor = RayBatchMonitor(args, overwrite=not debug)
+        # run_ray_tasks blocks until all runs finish, the event loop keeps running meanwhile
+        stop = threading.Event()
+        ray_job = asyncio.ensure_future(asyncio.to_thread(
+            run_ray_tasks, run_task_remote, args, self.max_concurrent_tasks, self.timeout, self.monitor, stop=stop
+        ))
+        try:
+            ray_results = await asyncio.shield(ray_job)
+        except asyncio.CancelledError:
+            # Cancel the running Ray tasks and wait for run_ray_tasks to return
+            stop.set()
+            await ray_job
+            print("Jobs cancelled.")
+            return None, None, None, None, None
+
+        for idx, i in enumerate(indices):
+            if idx in ray_results:
+                statuses[i], scores[i], results[i], tasks[i] = ray_results[idx]
+                self.stats[i] = results[i].stats
+            else:
+                # The run has failed or has been cancelled, e.g. for missing heartbeats
+                statuses[i] = f"code failure: {self.monitor.get_status(idx) or 'the Ray task failed'}"
+        print("Jobs finished.")
+        return self.run_names, tuple(statuses), tuple(scores), tuple(results), tuple(tasks)
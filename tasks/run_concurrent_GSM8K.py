@@ -12,7 +12,7 @@ load_dotenv()
 from time import time  # noqa
 
 from agent.clients import get_client  # noqa
-from batch_eval import save_results, Manager, create_batch_run_path  # noqa
+from batch_eval import RETRY_ERRORS, RETRY_FAILED, save_results, Manager, create_batch_run_path  # noqa
 import data_collection_config as dcf  # noqa
 
 # model to evaluate
@@ -34,7 +34,9 @@ for i, task in enumerate(taskset.tasks):
         print("No guidelines")
 
 start_t = time()
-batch_run_path = create_batch_run_path(model, taskset.name)
+resume = False  # Continue the latest batch run of the taskset, skipping the finished runs
+retry_statuses = RETRY_FAILED  # With resume, run these again; RETRY_ERRORS keeps the failed runs
+batch_run_path = create_batch_run_path(model, taskset.name, resume=resume)
 agent_configs = taskset.get_agent_configs()
 
 manager = Manager(
@@ -45,7 +47,7 @@ manager = Manager(
 )
 
 
-run_task = asyncio.create_task(manager.run(client))
+run_task = asyncio.create_task(manager.run(client, resume=resume, retry_statuses=retry_statuses))
 
 
 await run_task
@@ -53,7 +55,7 @@ await manager.monitor_job
 
 
 run_names, statuses, scores, agents, tasks = run_task.result()
-stats = [agent.stats for agent in agents]
+stats = manager.stats  # Including the stats of the resumed runs
 end_t = time()
 
 
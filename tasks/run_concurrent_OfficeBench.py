@@ -12,7 +12,7 @@ load_dotenv()
 from time import time  # noqa
 
 from agent.clients import get_client  # noqa
-from tasks.batch_eval import save_results, Manager, create_batch_run_path  # noqa
+from tasks.batch_eval import RETRY_ERRORS, RETRY_FAILED, save_results, Manager, create_batch_run_path  # noqa
 import tasks.t_OfficeBench.data_collection_config as dcf  # noqa
 
 # baseline / teacher / trained model to evaluate or collect data with
@@ -81,7 +81,9 @@ for i, task in enumerate(taskset.tasks):
 # %%
 
 start_t = time()
-batch_run_path = create_batch_run_path(model, taskset.name)
+resume = False  # Continue the latest batch run of the taskset, skipping the finished runs
+retry_statuses = RETRY_FAILED  # With resume, run these again; RETRY_ERRORS keeps the failed runs
+batch_run_path = create_batch_run_path(model, taskset.name, resume=resume)
 run_paths = [batch_run_path] * len(taskset)
 
 for i, task in enumerate(taskset.tasks):
@@ -99,7 +101,7 @@ manager = Manager(
 )
 
 
-run_task = asyncio.create_task(manager.run(client, debug=False))
+run_task = asyncio.create_task(manager.run(client, debug=False, resume=resume, retry_statuses=retry_statuses))
 
 
 await run_task
@@ -107,7 +109,7 @@ await manager.monitor_job
 
 
 run_names, statuses, scores, agents, tasks = run_task.result()
-stats = [agent.stats for agent in agents]
+stats = manager.stats  # Including the stats of the resumed runs
 end_t = time()
 
 
@@ -1,4 +1,31 @@
 from agent import agent as ag
+from core.shared_data import get_shared_data
+
+
+# Loaders of the read-only data of the tools, which is loaded once per process, see core.shared_data
+def load_flights():
+    from tasks.t_ToolQA.t_table_task.utils.load_flights import DATA_FLIGHTS
+    return DATA_FLIGHTS
+
+def load_coffee():
+    from tasks.t_ToolQA.t_table_task.utils.load_coffee import DATA_COFFEE
+    return DATA_COFFEE
+
+def load_airbnb():
+    from tasks.t_ToolQA.t_table_task.utils.load_airbnb import DATA_AIRBNB
+    return DATA_AIRBNB
+
+def load_yelp():
+    from tasks.t_ToolQA.t_table_task.utils.load_yelp import DATA_YELP
+    return DATA_YELP
+
+def load_graph_data():
+    from tasks.t_ToolQA.t_graph_task.utils import GRAPH_DATA
+    return GRAPH_DATA
+
+TABLE_LOADERS = {"flights": load_flights, "coffee": load_coffee, "airbnb": load_airbnb, "yelp": load_yelp}
+# The data to put into the object store of a Ray batch run, see tasks.ray_eval.RayManager
+SHARED_DATA_LOADERS = {**TABLE_LOADERS, "dblp": load_graph_data}
 
 def data_filter(agent: ag.Agent, data, argument):
     """data_filter(database: pandas.DataFrame, argument: str) -> pandas.DataFrame
@@ -221,16 +248,9 @@ def mock_load_db(agent: ag.Agent, db_variant: str):
         Example calls:
         `flights_db = load_db('flights')`: Returns the flights database."""
     agent.stats.add_tool_call("load_db")
-    if db_variant == 'flights':
-        from tasks.t_ToolQA.t_table_task.utils.load_flights import DATA_FLIGHTS as TABLE_DATA
-    elif db_variant == 'coffee':
-        from tasks.t_ToolQA.t_table_task.utils.load_coffee import DATA_COFFEE as TABLE_DATA
-    elif db_variant == 'airbnb':
-        from tasks.t_ToolQA.t_table_task.utils.load_airbnb import DATA_AIRBNB as TABLE_DATA
-    elif db_variant == 'yelp':
-        from tasks.t_ToolQA.t_table_task.utils.load_yelp import DATA_YELP as TABLE_DATA
-    else:
+    if db_variant not in TABLE_LOADERS:
         raise ValueError("Invalid database variant. Please choose from flights, coffee, airbnb, or yelp.")
+    TABLE_DATA = get_shared_data(db_variant, TABLE_LOADERS[db_variant])
     print("{} database has been successfully loaded, which includes the following columns: {}.".format(db_variant, TABLE_DATA[1]))
     return TABLE_DATA[0]
 
@@ -252,7 +272,7 @@ def mock_load_graph(agent: ag.Agent):
         - Output: The graph data.
         Example calls:
         `GRAPH_DATA = load_graph()`: Returns the graph data."""
-    from tasks.t_ToolQA.t_graph_task.utils import GRAPH_DATA
     agent.stats.add_tool_call("load_graph")
+    GRAPH_DATA = get_shared_data("dblp", load_graph_data)
     print("DBLP graph data is loaded, including two graphs: AuthorNet and PaperNet.")
     return GRAPH_DATA
\ No newline at end of file